@@ -1,32 +1,110 @@
 # coding=utf-8
 from abc import ABCMeta, abstractmethod
-from psycopg2.extras import Json
 from tornado import gen
 from tornado.web import HTTPError
 import numpy as np
-from irt import GrmIRTInfo, GradeResponseIrtModel, BrmIRTInfo
-from eap import EAP
-from utils import Flow, get_has_answered_que_id_list, del_session, get_threshold
+from irt import BrmIRTInfo, get_grm_item_info
+from eap import BrmPosteriorState, GrmPosteriorState
+from utils import Flow, get_has_answered_que_id_list, get_threshold, get_threshold_matrix, set_test_state, \
+    del_test_state
+from itembank import item_bank_cache, get_grid_index, QUESTION_COLUMNS, SHADOW_BANK_SIZE
+from exposure import exposure_control, exposure_counter
+from stopping import stopping_rule
+from statements import statements
+from settings import ITEM_BANK_CACHE, INFO_TABLE
 import random
 
 
+# 不定长的id列表都用数组参数，参数个数固定，可以预备一次反复执行
+QUE_SELECT = statements.register(
+    'que_select', "SELECT %s, NULL AS row_num FROM question WHERE id=%%s AND questionnaire_id=%%s" % QUESTION_COLUMNS)
+LEVEL_ONE_SELECT = statements.register('level_one_select', """
+    select * from (select %s, row_number() over(order by threshold) row_num from question
+    where questionnaire_id=%%s and a_level=%%s and id <> ALL(%%s::integer[]) ) as temp
+    where row_num = ANY(%%s::bigint[])
+    """ % QUESTION_COLUMNS)
+# 影子题库的候选题：难度低于theta和不低于theta的两侧各沿(questionnaire_id, a_level, threshold)索引
+# 取SHADOW_BANK_SIZE道，合并后留下离theta最近的SHADOW_BANK_SIZE道，不必对整层按距离排序
+_SHADOW_CANDIDATES = """
+    below as (select {columns} from question
+              where questionnaire_id=%s and a_level=%s and id <> ALL(%s::integer[]) and threshold < %s
+              order by threshold desc limit {size}),
+    above as (select {columns} from question
+              where questionnaire_id=%s and a_level=%s and id <> ALL(%s::integer[]) and threshold >= %s
+              order by threshold limit {size}),
+    temp as (select *, row_number() over(order by (abs(threshold-%s))) row_num
+             from (select * from below union all select * from above) as near),
+    temp1 as (select * from temp where row_num <= {size})
+    """.format(columns=QUESTION_COLUMNS, size=SHADOW_BANK_SIZE)
+# 影子题库整个取回，由曝光控制策略在内存里选题
+SHADOW_SELECT = statements.register('shadow_select', """
+    with %s
+    select * from temp1 order by row_num
+    """ % _SHADOW_CANDIDATES)
+# 查信息函数排序表：theta所在格点上信息函数最大的SHADOW_BANK_SIZE道未作答的题
+INFO_RANK_SELECT = statements.register('info_rank_select', """
+    select {columns}, ranked.row_num from question join unnest(
+        (select question_ids from question_info_rank where questionnaire_id=%s and a_level=%s and theta_bin=%s))
+        with ordinality as ranked(que_id, row_num) on question.id = ranked.que_id
+    where ranked.que_id <> ALL(%s::integer[])
+    order by ranked.row_num limit {size}
+    """.format(columns=QUESTION_COLUMNS, size=SHADOW_BANK_SIZE))
+ANSWER_FINISH = statements.register(
+    'answer_finish', "UPDATE answer SET theta=%s, info=%s, has_finished=%s WHERE id=%s")
+RESPONSE_INSERT = statements.register(
+    'response_insert',
+    "INSERT INTO response (answer_id, try_count, step, question_id, a_level, choice, score, theta, info) "
+    "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)")
+
+
+@gen.coroutine
+def get_que_by_id(db, q, que_id):
+    """
+    按id取出试题对象
+    :param q: 问卷对象
+    :param que_id: 试题id
+    :return: 试题对象
+    """
+    if ITEM_BANK_CACHE:
+        bank = yield item_bank_cache.get_bank(db, q)
+        que = bank.get_que(que_id)
+    else:
+        cursor = yield statements.execute(db, QUE_SELECT, (que_id, q.id))
+        que = cursor.fetchone()
+    if que is None:
+        raise HTTPError(404)
+    raise gen.Return(que)
+
+
 @gen.coroutine
-def get_level_one_item(ans, session, q, level_one_count, db):
+def get_que_scores(db, q, que_id):
+    """
+    试题各选项的得分数组，从内存题库的得分表里取，不用题库缓存时返回None（由CheckChoice解析choice_value）
+    :param q: 问卷对象
+    :param que_id: 试题id
+    :raise gen.Return: numpy数组或None
+    """
+    scores = None
+    if ITEM_BANK_CACHE:
+        bank = yield item_bank_cache.get_bank(db, q)
+        scores = bank.get_scores(que_id)
+    raise gen.Return(scores)
+
+
+@gen.coroutine
+def get_level_one_item(ans, state, q, level_one_count, db):
     """
     选出第一层的题目
-    :param ans:
-    :param session:
+    :param ans: 作答记录
+    :param state: 测验状态，TestState对象
     :param q: 问卷对象
     :param level_one_count: 第一层待抽的题目数量
     :return: 返回第一次抽取的题目对象
     """
     que = None
 
-    # 测验ID
-    q_id = q.id
-
     # 生成答题者已经做过的题目的id列表
-    can_not_in_choices_index = get_has_answered_que_id_list(ans, 1)
+    can_not_in_choices_index = get_has_answered_que_id_list(ans, state, 1)
 
     # 第一层题库的题量
     _count = q.level_one_count - len(can_not_in_choices_index)
@@ -38,13 +116,8 @@ def get_level_one_item(ans, session, q, level_one_count, db):
     # 题量/待抽题量，确定每道试题抽取题库的范围
     _slice = _count / level_one_count
 
-    # json field
-    # 选出来的题目放入这个字典
-    selected_que_dict = {}
-    # 选出来的题名顺序放入这个字典
-    order_que = {}
-    # 第一阶段的试题存入session的列表
-    next_item_list = []
+    # 第一阶段的试题id存入测验状态的列表
+    next_id_list = []
 
     choice_question_index_list = []
 
@@ -59,71 +132,54 @@ def get_level_one_item(ans, session, q, level_one_count, db):
             choice_question_index = i + 1
         choice_question_index_list.append(choice_question_index)
 
-    if not can_not_in_choices_index:
-        cursor = yield db.execute("""
-                select * from (select *, row_number() over(order by threshold) row_num from question
-                where questionnaire_id=%s and a_level=%s ) as temp
-                where row_num in %s
-                """, (q.id, 1, tuple(choice_question_index_list)))
+    if ITEM_BANK_CACHE:
+        bank = yield item_bank_cache.get_bank(db, q)
+        level_bank = bank.get_level(1)
+        if level_bank is None:
+            raise HTTPError(403)
+        use_question_list = level_bank.get_ques_by_row_num(choice_question_index_list, can_not_in_choices_index)
     else:
-        cursor = yield db.execute("""
-                select * from (select *, row_number() over(order by threshold) row_num from question
-                where questionnaire_id=%s and a_level=%s and not (id in %s) ) as temp
-                where row_num in %s
-                """, (q.id, 1, tuple(can_not_in_choices_index), tuple(choice_question_index_list)))
-
-    use_question_list = cursor.fetchall()
+        cursor = yield statements.execute(db, LEVEL_ONE_SELECT,
+                                          (q.id, 1, list(can_not_in_choices_index), choice_question_index_list))
+        use_question_list = cursor.fetchall()
 
     for i, use_question in enumerate(use_question_list):
-        # 保存试题参数到session
-        session['%s_a' % q_id].append(use_question.slop)
-        session['%s_b' % q_id].append(get_threshold(use_question))
-        # oder_que的key
-        index_key = i + 1
-        order_que[index_key] = use_question.id
-        selected_que_dict[use_question.id] = {'a_level': 1,
-                                              'slop': use_question.slop,
-                                              'threshold': get_threshold(use_question)}
         if i == 0:
             que = use_question
         else:
-            next_item_list.append(use_question)
+            next_id_list.append(use_question.id)
 
-    ans.score_answer.update(selected_que_dict)
-    ans.order_answer.update(order_que)
-    # session存入下面题目
-    session['%s_next_item' % q.id] = next_item_list
+    # 测验状态存入下面题目
+    state.next_ids = next_id_list
     raise gen.Return(que)
 
 
 @gen.coroutine
-def get_level_others_items(session, q_id, est_theta, shadow_bank, ans, db):
+def get_level_others_items(state, q_id, est_theta, shadow_bank, ans, db, bank=None, info_table=False):
     """
     选出其他层的题目
-    :param session:
+    :param state: 测验状态，TestState对象
     :param q_id:
-    :param ans:
+    :param ans: 作答记录
     :param est_theta:估计特质
     :param shadow_bank: 影子题库class
+    :param bank: 可选，内存题库ItemBank，为None时查询数据库
+    :param info_table: 查询数据库时是否查信息函数排序表
     :return:问题对象
     """
 
     # 当前测验所属层数（阶段）
-    level = session['%s_stage' % q_id]
+    level = state.stage
 
-    # 该层已作答试题列表
-    # 修改为适合json field
     # 不该出现于待抽提的题目ID列表
     a_level = int(level)
-    not_in_index_list = get_has_answered_que_id_list(ans, a_level=a_level)
-
-    # 抽出来的题
-    que = yield shadow_bank(q_id, a_level, est_theta, not_in_index_list, db).get_que()
+    not_in_index_list = get_has_answered_que_id_list(ans, state, a_level=a_level)
 
+    # 测验进度，progressive restricted曝光控制用
+    progress = (state.step - 1) * 1.0 / state.step_count
 
-    # 保存试题参数到session
-    session['%s_a' % q_id].append(que.slop)
-    session['%s_b' % q_id].append(get_threshold(que))
+    # 抽出来的题
+    que = yield shadow_bank(q_id, a_level, est_theta, not_in_index_list, db, bank, progress, info_table).get_que()
 
     # 返回试题
     raise gen.Return(que)
@@ -132,12 +188,15 @@ def get_level_others_items(session, q_id, est_theta, shadow_bank, ans, db):
 class BaseShadowBank:
     __metaclass__ = ABCMeta
 
-    def __init__(self, q_id, a_level, est_theta, not_in_index, db):
+    def __init__(self, q_id, a_level, est_theta, not_in_index, db, bank=None, progress=0.0, info_table=False):
         """
         影子题库
         :param questions: 待抽题对象列表
         :param est_theta: 估计参数
         :param not_in_index: 不该进入抽题的题目id列表
+        :param bank: 可选，内存题库ItemBank，为None时查询数据库
+        :param progress: 测验进度，已作答题量/总题量
+        :param info_table: 是否查question_info_rank表，否则取难度与theta最近的题
         :return: 抽出来的题
         """
 
@@ -151,127 +210,109 @@ class BaseShadowBank:
 
         self.db = db
 
-    @abstractmethod
-    def get_que(self):
-        # 抽题
-        pass
+        self.bank = bank
 
+        self.progress = progress
 
-class BrmShadowBank(BaseShadowBank):
-    @gen.coroutine
-    def get_que(self):
-        theta = self.est_theta
-        q_id = self.q_id
-        a_level = self.a_level
-        not_in_index = self.not_in_index
-
-        if not not_in_index:
-
-            query = '''
-                    with temp1 as (
-                        with temp as (select *, row_number() over(order by (abs(threshold-%s))) row_num
-                            from question where questionnaire_id=%s and a_level=%s )
-                        select * from temp where row_num < 31)
-                    select * from temp1 ORDER BY (count / ((select sum(count) from temp1) + 1.0)) / ((slop ^ 2) / ((1 + exp(slop * (threshold-%s))) * (1 + exp(slop*(%s - threshold))))) limit 1
-                    '''
-            cursor = yield self.db.execute(query, [theta, q_id, a_level, theta, theta])
-
-        else:
-            query = '''
-                    with temp1 as (
-                        with temp as (select *, row_number() over(order by (abs(threshold-%s))) row_num
-                            from question where questionnaire_id=%s and a_level=%s and not (id in %s ))
-                        select * from temp where row_num < 31)
-                    select * from temp1 ORDER BY (count / ((select sum(count) from temp1) + 1.0)) / ((slop ^ 2) / ((1 + exp(slop * (threshold-%s))) * (1 + exp(slop*(%s - threshold))))) limit 1
-                    '''
-            cursor = yield self.db.execute(query, [theta, q_id, a_level, tuple(not_in_index), theta, theta])
-
-        q = cursor.fetchone()
-        if q:
-            raise gen.Return(q)
-        else:
-            HTTPError(403)
+        self.info_table = info_table
 
-
-class GrmShadowBank(BaseShadowBank):
     @gen.coroutine
     def get_que(self):
-
+        # 抽题，影子题库的信息函数算好后交给曝光控制策略选题
+        if self.bank is not None:
+            raise gen.Return(self.get_cached_que())
         shadow_questions = yield self.get_shadow_question_list()
+        if not shadow_questions:
+            raise HTTPError(403)
         count_array, info_array = self.get_count_and_info_values_list(shadow_questions)
-
-        total_count = np.sum(count_array)
-
-        if total_count > 0:
-            # 抽取使用率最低的题目
-            index_min = ((count_array / total_count) / info_array).argmin()
-            qs = shadow_questions[index_min]
-        else:
-            qs = shadow_questions[0]
-        raise gen.Return(qs)
+        # 查出的count加上还没写回数据库的曝光次数，和题库缓存里的计数一致
+        count_array = count_array + np.array([exposure_counter.get_pending(que.id) for que in shadow_questions],
+                                             dtype=float)
+        index = exposure_control.select(
+            info_array, count_array,
+            np.array([que.exposure_param for que in shadow_questions], dtype=float),
+            np.array([que.exposure_rate for que in shadow_questions], dtype=float),
+            self.progress)
+        raise gen.Return(shadow_questions[index])
 
     @gen.coroutine
     def get_shadow_question_list(self):
-        q_id = self.q_id
-        a_level = self.a_level
-        not_in_index = self.not_in_index
-        if not not_in_index:
-            cursor = yield self.db.execute(
-                """
-                with temp as (select *, row_number() over(order by (abs(threshold-%s))) row_num
-                from question where questionnaire_id=%s and a_level=%s )
-                select * from temp where row_num < 31
-                """,
-                (self.est_theta, q_id, a_level)
-            )
-        else:
-            cursor = yield self.db.execute(
-                """
-                with temp as (select *, row_number() over(order by (abs(threshold-%s))) row_num
-                from question where questionnaire_id=%s and a_level=%s and not (id in %s ))
-                select * from temp where row_num < 31
-                """,
-                (self.est_theta, q_id, a_level, tuple(not_in_index))
-            )
-
+        if self.info_table:
+            cursor = yield statements.execute(self.db, INFO_RANK_SELECT, (
+                self.q_id, self.a_level, get_grid_index(self.est_theta), list(self.not_in_index)))
+            shadow_question_list = cursor.fetchall()
+            if shadow_question_list:
+                raise gen.Return(shadow_question_list)
+        cursor = yield statements.execute(self.db, SHADOW_SELECT, self.get_candidate_params())
         shadow_question_list = cursor.fetchall()
         raise gen.Return(shadow_question_list)
 
+    @abstractmethod
+    def get_count_and_info_values_list(self, shadow_questions):
+        # 影子题库各题的曝光次数和在est_theta处的信息函数值
+        pass
+
+    def get_candidate_params(self):
+        # _SHADOW_CANDIDATES的参数
+        not_in_index = list(self.not_in_index)
+        return ((self.q_id, self.a_level, not_in_index, self.est_theta) * 2) + (self.est_theta,)
+
+    def get_cached_que(self):
+        # 从内存题库抽题，二分查找出影子题库，信息函数查预先算好的表
+        level_bank = self.bank.get_level(self.a_level)
+        que = level_bank.get_que(self.est_theta, self.not_in_index, self.progress) if level_bank is not None else None
+        if que is None:
+            raise HTTPError(403)
+        return que
+
+
+class BrmShadowBank(BaseShadowBank):
     def get_count_and_info_values_list(self, shadow_questions):
-        a_array = np.array([])
-        b_array = np.array([])
-        count_array = np.array([])
-        for que in shadow_questions:
-            a_array = np.append(a_array, que.slop)
-            b_array = np.append(a_array, get_threshold(que))
-            count_array = np.append(count_array, que.count)
-        # 下面将斜率变成二维数组,才能计算,否则会跳出不能计算的异常
-        a_array.shape = a_array.shape[0], 1
-        return count_array, GrmIRTInfo(a_array, b_array, self.est_theta).get_item_info_list()
+        a_array = np.array([que.slop for que in shadow_questions], dtype=float)
+        b_array = np.array([que.threshold for que in shadow_questions], dtype=float)
+        count_array = np.array([que.count for que in shadow_questions], dtype=float)
+        return count_array, BrmIRTInfo(a_array, b_array, self.est_theta).get_item_info_list()
+
+
+class GrmShadowBank(BaseShadowBank):
+    def get_count_and_info_values_list(self, shadow_questions):
+        a_array = np.array([que.slop for que in shadow_questions], dtype=float)
+        b_matrix = get_threshold_matrix([get_threshold(que) for que in shadow_questions])
+        count_array = np.array([que.count for que in shadow_questions], dtype=float)
+        return count_array, get_grm_item_info(a_array, b_matrix, [self.est_theta])[:, 0]
 
 
 class BaseSelectQuestion:
     __metaclass__ = ABCMeta
 
-    def __init__(self, session, q, que_id, ans, db):
+    def __init__(self, session, state, q, que, score, choice, ans, db, batch):
         """
 
         :param session:
-        :param ans:
+        :param state: 测验状态，TestState对象
+        :param ans: 作答记录
         :param db:
+        :param batch: StepBatch对象，作答记录的写入攒在这里，和session一起一次写入
         :param q: 问卷对象，model对象
-        :param que_id: 问卷id，整数
+        :param que: 刚作答的试题对象
+        :param score: 刚作答试题的得分，整数
+        :param choice: 刚作答试题所选的选项
         """
         self.session = session
+        self.state = state
         self.q = q
-        self.que_id = que_id
+        self.que = que
+        self.que_id = que.id
         self.q_id = q.id
-        self.a = None
-        self.b = None
-        self.score = None
+        self.score = score
+        self.choice = choice
+        self.posterior = None
         self.theta = None
         self.ans = ans
         self.db = db
+        self.batch = batch
+        # 内存题库，不用题库缓存时为None
+        self.bank = None
 
     @gen.coroutine
     def get_que_then_redirect(self):
@@ -279,105 +320,124 @@ class BaseSelectQuestion:
         q_id = self.q_id
         que_id = self.que_id
         db = self.db
+        batch = self.batch
         ans = self.ans
         session = self.session
+        state = self.state
+        if ITEM_BANK_CACHE:
+            self.bank = yield item_bank_cache.get_bank(db, q)
         # 将是否重启测验设定为false
-        session['is_%s_re_start' % q_id] = False
+        state.re_start = False
+        state.add_response(que_id, self.score)
+        # 这道题已经计分，清掉当前试题，重复提交同一道题时不再计分
+        state.que_id = None
+        # 把刚作答的试题加入后验状态
+        self.posterior = self.get_posterior_class().from_json(state.posterior)
+        self.update_posterior()
+        state.posterior = self.posterior.to_json()
+        # 被试答题过程
+        flow = Flow(flow=q.flow, name=q.flow)
+        # 由终止规则决定下一道题所在阶段
+        state.stage_step += 1
+        next_stage = stopping_rule.get_next_stage(flow, state.stage, state.stage_step, self.posterior.sd)
+        if next_stage != state.stage:
+            state.stage = next_stage
+            state.stage_step = 0
         # 下面是第一阶段抽题
-        if session['%s_stage' % q_id] == 1:
-            yield db.execute("UPDATE answer SET order_answer=%s, score_answer=%s WHERE id=%s",
-                             (Json(ans.order_answer), Json(ans.score_answer), ans.aid))
+        if state.stage == 1:
+            self.add_response()
+            set_test_state(session, q_id, state)
             raise gen.Return('/cat/%s' % q_id)
         else:
-            # 获取已作答项目参数
-            self.a = np.array(session['%s_a' % q_id])
-            self.b = np.array(session['%s_b' % q_id])
-            self.score = np.array(session['%s_score' % q_id])
-
             # 计算潜在特质
             self.theta = self.get_theta()
             # 计算误差
             info = self.get_info()
+            self.add_response(self.theta, info)
 
-            # 保存误差和潜在特质的值
-            # 修改为适合json field
-            ans.score_answer[str(que_id)].update({'info': info, 'theta': self.theta})
-            # 被试答题过程
-            flow = Flow(flow=q.flow, name=session.session_key)
-
-            if session['%s_stage' % q_id] == flow.level_len + 1:
+            if state.stage == flow.level_len + 1:
                 # 上面是结束规则
-                yield db.execute("UPDATE answer SET theta=%s, info=%s, has_finished=%s,"
-                                 "order_answer=%s, score_answer=%s WHERE id=%s",
-                                 (self.theta, info, True, Json(ans.order_answer), Json(ans.score_answer), ans.aid))
+                batch.add(*ANSWER_FINISH.get_query((self.theta, info, True, ans.aid)))
 
-                # 删除所有测验相关session键值
-                del_session(session, q_id)
+                # 删除测验状态
+                del_test_state(session, q_id)
 
                 # 返回到问卷列表页面
                 raise gen.Return('/result/%s' % q_id)
             else:
                 # 第二阶段抽题
-                que = yield get_level_others_items(session, q_id, self.theta, self.get_shadow_bank(), ans, db)
-                session['q_%s_id' % q_id] = que
-                level = session['%s_stage' % q_id]
-                index_key = session['%s_step' % q_id] + 1
-                ans.score_answer[str(que.id)] = {'a_level': level,
-                                                 'slop': que.slop,
-                                                 'threshold': get_threshold(que)}
-                session['%s_next_item' % q_id] = que
-                ans.order_answer[index_key] = que.id
-                yield db.execute("UPDATE answer SET order_answer=%s, score_answer=%s WHERE id=%s",
-                                 (Json(ans.order_answer), Json(ans.score_answer), ans.aid))
+                bank = self.bank
+                # 排序表重建之后试题参数没改过才能用
+                info_table = INFO_TABLE and q.info_table_version == q.bank_version
+                que = yield get_level_others_items(state, q_id, self.theta, self.get_shadow_bank(), ans, db, bank,
+                                                   info_table)
+                state.next_ids = [que.id]
+                set_test_state(session, q_id, state)
                 raise gen.Return('/cat/%s' % q_id)
 
+    def add_response(self, theta=None, info=None):
+        """
+        往response表追加刚作答的一道题，和session一起写入
+        :param theta: 作答后的特质估计值，第一阶段不估计
+        :param info: 作答后的测验信息
+        """
+        state = self.state
+        self.batch.add(*RESPONSE_INSERT.get_query(
+            (self.ans.aid, self.ans.try_count, state.step, self.que_id, self.que.a_level, self.choice,
+             self.score, theta, info)))
+
     @abstractmethod
     def get_shadow_bank(self, *args, **kwargs):
         # 影子题库
         pass
 
     @abstractmethod
-    def get_theta(self, *args, **kwargs):
-        # 返回参数估计值,这里放参数估计算法
+    def get_posterior_class(self):
+        # 后验状态类，这里放参数估计算法
         pass
 
     @abstractmethod
+    def update_posterior(self):
+        # 把刚作答的试题加入后验状态
+        pass
+
+    def get_que_threshold(self):
+        # 刚作答试题的阈值，有内存题库时取载入时解析好的，不再切分字符串
+        if self.bank is not None:
+            threshold = self.bank.get_threshold(self.que_id)
+            if threshold is not None:
+                return threshold
+        return get_threshold(self.que)
+
+    def get_theta(self):
+        # 返回参数估计值
+        return self.posterior.res
+
     def get_info(self):
         # 返回信息函数计算值
-        pass
+        return self.posterior.get_info(self.theta)
 
 
 class BrmSelectQuestion(BaseSelectQuestion):
     def get_shadow_bank(self):
         return BrmShadowBank
 
-    def get_theta(self):
-        return EAP(a=self.a, b=self.b, score=self.score).res
+    def get_posterior_class(self):
+        return BrmPosteriorState
 
-    def get_info(self):
-        return BrmIRTInfo(self.a, self.b, self.theta).get_test_info()
+    def update_posterior(self):
+        self.posterior.update(self.que.slop, self.que.threshold, self.score)
 
 
 class GrmSelectQuestion(BaseSelectQuestion):
     def get_shadow_bank(self):
         return GrmShadowBank
 
-    def get_theta(self):
-        # 斜率的维度需要改变
-        self.a.shape = self.a.shape[0], 1
-        if self.session['%s_x0' % self.q_id] is not None:
-            # 用前一个参数估计结果作为初始估计值,否则会不收敛出错
-            theta = GradeResponseIrtModel(a=self.a, b=self.b, score=self.score).get_est_theta(
-                self.session['%s_x0' % self.q_id])
-        else:
-            # 对前三道题的参数估计,用0作为初值
-            theta = GradeResponseIrtModel(a=self.a, b=self.b, score=self.score).get_est_theta(0)
-        # 将估计出来的theta值存入session，待下次调用
-        self.session['%s_x0' % self.q_id] = theta
-        return theta
+    def get_posterior_class(self):
+        return GrmPosteriorState
 
-    def get_info(self):
-        return GrmIRTInfo(self.a, self.b, self.theta).get_test_info()
+    def update_posterior(self):
+        self.posterior.update(self.que.slop, self.get_que_threshold(), self.score)
 
 
 class SelectQuestion(object):
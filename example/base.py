@@ -1,46 +1,87 @@
 # coding=utf-8
 from tornado import gen
+from tornado.log import app_log
 from utils import get_random_string
+from session import Session
+from persistence import StepBatch, RoundTripCounter
 from tornado.web import RequestHandler
-from psycopg2.extras import Json
-from psycopg2 import IntegrityError
 
 class BaseHandler(RequestHandler):
 
+    _db = None
+
     @property
     def db(self):
-        # 数据库
-        return self.application.db
+        # 数据库，经RoundTripCounter代理，记录本次请求的查询往返次数
+        if self._db is None:
+            self._db = RoundTripCounter(self.application.db)
+        return self._db
+
+    def finish(self, chunk=None):
+        if self._db is not None:
+            self.set_header('X-DB-Round-Trips', self._db.round_trips)
+        return super(BaseHandler, self).finish(chunk)
+
+    def on_finish(self):
+        if self._db is not None:
+            app_log.debug('%s %s: %d db round trips', self.request.method, self.request.path, self._db.round_trips)
 
 
 class SessionBaseHandler(BaseHandler):
 
-    # TODO 需要更快的基于memcached或redis的session,且支持异步
-    # session
+    # session存储后端见session.py，由settings.SESSION_STORE选择
+
+    # 为True且session存在业务数据库里时，prepare不单独查询session，
+    # 由子类第一次查询时一并取出，再调用load_session
+    prefetch_session = False
+
+    @property
+    def session_store(self):
+        return self.application.session_store
+
+    @property
+    def should_prefetch_session(self):
+        return self.prefetch_session and self.session_store.in_database
 
     @gen.coroutine
     def prepare(self):
         # 类似于middleware的作用, 为Handler类绑定session
         # 为了防止浏览器的后退前进按钮导致试题重复出现,所以添加header
         self.add_header('Cache-Control', 'no-cache, no-store, must-revalidate, max-age=0')
-        self.session_key, self.session = yield self._get_session()
+        # 本次请求要写的语句，在save时和session一起一次写入
+        self.step_batch = StepBatch()
+        if self.should_prefetch_session:
+            self.session_key, self.session = self.get_cookie('sessionid'), None
+        else:
+            self.session_key, self.session = yield self._get_session()
+
+    @gen.coroutine
+    def load_session(self, session_data):
+        """
+        绑定子类一并查询出来的session
+        :param session_data: 查询出的session_data，session不存在时为None
+        :raise gen.Return: session_key是否变了（新建了session）
+        """
+        if self.session_key and session_data is not None:
+            self.session = Session(session_data)
+            raise gen.Return(False)
+        self.session_key = yield self._get_init_db_session()
+        self.session = Session()
+        raise gen.Return(True)
 
     @gen.coroutine
     def _get_init_db_session(self):
         """
-        初始化session,往数据库session表插入session记录
+        初始化session,往session存储后端插入session记录
         往浏览器写入sessionid
         :raise gen.Return: session_key, 字符串
         """
         while True:
             session_key = get_random_string()
-            try:
-                yield self.db.execute("INSERT INTO session (session_key, session_data) VALUES (%s,%s)",
-                                      (session_key, Json({})))
+            created = yield self.session_store.create(session_key, {})
+            if created:
                 self.set_cookie('sessionid', session_key)
                 raise gen.Return(session_key)
-            except IntegrityError:
-                continue
 
     @gen.coroutine
     def _get_session(self):
@@ -50,20 +91,22 @@ class SessionBaseHandler(BaseHandler):
         """
         session_key = self.get_cookie('sessionid')
         if session_key:
-            cursor = yield self.db.execute("SELECT * FROM session WHERE session_key=%s",
-                                           (session_key,))
-            session = cursor.fetchone()
-            if session:
-                session_key = session.session_key
-                session = session.session_data
-                raise gen.Return((session_key, session))
+            session = yield self.session_store.get(session_key)
+            if session is not None:
+                raise gen.Return((session_key, Session(session)))
         session_key = yield self._get_init_db_session()
-        raise gen.Return((session_key, {}))
+        raise gen.Return((session_key, Session()))
 
     @gen.coroutine
     def save(self):
-        # 保存session数据
-        session_key = self.session_key
-        session_data = self.session
-        yield self.db.execute("UPDATE session SET session_data = %s WHERE session_key = %s;",
-                              (Json(session_data), session_key))
\ No newline at end of file
+        # 保存session数据，只写改动过的键，没有改动就不写
+        # session在业务数据库里时，和本次请求攒下的其他语句一次写入
+        session = self.session
+        if session.is_dirty:
+            statement = self.session_store.get_save_changes_statement(self.session_key, session)
+            if statement is None:
+                yield self.session_store.save_changes(self.session_key, session)
+            else:
+                self.step_batch.add(*statement)
+            session.clear_changes()
+        yield self.step_batch.execute(self.db)
@@ -0,0 +1,134 @@
+# coding=utf-8
+"""
+热点查询（用statements.py里登记的同一批查询）在加索引前后的执行计划和耗时
+在一个临时schema里迁移到最新版本后删掉热点查询的索引，生成大题库和大量作答记录，
+跑一遍热点查询，再重新执行加索引的迁移后重跑，最后删掉临时schema
+
+    python bench_indexes.py [题量] [作答记录数] [重复次数]
+"""
+import hashlib
+import sys
+import time
+import numpy as np
+import psycopg2
+from settings import DSN
+from migrate import migrate, MIGRATIONS
+from main import ANSWER_SELECT_WITH_SESSION, RESULT_SELECT
+from bank import LEVEL_ONE_SELECT, SHADOW_SELECT, BrmShadowBank
+
+BENCH_SCHEMA = 'cat_bench'
+
+# 加索引的迁移版本及其建的索引
+INDEX_VERSION = 5
+INDEXES = ('answer_questionnaire_id_session_key', 'question_questionnaire_id_a_level_threshold')
+
+QUESTIONNAIRE_COUNT = 20
+# 各问卷的flow，题目按层数均分
+FLOW = '5|4|3'
+LEVEL_COUNT = len(FLOW.split('|'))
+
+
+def generate_data(cursor, question_count, answer_count):
+    """
+    生成QUESTIONNAIRE_COUNT个问卷，question_count道题均分到各问卷flow的各层，
+    answer_count条作答记录，每条5道题的response
+    """
+    cursor.execute("""
+        INSERT INTO questionnaire (name, type, flow, level_one_count)
+        SELECT 'bench ' || i, 'brm', %(flow)s, %(level_one_count)s FROM generate_series(1, %(q_count)s) i;
+        INSERT INTO question (question, slop, threshold, choice_text, choice_value, count, a_level, questionnaire_id)
+        SELECT 'question ' || i, 0.5 + random() * 2, random() * 6 - 3, 'a|b', '0|1', (random() * 100)::integer,
+        1 + i %% %(level_count)s, 1 + (i / %(level_count)s) %% %(q_count)s
+        FROM generate_series(0, %(question_count)s - 1) i;
+        INSERT INTO session (session_key, session_data)
+        SELECT md5(i::text), '{}' FROM generate_series(1, %(answer_count)s) i;
+        INSERT INTO answer (questionnaire_id, session_key, try_count, has_finished)
+        SELECT 1 + i %% %(q_count)s, md5(i::text), 1, true FROM generate_series(1, %(answer_count)s) i;
+        INSERT INTO response (answer_id, try_count, step, question_id, a_level, choice, score)
+        SELECT answer.id, 1, step, 1 + (random() * (%(question_count)s - 1))::integer, 1, 'a', 1
+        FROM answer, generate_series(1, 5) step;
+        ANALYZE;
+        """, {'q_count': QUESTIONNAIRE_COUNT, 'question_count': question_count, 'answer_count': answer_count,
+              'flow': FLOW, 'level_count': LEVEL_COUNT,
+              'level_one_count': question_count / QUESTIONNAIRE_COUNT / LEVEL_COUNT})
+
+
+def get_hot_queries(answer_count):
+    """
+    :return: [(名称, Statement对象, 参数)]，取中间的一条作答记录
+    """
+    i = answer_count / 2
+    session_key = hashlib.md5(str(i)).hexdigest()
+    q_id = 1 + i % QUESTIONNAIRE_COUNT
+    shadow_bank = BrmShadowBank(q_id, 2, 0.5, [], None)
+    return [
+        ('answer lookup', ANSWER_SELECT_WITH_SESSION, (session_key, session_key, q_id)),
+        ('level one items', LEVEL_ONE_SELECT, (q_id, 1, [], [1, 50, 100, 150, 200])),
+        ('shadow bank', SHADOW_SELECT, shadow_bank.get_candidate_params()),
+        ('result', RESULT_SELECT, (q_id, session_key)),
+    ]
+
+
+def run_queries(cursor, hot_queries, repeat):
+    """
+    :return: {名称: (执行计划, 耗时中位数毫秒)}
+    """
+    result = {}
+    for name, statement, params in hot_queries:
+        query, params = statement.get_query(params, prepared=False)
+        cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + query, params)
+        plan = '\n'.join(row[0] for row in cursor.fetchall())
+        timings = []
+        for i in range(repeat):
+            s = time.time()
+            cursor.execute(query, params)
+            cursor.fetchall()
+            timings.append((time.time() - s) * 1000)
+        result[name] = plan, float(np.median(timings))
+    return result
+
+
+def main(question_count=100000, answer_count=100000, repeat=20):
+    conn = psycopg2.connect(DSN)
+    try:
+        with conn:
+            with conn.cursor() as cursor:
+                cursor.execute('DROP SCHEMA IF EXISTS %s CASCADE; CREATE SCHEMA %s; SET search_path TO %s;'
+                               % (BENCH_SCHEMA, BENCH_SCHEMA, BENCH_SCHEMA))
+        migrate(conn)
+        with conn:
+            with conn.cursor() as cursor:
+                for index in INDEXES:
+                    cursor.execute('DROP INDEX %s;' % index)
+                generate_data(cursor, question_count, answer_count)
+        hot_queries = get_hot_queries(answer_count)
+        with conn.cursor() as cursor:
+            before = run_queries(cursor, hot_queries, repeat)
+        conn.rollback()
+        with conn:
+            with conn.cursor() as cursor:
+                cursor.execute(dict((version, sql) for version, name, sql in MIGRATIONS)[INDEX_VERSION])
+        with conn.cursor() as cursor:
+            after = run_queries(cursor, hot_queries, repeat)
+        conn.rollback()
+        for name, statement, params in hot_queries:
+            print '=' * 80
+            print name
+            print '-' * 80
+            print 'before:'
+            print before[name][0]
+            print 'after:'
+            print after[name][0]
+        print '=' * 80
+        print '%-20s %12s %12s' % ('query', 'before(ms)', 'after(ms)')
+        for name, statement, params in hot_queries:
+            print '%-20s %12.3f %12.3f' % (name, before[name][1], after[name][1])
+    finally:
+        with conn:
+            with conn.cursor() as cursor:
+                cursor.execute('DROP SCHEMA IF EXISTS %s CASCADE;' % BENCH_SCHEMA)
+        conn.close()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
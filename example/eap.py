@@ -1,54 +1,218 @@
+# coding=utf-8
+from abc import ABCMeta, abstractmethod
+import base64
 import numpy as np
-from irt import LogisticModel
+from numpy.polynomial.hermite_e import hermegauss
+from irt import LogisticModel, GrmModel
 
+_quadrature_cache = {}
 
-class EAP:
 
-    def __init__(self, score, a, b, model=LogisticModel):
-        model = model(a, b, self.x_nodes)
-        p = model.prob_values
-        self.lik_values = np.prod(p**score*(1.0 - p)**(1-score), axis=1)
+def get_quadrature(n_nodes=21, method='hermite', bound=4.0):
+    """
+    标准正态先验下的积分节点和对数权重
+    :param n_nodes: 节点数，整数
+    :param method: 'hermite'为高斯-埃尔米特积分，'uniform'为[-bound, bound]上的等距节点
+    :param bound: 等距节点的上下界，浮点数
+    :return: (节点, 对数权重)，均为shape为（节点数，）的numpy数组，权重之和为1
+    """
+    key = (n_nodes, method, bound)
+    if key not in _quadrature_cache:
+        if method == 'hermite':
+            x, w = hermegauss(n_nodes)
+        elif method == 'uniform':
+            x = np.linspace(-bound, bound, n_nodes)
+            w = np.exp(-x ** 2 / 2.0)
+        else:
+            raise ValueError(u'不支持的积分方法%s' % method)
+        with np.errstate(divide='ignore'):
+            log_w = np.log(w / np.sum(w))
+        _quadrature_cache[key] = x, log_w
+    return _quadrature_cache[key]
+
+
+def _encode_array(values):
+    # numpy数组存成float32的base64字符串
+    return base64.b64encode(np.asarray(values, dtype='<f4').tobytes()).decode('ascii')
+
+
+def _decode_array(data):
+    return np.frombuffer(base64.b64decode(data), dtype='<f4').astype(float)
+
+
+class LogEAP(object):
+    """
+    对数空间的期望后验估计，逐题累加对数似然，长测验也不会下溢
+    score可以是一个被试（一维）或多个被试（二维，每行一个被试）的得分，
+    题量不同的被试用nan填充score，或者传入mask
+    """
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self, score, a, b, mask=None, n_nodes=21, quadrature='hermite'):
+        """
+        :param score: 得分，shape为（题量，）或（被试数，题量）的numpy数组
+        :param a: 斜率，能广播成score的shape
+        :param b: 阈值，BRM能广播成score的shape，GRM在此基础上多出最后一维边界
+        :param mask: 可选，shape同score的布尔数组，True表示该题作答有效
+        :param n_nodes: 积分节点数
+        :param quadrature: 积分方法，见get_quadrature
+        """
+        score = np.asarray(score, dtype=float)
+        if mask is None:
+            mask = ~np.isnan(score)
+        else:
+            mask = np.asarray(mask, dtype=bool)
+        self.x_nodes, log_weights = get_quadrature(n_nodes, quadrature)
+        a = np.broadcast_to(np.asarray(a, dtype=float), score.shape)
+        # 各题在每个节点上的对数似然，shape为（...，题量，节点数）
+        item_loglik = self.get_item_loglik_values(score, mask, a, np.asarray(b, dtype=float))
+        item_loglik[~mask] = 0.0
+        log_post = np.sum(item_loglik, axis=-2) + log_weights
+        # 减去最大值再取指数，防止溢出
+        post = np.exp(log_post - np.max(log_post, axis=-1)[..., np.newaxis])
+        self.post_values = post / np.sum(post, axis=-1)[..., np.newaxis]
+
+    @abstractmethod
+    def get_item_loglik_values(self, score, mask, a, b):
+        """
+        :return: 各题在每个积分节点上的对数似然，shape为score.shape + (节点数，)
+        """
+        pass
 
     @property
-    def g(self):
-        x = self.x_nodes
-        weight = self.weights
-        return np.sum(x[:, 0]*weight*self.lik_values)
+    def res(self):
+        # 后验均值
+        return np.dot(self.post_values, self.x_nodes)
 
     @property
-    def h(self):
-        weight = self.weights
-        return np.sum(weight * self.lik_values)
+    def sd(self):
+        # 后验标准差，可作为特质估计值的标准误
+        res = np.asarray(self.res)[..., np.newaxis]
+        return np.sqrt(np.sum(self.post_values * (self.x_nodes - res) ** 2, axis=-1))
+
+
+class BrmEAP(LogEAP):
+    """
+    二级计分模型的期望后验估计
+    """
+
+    def get_item_loglik_values(self, score, mask, a, b):
+        z = a[..., np.newaxis] * (self.x_nodes - b[..., np.newaxis])
+        # log(p) = -log(1+e^-z), log(1-p) = -log(1+e^z)
+        sign = np.where(score == 1, -1.0, 1.0)[..., np.newaxis]
+        return -np.logaddexp(0, sign * z)
+
+
+class GrmEAP(LogEAP):
+    """
+    等级计分模型的期望后验估计，得分从1开始
+    """
+
+    def get_item_loglik_values(self, score, mask, a, b):
+        # shape为（...，题量，节点数，等级数）
+        model = GrmModel(a[..., np.newaxis, np.newaxis], b[..., np.newaxis, :], self.x_nodes[:, np.newaxis])
+        p = model.category_prob_values
+        # 取出被试在每道题上所得等级的概率
+        index = np.where(mask, score - 1, 0).astype(int)
+        index = np.broadcast_to(index[..., np.newaxis, np.newaxis], p.shape[:-1] + (1,))
+        p = np.take_along_axis(p, index, axis=-1)[..., 0]
+        return np.log(np.maximum(p, np.finfo(float).tiny))
+
+
+class PosteriorState(object):
+    """
+    增量式的期望后验估计，把积分节点上的对数后验和测验信息作为状态保存，
+    每作答一道题只需更新一次节点上的值，不必对已作答的所有题重新计算
+    默认用等距节点，测验信息在节点之间线性插值
+    """
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self, log_post=None, info=None, n_nodes=41, quadrature='uniform'):
+        """
+        :param log_post: 节点上的对数后验（未归一化），为None时为先验
+        :param info: 节点上的测验信息，为None时为0
+        :param n_nodes: 积分节点数
+        :param quadrature: 积分方法，见get_quadrature
+        """
+        self.n_nodes = n_nodes
+        self.quadrature = quadrature
+        self.x_nodes, log_weights = get_quadrature(n_nodes, quadrature)
+        self.log_post = log_weights.copy() if log_post is None else np.array(log_post, dtype=float)
+        self.info_values = np.zeros(n_nodes) if info is None else np.array(info, dtype=float)
+
+    @abstractmethod
+    def update(self, a, b, score):
+        """
+        加入一道题的作答
+        :param a: 斜率，浮点数
+        :param b: 阈值，BRM为浮点数，GRM为各边界阈值的列表
+        :param score: 得分，整数
+        """
+        pass
+
+    @property
+    def post_values(self):
+        post = np.exp(self.log_post - np.max(self.log_post))
+        return post / np.sum(post)
 
     @property
     def res(self):
-        return self.g / self.h
-
-    x_nodes = np.array([[-7.84938289],
-                        [-6.75144472],
-                        [-5.82938201],
-                        [-4.99496394],
-                        [-4.21434398],
-                        [-3.46984669],
-                        [-2.75059298],
-                        [-2.04910247],
-                        [-1.35976582],
-                        [-0.67804569],
-                        [0],
-                        [0.67804569],
-                        [1.35976582],
-                        [2.04910247],
-                        [2.75059298],
-                        [3.46984669],
-                        [4.21434398],
-                        [4.99496394],
-                        [5.82938201],
-                        [6.75144472],
-                        [7.84938289]])
-
-    weights = np.array([3.72E-14, 8.82E-11, 2.57E-08, 2.17E-06, 7.48E-05, 0.001254982, 0.011414066, 0.060179647,
-                        0.192120324, 0.381669074, 0.479023703, 0.381669074, 0.192120324, 0.060179647, 0.011414066,
-                        0.001254982, 7.48E-05, 2.17E-06, 2.57E-08, 8.82E-11, 3.72E-14])
+        # 后验均值
+        return float(np.dot(self.post_values, self.x_nodes))
+
+    @property
+    def sd(self):
+        # 后验标准差
+        return float(np.sqrt(np.dot(self.post_values, (self.x_nodes - self.res) ** 2)))
+
+    def get_info(self, theta):
+        # 特质值处的测验信息
+        return float(np.interp(theta, self.x_nodes, self.info_values))
+
+    def to_json(self):
+        """
+        :return: 可以直接存入session的字典，对数后验减去最大值后和测验信息都存成float32的base64字符串
+        """
+        log_post = np.maximum(self.log_post - np.max(self.log_post), -745.0)
+        return {'n': self.n_nodes, 'q': self.quadrature,
+                'lp': _encode_array(log_post), 'info': _encode_array(self.info_values)}
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        :param data: to_json的返回值，为None时返回先验状态
+        """
+        if data is None:
+            return cls()
+        return cls(log_post=_decode_array(data['lp']), info=_decode_array(data['info']),
+                   n_nodes=data['n'], quadrature=data['q'])
+
+
+class BrmPosteriorState(PosteriorState):
+
+    def update(self, a, b, score):
+        z = a * (self.x_nodes - b)
+        sign = -1.0 if score == 1 else 1.0
+        self.log_post -= np.logaddexp(0, sign * z)
+        p = 1.0 / (1.0 + np.exp(-z))
+        self.info_values += a ** 2 * p * (1 - p)
+
+
+class GrmPosteriorState(PosteriorState):
+
+    def update(self, a, b, score):
+        # shape为（节点数，等级数）
+        model = GrmModel(a, np.asarray(b, dtype=float)[np.newaxis, :], self.x_nodes[:, np.newaxis])
+        p = model.category_prob_values
+        dp = model.d_boundary_values
+        self.log_post += np.log(np.maximum(p[:, score - 1], np.finfo(float).tiny))
+        self.info_values += np.sum((dp[:, :-1] - dp[:, 1:]) ** 2 / np.maximum(p, np.finfo(float).tiny), axis=1)
+
+
+# 兼容旧名称
+EAP = BrmEAP
 
 if __name__ == '__main__':
     import time
@@ -63,4 +227,15 @@ if __name__ == '__main__':
         error[i] = np.abs(theta - eap.res)
     print np.mean(error)
     e = time.clock()
-    print e - s
\ No newline at end of file
+    print e - s
+
+    # 批量估计，同样10000个被试，每个被试10道题
+    s = time.clock()
+    theta = np.random.normal(size=(10000, 1))
+    a0 = np.random.uniform(1, 3, (10000, 10))
+    b0 = np.random.normal(size=(10000, 10))
+    score0 = np.random.binomial(1, LogisticModel(a0, b0, theta).prob_values)
+    eap = BrmEAP(score0, a0, b0)
+    print np.mean(np.abs(theta[:, 0] - eap.res))
+    e = time.clock()
+    print e - s
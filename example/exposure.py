@@ -0,0 +1,188 @@
+# coding=utf-8
+from abc import ABCMeta, abstractmethod
+import numpy as np
+from tornado import gen
+from tornado.ioloop import PeriodicCallback
+from tornado.locks import Lock
+from tornado.log import app_log
+from statements import statements
+from settings import EXPOSURE_CONTROL, EXPOSURE_RANDOMESQUE_K, EXPOSURE_MAX_RATE
+
+COUNT_UPDATE = statements.register(
+    'question_count_update',
+    "UPDATE question SET count = question.count + v.n "
+    "FROM unnest(%s::integer[], %s::integer[]) AS v(id, n) WHERE question.id = v.id")
+
+
+class ExposureCounter(object):
+    """
+    试题曝光次数计数器，在内存里累计每道题的曝光次数，
+    定期合并成一条UPDATE写回question.count，避免每次展示试题都更新一行
+    """
+
+    def __init__(self):
+        # 还没写回数据库的曝光次数，试题id: 次数
+        self._pending = {}
+        # 正在写回数据库的曝光次数
+        self._flushing = {}
+        self._callback = None
+        # 写回和题库缓存的重新载入互斥：载入时拿着锁查询count，这时没有正在写回的次数，
+        # 查出的count加上get_pending_items就是最新的曝光次数，不会重复计算
+        self.lock = Lock()
+
+    def incr(self, que_id, n=1):
+        self._pending[que_id] = self._pending.get(que_id, 0) + n
+
+    def get_pending(self, que_id):
+        """
+        :return: 该题还没写回数据库的曝光次数，数据库里的count加上它就是最新的曝光次数
+        """
+        return self._pending.get(que_id, 0) + self._flushing.get(que_id, 0)
+
+    def get_pending_items(self):
+        """
+        :return: 所有还没写回数据库的(试题id, 次数)列表
+        """
+        pending = dict(self._flushing)
+        for que_id, n in self._pending.items():
+            pending[que_id] = pending.get(que_id, 0) + n
+        return list(pending.items())
+
+    @gen.coroutine
+    def flush(self, db):
+        """
+        把累计的曝光次数一次写回数据库，失败时留到下次再写
+        """
+        with (yield self.lock.acquire()):
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, {}
+            que_id_list, n_list = zip(*self._flushing.items())
+            try:
+                yield statements.execute(db, COUNT_UPDATE, (list(que_id_list), list(n_list)))
+            except Exception:
+                app_log.exception(u'曝光次数写回失败')
+                for que_id, n in self._flushing.items():
+                    self.incr(que_id, n)
+            finally:
+                self._flushing = {}
+
+    def start(self, db, flush_interval):
+        """
+        :param db: 数据库
+        :param flush_interval: 写回间隔，单位为秒
+        """
+        self._callback = PeriodicCallback(lambda: self.flush(db), flush_interval * 1000)
+        self._callback.start()
+
+    def stop(self):
+        if self._callback is not None:
+            self._callback.stop()
+            self._callback = None
+
+    @gen.coroutine
+    def close(self, db):
+        """
+        进程退出前调用，停止定期写回，再把还没写回的曝光次数写回数据库
+        """
+        self.stop()
+        yield self.flush(db)
+
+
+exposure_counter = ExposureCounter()
+
+
+class BaseExposureControl(object):
+    """
+    曝光控制策略，从影子题库里选出一道题，
+    需要的参数都离线算好（exposure_params.py）存在question表里，抽题时只对影子题库的数组做O(k)的运算
+    """
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def select(self, info, count, exposure_param, exposure_rate, progress):
+        """
+        :param info: 影子题库各题在theta处的信息函数值，shape为（k，）的numpy数组，下同
+        :param count: 各题的曝光次数
+        :param exposure_param: 各题的Sympson-Hetter曝光参数
+        :param exposure_rate: 各题的曝光率
+        :param progress: 测验进度，已作答题量/总题量
+        :return: 选中的题在影子题库中的下标
+        """
+        pass
+
+
+class RatioExposureControl(BaseExposureControl):
+    """
+    曝光次数占比与信息函数之比最小的题
+    """
+
+    def select(self, info, count, exposure_param, exposure_rate, progress):
+        return int(((count / (np.sum(count) + 1.0)) / info).argmin())
+
+
+class RandomesqueExposureControl(BaseExposureControl):
+    """
+    randomesque：信息函数最大的k道题中随机抽一道
+    """
+
+    def __init__(self, k=EXPOSURE_RANDOMESQUE_K):
+        self.k = k
+
+    def select(self, info, count, exposure_param, exposure_rate, progress):
+        if info.size <= self.k:
+            top = np.arange(info.size)
+        else:
+            top = np.argpartition(-info, self.k - 1)[:self.k]
+        return int(top[np.random.randint(top.size)])
+
+
+class SympsonHetterExposureControl(BaseExposureControl):
+    """
+    Sympson-Hetter：按信息函数从大到小，每道题以其曝光参数为概率决定是否施测，
+    第一道通过的题就是选中的题，都没通过时选信息函数最大的题
+    """
+
+    def select(self, info, count, exposure_param, exposure_rate, progress):
+        order = np.argsort(-info, kind='mergesort')
+        passed = np.random.random_sample(info.size) < exposure_param[order]
+        return int(order[passed.argmax()] if passed.any() else order[0])
+
+
+class ProgressiveRestrictedExposureControl(BaseExposureControl):
+    """
+    progressive restricted：曝光率达到max_rate的题不抽（全部达到时不限制），
+    其余的题按随机数和信息函数的加权和抽最大的，测验越往后信息函数的权重越大
+    """
+
+    def __init__(self, max_rate=EXPOSURE_MAX_RATE):
+        self.max_rate = max_rate
+
+    def select(self, info, count, exposure_param, exposure_rate, progress):
+        weight = (1 - progress) * np.random.random_sample(info.size) * info.max() + progress * info
+        restricted = exposure_rate >= self.max_rate
+        if not restricted.all():
+            weight[restricted] = -np.inf
+        return int(weight.argmax())
+
+
+EXPOSURE_CONTROLS = {
+    'ratio': RatioExposureControl,
+    'randomesque': RandomesqueExposureControl,
+    'sympson_hetter': SympsonHetterExposureControl,
+    'progressive_restricted': ProgressiveRestrictedExposureControl,
+}
+
+
+def get_exposure_control(name=EXPOSURE_CONTROL):
+    """
+    :param name: EXPOSURE_CONTROLS的键
+    :return: 曝光控制策略对象
+    """
+    try:
+        return EXPOSURE_CONTROLS[name]()
+    except KeyError:
+        raise ValueError(u'不支持的曝光控制策略%s' % name)
+
+
+exposure_control = get_exposure_control()
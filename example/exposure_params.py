@@ -0,0 +1,85 @@
+# coding=utf-8
+"""
+按作答记录离线计算曝光控制的参数，写回question.exposure_param和question.exposure_rate，
+并增加questionnaire.exposure_version，题库缓存据此只刷新曝光参数，不使题库缓存和信息函数排序表失效
+
+    python exposure_params.py 问卷id [最大曝光率]
+
+曝光率为施测过该题的测验数/测验总数。Sympson-Hetter参数用迭代法：
+被选中的概率P(S)=曝光率/当前的曝光参数，P(S)超过最大曝光率的题曝光参数改为最大曝光率/P(S)，其余为1，
+每次运行迭代一步，上线一段时间积累作答记录后再运行，直到各题曝光率都不超过最大曝光率
+"""
+import sys
+import numpy as np
+import psycopg2
+from settings import DSN, EXPOSURE_MAX_RATE
+
+
+def get_exposure_params(admin_count, test_count, exposure_param, max_rate=EXPOSURE_MAX_RATE):
+    """
+    Sympson-Hetter迭代一步
+    :param admin_count: 各题施测过的测验数，shape为（题量，）的numpy数组
+    :param test_count: 测验总数
+    :param exposure_param: 各题当前的曝光参数
+    :param max_rate: 最大曝光率
+    :return: (新的曝光参数, 曝光率)
+
+    >>> param, rate = get_exposure_params(np.array([50., 10., 0.]), 100, np.array([1., 1., 1.]), 0.25)
+    >>> param.tolist(), rate.tolist()
+    ([0.5, 1.0, 1.0], [0.5, 0.1, 0.0])
+    """
+    rate = admin_count / max(test_count, 1)
+    select_rate = rate / np.maximum(exposure_param, 1e-6)
+    param = np.where(select_rate > max_rate, max_rate / np.maximum(select_rate, 1e-6), 1.0)
+    return param, rate
+
+
+def update_exposure_params(cursor, q_id, max_rate=EXPOSURE_MAX_RATE):
+    """
+    :param cursor: 事务中的游标
+    :param q_id: 问卷id
+    :return: (测验总数, 题目id数组, 新的曝光参数, 曝光率)
+    """
+    cursor.execute("""
+        SELECT count(*) FROM (SELECT DISTINCT response.answer_id, response.try_count FROM response
+        JOIN answer ON response.answer_id = answer.id WHERE answer.questionnaire_id = %s) AS tests;
+        """, (q_id,))
+    test_count = cursor.fetchone()[0]
+    cursor.execute("""
+        SELECT question.id, question.exposure_param, count(DISTINCT (tests.answer_id, tests.try_count))
+        FROM question LEFT JOIN (SELECT response.answer_id, response.try_count, response.question_id FROM response
+        JOIN answer ON response.answer_id = answer.id WHERE answer.questionnaire_id = %s) AS tests
+        ON tests.question_id = question.id
+        WHERE question.questionnaire_id = %s GROUP BY question.id;
+        """, (q_id, q_id))
+    values = np.array(cursor.fetchall(), dtype=float).reshape(-1, 3)
+    que_ids = values[:, 0].astype(int)
+    param, rate = get_exposure_params(values[:, 2], test_count, values[:, 1], max_rate)
+    cursor.execute("""
+        UPDATE question SET exposure_param = v.exposure_param, exposure_rate = v.exposure_rate
+        FROM unnest(%s::integer[], %s::double precision[], %s::double precision[])
+        AS v(id, exposure_param, exposure_rate)
+        WHERE question.id = v.id;
+        UPDATE questionnaire SET exposure_version = exposure_version + 1 WHERE id = %s;
+        """, (que_ids.tolist(), param.tolist(), rate.tolist(), q_id))
+    return test_count, que_ids, param, rate
+
+
+def main(argv):
+    q_id = int(argv[0])
+    max_rate = float(argv[1]) if len(argv) > 1 else EXPOSURE_MAX_RATE
+    conn = psycopg2.connect(DSN)
+    try:
+        with conn:
+            with conn.cursor() as cursor:
+                test_count, que_ids, param, rate = update_exposure_params(cursor, q_id, max_rate)
+        print 'tests: %d, questions: %d' % (test_count, que_ids.size)
+        print 'max exposure rate: %.4f, over %.2f: %d' % (rate.max() if rate.size else 0, max_rate,
+                                                          np.sum(rate > max_rate))
+        print 'restricted (exposure_param < 1): %d' % np.sum(param < 1)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
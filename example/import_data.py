@@ -1,34 +1,365 @@
 # coding=utf-8
-import psycopg2
+"""
+流式导入问卷和题库，逐块校验、规范化后用COPY写入，整个导入在一个事务里，有一行不合格就全部回滚
+
+    python import_data.py                            导入data目录下的示例数据
+    python import_data.py 题库.csv 列名,列名,...       导入题库文件，a_level列为空或没有a_level列时自动分层（见strata.py）
+"""
+from cStringIO import StringIO
+import csv
+import io
+import math
 import os.path
+import sys
+import psycopg2
 from settings import DSN
+from strata import restratify
 
 BASE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data')
 
+# 每块的行数，校验和COPY都按块进行，内存占用与文件大小无关
+CHUNK_SIZE = 10000
+
+# 错误行数超过这个数就不再继续校验
+MAX_ERRORS = 100
+
+QUESTIONNAIRE_COLUMNS = ('id', 'name', 'type', 'flow', 'level_one_count')
+
+QUESTION_COLUMNS = ('id', 'question', 'slop', 'threshold', 'thresholds', 'intercept', 'choice_text',
+                    'choice_value', 'a_level', 'questionnaire_id')
+
+# 选项、得分、阈值的分隔符
+SEP = '|'
+
+
+class RowError(ValueError):
+    """
+    某一行不合格
+    """
+
+    def __init__(self, line_num, message):
+        super(RowError, self).__init__(line_num, message)
+        self.line_num = line_num
+        self.message = message
+
+    def __unicode__(self):
+        return u'第%d行: %s' % (self.line_num, self.message)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+class ImportFailed(Exception):
+    """
+    导入失败，errors为全部RowError
+    """
+
+    def __init__(self, errors):
+        super(ImportFailed, self).__init__(errors)
+        self.errors = errors
+
+    def __unicode__(self):
+        return u'\n'.join(unicode(e) for e in self.errors)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+def _parse_int(value, name, required=True):
+    if value == '':
+        if required:
+            raise ValueError(u'%s不能为空' % name)
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(u'%s必须是整数: %s' % (name, value))
+
+
+def _parse_float(value, name, required=True):
+    if value == '':
+        if required:
+            raise ValueError(u'%s不能为空' % name)
+        return None
+    try:
+        value = float(value)
+    except ValueError:
+        raise ValueError(u'%s必须是数字: %s' % (name, value))
+    if math.isinf(value) or math.isnan(value):
+        raise ValueError(u'%s必须是有限的数字: %s' % (name, value))
+    return value
+
+
+def _parse_list(value, name, parse):
+    if value == '':
+        return []
+    return [parse(item.strip(), name) for item in value.split(SEP)]
+
+
+def normalize_question(row, q_type, warnings=None):
+    """
+    校验并规范化一道题
+    :param row: 列名到unicode字符串的字典，缺少的列为空字符串
+    :param q_type: 所属问卷的计分类型，'brm'或'grm'
+    :param warnings: 可选，规范化时改动了参数的说明追加到这里
+    :return: 规范化后的字典，a_level为空时为None，等待自动分层
+    :raise ValueError: 不合格
+    """
+    question = row['question'].strip()
+    if not question:
+        raise ValueError(u'question不能为空')
+    slop = _parse_float(row['slop'], 'slop')
+    if slop <= 0:
+        raise ValueError(u'slop必须大于0: %s' % slop)
+    threshold = _parse_float(row['threshold'], 'threshold', required=False)
+    thresholds = _parse_list(row['thresholds'], 'thresholds', _parse_float)
+    choice_text = [item.strip() for item in row['choice_text'].split(SEP)]
+    if not all(choice_text):
+        raise ValueError(u'choice_text不能有空选项: %s' % row['choice_text'])
+    choice_value = _parse_list(row['choice_value'], 'choice_value', _parse_int)
+    if len(choice_value) != len(choice_text):
+        raise ValueError(u'choice_value有%d项，choice_text有%d项' % (len(choice_value), len(choice_text)))
+    if q_type == 'brm':
+        if thresholds:
+            raise ValueError(u'二级计分的题不能有thresholds')
+        if threshold is None:
+            raise ValueError(u'threshold不能为空')
+        if not set(choice_value) <= {0, 1}:
+            raise ValueError(u'二级计分的choice_value只能是0或1: %s' % row['choice_value'])
+    else:
+        if not thresholds:
+            raise ValueError(u'多级计分的题thresholds不能为空')
+        if any(b0 == b1 for b0, b1 in zip(sorted(thresholds), sorted(thresholds)[1:])):
+            raise ValueError(u'thresholds不能有相同的值: %s' % row['thresholds'])
+        if thresholds != sorted(thresholds):
+            # 等级反应模型的边界必须递增，估计误差造成的乱序按从小到大排好
+            thresholds = sorted(thresholds)
+            if warnings is not None:
+                warnings.append(u'thresholds不是递增的，已排序: %s' % row['thresholds'])
+        # 得分是等级，从1到边界数+1
+        if not all(1 <= value <= len(thresholds) + 1 for value in choice_value):
+            raise ValueError(u'choice_value必须在1到%d之间: %s' % (len(thresholds) + 1, row['choice_value']))
+        if threshold is None:
+            threshold = sum(thresholds) / len(thresholds)
+    a_level = _parse_int(row['a_level'], 'a_level', required=False)
+    if a_level is not None and a_level < 1:
+        raise ValueError(u'a_level必须大于等于1: %s' % a_level)
+    return {
+        'id': _parse_int(row['id'], 'id', required=False),
+        'question': question,
+        'slop': slop,
+        'threshold': threshold,
+        'thresholds': SEP.join(repr(b) for b in thresholds) or None,
+        'intercept': _parse_float(row['intercept'], 'intercept', required=False),
+        'choice_text': SEP.join(choice_text),
+        'choice_value': SEP.join(str(value) for value in choice_value),
+        'a_level': a_level,
+        'questionnaire_id': _parse_int(row['questionnaire_id'], 'questionnaire_id'),
+    }
+
+
+def normalize_questionnaire(row, warnings=None):
+    name = row['name'].strip()
+    if not name:
+        raise ValueError(u'name不能为空')
+    q_type = row['type'].strip()
+    if q_type not in ('brm', 'grm'):
+        raise ValueError(u'type只能是brm或grm: %s' % q_type)
+    flow = _parse_list(row['flow'], 'flow', _parse_int)
+    if len(flow) < 2 or min(flow) < 1:
+        raise ValueError(u'flow必须是两个以上用%s分隔的正整数: %s' % (SEP, row['flow']))
+    return {
+        'id': _parse_int(row['id'], 'id', required=False),
+        'name': name,
+        'type': q_type,
+        'flow': SEP.join(str(n) for n in flow),
+        'level_one_count': _parse_int(row['level_one_count'], 'level_one_count', required=False),
+    }
+
+
+def read_csv_chunks(path, chunk_size=CHUNK_SIZE):
+    """
+    逐块读出csv文件
+    :param path: 文件路径
+    :return: 生成器，每次生成[(行号, unicode字符串列表)]
+    """
+    with io.open(path, 'rb') as f:
+        chunk = []
+        for line_num, values in enumerate(csv.reader(f), 1):
+            if not values:
+                continue
+            chunk.append((line_num, [value.decode('utf-8').strip() for value in values]))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def _to_copy_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        # repr保留全部有效数字
+        return repr(value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def copy_rows(cursor, table, columns, rows):
+    """
+    用COPY写入一块规范化后的行
+    :param rows: 字典列表
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow([_to_copy_value(row[column]) for column in columns])
+    buf.seek(0)
+    cursor.copy_expert('COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (table, ', '.join(columns)), buf)
+
+
+def normalize_chunk(chunk, columns, all_columns, normalize, errors, warnings=None):
+    """
+    校验并规范化一块
+    :param chunk: read_csv_chunks生成的一块
+    :param columns: 文件各列的列名
+    :param all_columns: 表的全部列名，文件里没有的列当作空字符串
+    :param normalize: 规范化一行的函数，参数为(行, 说明列表)
+    :param errors: 不合格的行追加到这里，超过MAX_ERRORS时抛出ImportFailed
+    :param warnings: 可选，规范化时改动了值的行追加到这里
+    :return: 合格的行
+    """
+    rows = []
+    for line_num, values in chunk:
+        try:
+            if len(values) != len(columns):
+                raise ValueError(u'应该有%d列，实际有%d列' % (len(columns), len(values)))
+            row = dict((column, u'') for column in all_columns)
+            row.update(zip(columns, values))
+            messages = []
+            rows.append(normalize(row, messages))
+            if warnings is not None:
+                warnings.extend(RowError(line_num, message) for message in messages)
+        except ValueError as e:
+            errors.append(RowError(line_num, e.args[0]))
+            if len(errors) >= MAX_ERRORS:
+                raise ImportFailed(errors)
+    return rows
+
+
+def import_questionnaires(cursor, path, columns=QUESTIONNAIRE_COLUMNS):
+    """
+    导入问卷
+    :param cursor: 事务中的游标
+    :param path: csv文件路径
+    :param columns: 文件各列的列名
+    :return: 导入的行数
+    """
+    errors = []
+    count = 0
+    copy_columns = [column for column in QUESTIONNAIRE_COLUMNS if column != 'id' or 'id' in columns]
+    for chunk in read_csv_chunks(path):
+        rows = normalize_chunk(chunk, columns, QUESTIONNAIRE_COLUMNS, normalize_questionnaire, errors)
+        if not errors:
+            copy_rows(cursor, 'questionnaire', copy_columns, rows)
+        count += len(rows)
+    if errors:
+        raise ImportFailed(errors)
+    _reset_sequence(cursor, 'questionnaire')
+    return count
 
-def import_csv(dsn, table_name, file_name, columns=None):
+
+def import_questions(cursor, path, columns=QUESTION_COLUMNS, chunk_size=CHUNK_SIZE, warnings=None):
     """
-    往postgresql导入csv数据
-    :param dsn:
-    :param table_name: 表名, str
-    :param file_name: 文件名, str
-    :param columns:
+    流式导入题库，a_level为空的题所属问卷导入后重新分层（按难度分块的a分层），最后更新各问卷的level_one_count
+    :param cursor: 事务中的游标，问卷要已经存在（可以是同一事务里刚导入的）
+    :param path: csv文件路径
+    :param columns: 文件各列的列名
+    :param chunk_size: 每块的行数
+    :param warnings: 可选，规范化时改动了参数的行（RowError）追加到这里
+    :return: 导入的行数
     """
-    conn = psycopg2.connect(dsn)
-    cursor = conn.cursor()
-    path = os.path.join(BASE_DIR, file_name)
-    _file = file(path)
-    cursor.copy_from(_file, table_name, sep=",", columns=columns)
-    conn.commit()
-    _file.close()
+    cursor.execute('SELECT id, type FROM questionnaire;')
+    q_types = dict(cursor.fetchall())
+    errors = []
+    count = 0
+    copy_columns = [column for column in QUESTION_COLUMNS if column != 'id' or 'id' in columns]
+    q_ids = set()
+    stratify_q_ids = set()
+
+    def normalize(row, messages):
+        q_id = _parse_int(row['questionnaire_id'], 'questionnaire_id')
+        if q_id not in q_types:
+            raise ValueError(u'问卷%s不存在' % q_id)
+        return normalize_question(row, q_types[q_id], messages)
+
+    for chunk in read_csv_chunks(path, chunk_size):
+        rows = normalize_chunk(chunk, columns, QUESTION_COLUMNS, normalize, errors, warnings)
+        for row in rows:
+            q_ids.add(row['questionnaire_id'])
+            if row['a_level'] is None:
+                # 先占位，导入完再分层
+                row['a_level'] = 0
+                stratify_q_ids.add(row['questionnaire_id'])
+        # 已经有错就只校验不写入，把错误一次报全
+        if not errors:
+            copy_rows(cursor, 'question', copy_columns, rows)
+        count += len(rows)
+    if errors:
+        raise ImportFailed(errors)
+    if 'id' in columns:
+        _reset_sequence(cursor, 'question')
+    for q_id in sorted(stratify_q_ids):
+        restratify(cursor, q_id)
+    update_level_one_count(cursor, sorted(q_ids))
+    return count
+
+
+def update_level_one_count(cursor, q_ids):
+    # 第一层的题量
+    cursor.execute("""
+        UPDATE questionnaire SET level_one_count = (
+            SELECT count(*) FROM question WHERE question.questionnaire_id = questionnaire.id AND a_level = 1)
+        WHERE id = ANY(%s);
+        """, (q_ids,))
+
+
+def _reset_sequence(cursor, table):
+    # 导入了显式的id，把自增序列推到最大id之后
+    cursor.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), (SELECT max(id) FROM " + table + "));",
+                   (table,))
+
+
+def main(argv):
+    conn = psycopg2.connect(DSN)
+    warnings = []
+    try:
+        with conn:
+            with conn.cursor() as cursor:
+                if argv:
+                    columns = argv[1].split(',') if len(argv) > 1 else QUESTION_COLUMNS
+                    print 'question: %d' % import_questions(cursor, argv[0], columns, warnings=warnings)
+                else:
+                    print 'questionnaire: %d' % import_questionnaires(
+                        cursor, os.path.join(BASE_DIR, 'q.csv'), ('id', 'name', 'type', 'flow', 'level_one_count'))
+                    print 'question: %d' % import_questions(
+                        cursor, os.path.join(BASE_DIR, 'brm-que.csv'),
+                        ('id', 'question', 'slop', 'threshold', 'choice_text', 'choice_value', 'a_level',
+                         'questionnaire_id'), warnings=warnings)
+                    print 'question: %d' % import_questions(
+                        cursor, os.path.join(BASE_DIR, 'grm-que.csv'),
+                        ('id', 'question', 'slop', 'threshold', 'thresholds', 'choice_value', 'choice_text',
+                         'a_level', 'questionnaire_id'), warnings=warnings)
+        for warning in warnings:
+            print warning
+    except ImportFailed as e:
+        print e
+        sys.exit(1)
+    finally:
+        conn.close()
 
 
 if __name__ == '__main__':
-    import_csv(DSN, 'questionnaire',
-               'q.csv', ('id', 'name', 'type', 'flow', 'level_one_count'))
-    import_csv(DSN, 'question',
-               'brm-que.csv', ('id', 'question', 'slop', 'threshold', 'choice_text', 'choice_value', 'a_level',
-                               'questionnaire_id'))
-    import_csv(DSN, 'question',
-               'grm-que.csv', ('id', 'question', 'slop', 'threshold', 'thresholds',
-                               'choice_value', 'choice_text', 'a_level', 'questionnaire_id'))
+    main(sys.argv[1:])
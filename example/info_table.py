@@ -0,0 +1,129 @@
+# coding=utf-8
+"""
+重建信息函数排序表question_info_rank：每个问卷每层在THETA_GRID每个格点上信息函数最大的INFO_TABLE_DEPTH道题，
+不用题库缓存时影子题库直接查这张表，试题参数（包括分层）有改动后要重建，曝光参数不影响排序表
+
+    python info_table.py [问卷id ...]             重建排序表，不给问卷id时重建全部问卷
+    python info_table.py --bench 问卷id [重复次数]  比较查排序表、按难度取候选题的查询和内存查表的耗时
+"""
+import sys
+import time
+import numpy as np
+import psycopg2
+from psycopg2.extras import NamedTupleCursor
+from settings import DSN, INFO_TABLE_DEPTH
+from utils import Que, get_threshold_matrix
+from itembank import ItemBank, THETA_GRID, BANK_SELECT, get_grid_index, get_info_table, get_rank_table
+from bank import SHADOW_SELECT, INFO_RANK_SELECT, BrmShadowBank
+
+
+def build_info_table(cursor, q_id, depth=INFO_TABLE_DEPTH):
+    """
+    重建一个问卷的排序表，并把info_table_version设为当前的bank_version
+    :param cursor: 事务中的游标
+    :param q_id: 问卷id
+    :return: 写入的行数（层数*格点数）
+    """
+    cursor.execute('SELECT type, bank_version FROM questionnaire WHERE id=%s FOR UPDATE;', (q_id,))
+    row = cursor.fetchone()
+    if row is None:
+        raise ValueError(u'问卷%s不存在' % q_id)
+    q_type, bank_version = row
+    cursor.execute('SELECT a_level, id, slop, threshold, thresholds FROM question WHERE questionnaire_id=%s '
+                   'ORDER BY a_level, id;', (q_id,))
+    level_rows = {}
+    for a_level, que_id, slop, threshold, thresholds in cursor.fetchall():
+        if thresholds:
+            threshold = [float(_) for _ in thresholds.split('|')]
+        level_rows.setdefault(a_level, []).append((que_id, slop, threshold))
+    a_levels = []
+    theta_bins = []
+    question_ids = []
+    for a_level, rows in sorted(level_rows.items()):
+        # 第一层按难度随机抽题，不用排序表
+        if a_level == 1:
+            continue
+        que_ids = np.array([_[0] for _ in rows], dtype=int)
+        if q_type == 'brm':
+            threshold = np.array([_[2] for _ in rows], dtype=float)
+        else:
+            threshold = get_threshold_matrix([_[2] for _ in rows])
+        info_table = get_info_table(q_type, np.array([_[1] for _ in rows], dtype=float), threshold)
+        for theta_bin, positions in enumerate(get_rank_table(info_table, depth)):
+            a_levels.append(a_level)
+            theta_bins.append(theta_bin)
+            question_ids.append('{%s}' % ','.join(str(_) for _ in que_ids[positions].tolist()))
+    cursor.execute("""
+        DELETE FROM question_info_rank WHERE questionnaire_id = %s;
+        INSERT INTO question_info_rank (questionnaire_id, a_level, theta_bin, question_ids)
+        SELECT %s, v.a_level, v.theta_bin, v.question_ids::integer[]
+        FROM unnest(%s::integer[], %s::integer[], %s::text[]) AS v(a_level, theta_bin, question_ids);
+        UPDATE questionnaire SET info_table_version = %s WHERE id = %s;
+        """, (q_id, q_id, a_levels, theta_bins, question_ids, bank_version, q_id))
+    return len(a_levels)
+
+
+def _median_ms(func, repeat):
+    timings = []
+    for i in range(repeat):
+        s = time.time()
+        func()
+        timings.append((time.time() - s) * 1000)
+    return float(np.median(timings))
+
+
+def bench(conn, q_id, repeat=200):
+    """
+    在各层的多个theta上比较两种候选题查询和内存查表的耗时
+    :return: [(名称, 耗时中位数毫秒)]
+    """
+    with conn.cursor(cursor_factory=NamedTupleCursor) as cursor:
+        cursor.execute('SELECT id, type, bank_version, exposure_version FROM questionnaire WHERE id=%s;', (q_id,))
+        q = cursor.fetchone()
+        cursor.execute(*BANK_SELECT.get_query((q_id,), prepared=False))
+        bank = ItemBank(q, [Que(*(tuple(row) + (None,))) for row in cursor.fetchall()])
+        thetas = np.linspace(THETA_GRID[0], THETA_GRID[-1], 9)
+        cases = [(a_level, theta) for a_level in sorted(bank.levels) if a_level != 1 for theta in thetas]
+
+        def run(statement, get_params):
+            for a_level, theta in cases:
+                cursor.execute(*statement.get_query(get_params(a_level, theta), prepared=False))
+                cursor.fetchall()
+
+        def run_memory():
+            for a_level, theta in cases:
+                bank.get_level(a_level).get_que(theta, [])
+
+        result = [
+            ('shadow select', _median_ms(lambda: run(SHADOW_SELECT, lambda a_level, theta: BrmShadowBank(
+                q_id, a_level, theta, [], None).get_candidate_params()), repeat) / len(cases)),
+            ('info rank select', _median_ms(lambda: run(INFO_RANK_SELECT, lambda a_level, theta: (
+                q_id, a_level, get_grid_index(theta), [])), repeat) / len(cases)),
+            ('in-memory lookup', _median_ms(run_memory, repeat) / len(cases)),
+        ]
+    conn.rollback()
+    return result
+
+
+def main(argv):
+    conn = psycopg2.connect(DSN)
+    try:
+        if argv and argv[0] == '--bench':
+            for name, ms in bench(conn, int(argv[1]), *[int(arg) for arg in argv[2:]]):
+                print '%-20s %10.4f ms' % (name, ms)
+            return
+        with conn:
+            with conn.cursor() as cursor:
+                if argv:
+                    q_ids = [int(arg) for arg in argv]
+                else:
+                    cursor.execute('SELECT id FROM questionnaire ORDER BY id;')
+                    q_ids = [row[0] for row in cursor.fetchall()]
+                for q_id in q_ids:
+                    print 'questionnaire %d: %d rows' % (q_id, build_info_table(cursor, q_id))
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -48,6 +48,42 @@ class LogisticModel(object):
         dp = self.d_prob_values
         return self.slop * dp
 
+
+class GrmModel(LogisticModel):
+    """
+    等级反应模型，相邻两个边界的logistic值相减即为各等级的概率
+    threshold的最后一维是各边界的阈值，题目等级数不同时用np.inf填充，
+    slop和theta需要能和threshold广播，例如slop的shape为（题量，1）
+    """
+
+    @cached_property
+    def boundary_values(self):
+        """
+        在边界logistic值的两端分别补上1和0
+        :return: 最后一维长度为等级数加1的numpy数组
+        """
+        p = self.prob_values
+        shape = p.shape[:-1] + (1,)
+        return np.concatenate((np.ones(shape), p, np.zeros(shape)), axis=-1)
+
+    @cached_property
+    def category_prob_values(self):
+        """
+        :return: 各等级的概率，最后一维长度为等级数
+        """
+        boundary = self.boundary_values
+        return boundary[..., :-1] - boundary[..., 1:]
+
+    @cached_property
+    def d_boundary_values(self):
+        """
+        在边界logistic一阶导数的两端补上0
+        :return: 最后一维长度为等级数加1的numpy数组
+        """
+        dp = self.d_prob_values
+        shape = dp.shape[:-1] + (1,)
+        return np.concatenate((np.zeros(shape), dp, np.zeros(shape)), axis=-1)
+
 # =========================下面是对数似然函数============================
 
 
@@ -97,6 +133,13 @@ class LogLik:
         """
         return None
 
+    def get_dloglik_and_ddloglik_values(self):
+        """
+        对数似然函数的一阶导数和二阶导数，子类可以覆盖此方法一次算出两者
+        :return: (一阶导数, 二阶导数)
+        """
+        return self.get_dloglik_value(), self.get_ddloglik_value()
+
 
 class BrmLogLik(LogLik):
 
@@ -119,45 +162,123 @@ class BrmLogLik(LogLik):
 
 class GrmLogLik(LogLik):
 
+    def __init__(self, score, a, b, theta, model=GrmModel):
+        # 斜率变成（题量，1），才能和各边界的阈值广播
+        super(GrmLogLik, self).__init__(score=score, a=np.reshape(a, (-1, 1)), b=b, theta=theta, model=model)
+
+    def get_item_dloglik_values(self, index):
+        """
+        各题对数似然的一阶导数和二阶导数，不必按等级循环
+        :param index: 各题所得等级的下标，即得分减1，shape同score
+        :return: (一阶导数, 二阶导数)，shape同score
+        """
+        boundary = self.model.boundary_values
+        d_boundary = self.model.d_boundary_values
+        # 边界logistic的二阶导数a^2*p*(1-p)*(1-2p)，两端补的1和0处为0
+        dd_boundary = self.slop * d_boundary * (1.0 - 2 * boundary)
+        # 所得等级的概率是第k个边界减第k+1个边界
+        index = index[..., np.newaxis]
+        pair = np.concatenate((index, index + 1), axis=-1)
+
+        def gather(values):
+            values = np.take_along_axis(values, pair, axis=-1)
+            return values[..., 0] - values[..., 1]
+
+        p = gather(boundary)
+        dp_p = gather(d_boundary) / p
+        ddp_p = gather(dd_boundary) / p
+        return dp_p, ddp_p - dp_p ** 2
+
+    @cached_property
+    def dloglik_values(self):
+        """
+        一次算出对数似然函数的一阶导数和二阶导数
+        :return: (一阶导数, 二阶导数)
+        """
+        # 得分从1开始
+        d1, d2 = self.get_item_dloglik_values(np.asarray(self.score, dtype=int) - 1)
+        return np.sum(d1) - self.theta, np.sum(d2) - 1
+
     def get_dloglik_value(self):
-        # 难度值的数量加1，也是试题的得分范围
-        rep_len = self.threshold.shape[1] + 1
+        return self.dloglik_values[0]
 
-        dloglik = 0
+    def get_ddloglik_value(self):
+        return self.dloglik_values[1]
 
-        for i in range(rep_len):
-            _score = self.score.copy()
+    def get_dloglik_and_ddloglik_values(self):
+        return self.dloglik_values
 
-            # 将等级计分转换为0,1计分
-            _score[_score != (i + 1)] = 0
-            _score[_score == (i + 1)] = 1
 
-            # 下面类似于P(k=1)-p(k=0)，其中k是这道题上的得分
-            p_pre, dp_pre = (1, 0) if i == 0 else (self.p[:, i-1], self.dp[:, i-1])
-            p, dp = (0, 0) if i == rep_len - 1 else (self.p[:, i], self.dp[:, i])
-            dloglik += np.dot(_score, (dp_pre - dp) / (p_pre - p))
+class BatchBrmLogLik(BrmLogLik):
+    """
+    多个被试一起计算的二级计分对数似然，每行一个被试，返回每个被试的导数
+    """
 
-        return dloglik - self.theta
+    # 阈值比得分多出的维数
+    threshold_extra_ndim = 0
+
+    def __init__(self, score, a, b, theta, mask=None, model=LogisticModel):
+        """
+        :param score: 得分，shape为（被试数，题量），题量不同的被试用nan填充
+        :param a: 斜率，能广播成score的shape，填充处可以是nan
+        :param b: 阈值，能广播成score的shape，填充处可以是nan
+        :param theta: 特质值，shape为（被试数，）
+        :param mask: 可选，shape同score的布尔数组，True表示该题作答有效
+
+        >>> score = np.array([[1, 0, 1], [0, 1, np.nan]])
+        >>> a = np.array([[1.0, 1.2, 0.8], [1.0, 1.2, np.nan]])
+        >>> b = np.array([[0.0, 0.5, -0.5], [0.0, 0.5, np.nan]])
+        >>> padded = BatchBrmLogLik(score, a, b, np.zeros(2)).get_dloglik_value()
+        >>> padded[1] == BrmLogLik(np.array([0, 1]), a[1, :2], b[1, :2], 0.0).get_dloglik_value()
+        True
+        """
+        score = np.asarray(score, dtype=float)
+        self.mask = ~np.isnan(score) if mask is None else np.asarray(mask, dtype=bool)
+        # 填充处换成不起作用的斜率0和阈值0，否则nan乘以0还是nan
+        a = np.where(self.mask, a, 0.0)
+        b = np.where(self.mask, b, 0.0)
+        super(BatchBrmLogLik, self).__init__(score=np.where(self.mask, score, 0), a=a, b=b,
+                                             theta=np.asarray(theta)[:, np.newaxis], model=model)
+
+    def get_dloglik_value(self):
+        return np.sum(self.mask * self.slop * (self.score - self.p), axis=-1) - self.theta[:, 0]
 
     def get_ddloglik_value(self):
-        # 难度值的数量加1，也是试题的得分范围
-        rep_len = self.threshold.shape[1] + 1
-        ddloglik = 0
-        for i in range(rep_len):
-            # 将等级计分转换为0,1计分
-            _score = self.score.copy()
-            _score[_score != (i + 1)] = 0
-            _score[_score == (i + 1)] = 1
+        return (-1) * np.sum(self.mask * self.ddp, axis=-1) - 1
+
+    def get_dddloglik_value(self):
+        # a^3*p*(1-p)*(1-2p)
+        return (-1) * np.sum(self.mask * self.slop * self.ddp * (1.0 - 2 * self.p), axis=-1)
+
+
+class BatchGrmLogLik(GrmLogLik):
+    """
+    多个被试一起计算的等级计分对数似然，每行一个被试，返回每个被试的导数
+    """
 
-            # 下面类似于P(k=1) - p(k=0),其中k是这道题上的得分
-            p, dp, ddp = (0, 0, 0) if i == rep_len - 1 else (self.p[:, i], self.dp[:, i], self.ddp[:, i])
-            p_pre, dp_pre, ddp_pre = (1, 0, 0) if i == 0 else (self.p[:, i-1], self.dp[:, i-1], self.ddp[:, i-1])
+    threshold_extra_ndim = 1
 
-            left = (ddp * (2 * p - 1.0) + ddp_pre * (1.0 - 2 * p_pre)) / (p_pre - p)
-            right = ((dp_pre - dp) ** 2) / ((p_pre - p) ** 2)
+    def __init__(self, score, a, b, theta, mask=None, model=GrmModel):
+        """
+        :param score: 得分，shape为（被试数，题量），题量不同的被试用nan填充
+        :param a: 斜率，能广播成score的shape，填充处可以是nan
+        :param b: 阈值，shape为（被试数，题量，边界数）或（题量，边界数），填充处可以是nan
+        :param theta: 特质值，shape为（被试数，）
+        :param mask: 可选，shape同score的布尔数组，True表示该题作答有效
+        """
+        score = np.asarray(score, dtype=float)
+        self.mask = ~np.isnan(score) if mask is None else np.asarray(mask, dtype=bool)
+        # 填充处换成不起作用的斜率0和阈值0，否则nan乘以0还是nan
+        a = np.where(self.mask, a, 0.0)[..., np.newaxis]
+        b = np.where(self.mask[..., np.newaxis], b, 0.0)
+        theta = np.asarray(theta)[:, np.newaxis, np.newaxis]
+        LogLik.__init__(self, score=np.where(self.mask, score, 1), a=a, b=b, theta=theta, model=model)
 
-            ddloglik += np.dot(_score, left - right)
-        return ddloglik - 1
+    @cached_property
+    def dloglik_values(self):
+        d1, d2 = self.get_item_dloglik_values(self.score.astype(int) - 1)
+        theta = self.theta[:, 0, 0]
+        return np.sum(self.mask * d1, axis=-1) - theta, np.sum(self.mask * d2, axis=-1) - 1
 
 
 class IRTModel(object):
@@ -210,10 +331,8 @@ class NewtonZeroMethod(IRTZeroMethod):
         p0 = x0 * 1.0
         for i in range(max_iter):
             _loglik = loglik(score=score, a=a, b=b, theta=p0)
-            # 一阶导数
-            f1 = _loglik.get_dloglik_value()
-            # 二阶导数
-            f2 = _loglik.get_ddloglik_value()
+            # 一阶导数和二阶导数
+            f1, f2 = _loglik.get_dloglik_and_ddloglik_values()
             # 三阶导数
             f3 = _loglik.get_dddloglik_value()
             if f2 == 0:
@@ -237,6 +356,63 @@ class NewtonZeroMethod(IRTZeroMethod):
         raise RuntimeError(msg)
 
 
+class BatchNewtonZeroMethod(IRTZeroMethod):
+    """
+    批量牛顿（哈雷）迭代，多个被试的特质值一起迭代，已收敛的被试不再参与计算，
+    不收敛的被试只做标记，不影响其他被试
+    """
+
+    @classmethod
+    def get_est_result(cls, x0, loglik, a, b, score, max_iter=50, tol=1e-5, mask=None, *args, **kwargs):
+        """
+        :param x0: 初始值，浮点数或shape为（被试数，）的numpy数组
+        :param loglik: 批量对数似然类，BatchBrmLogLik或BatchGrmLogLik
+        :param a: 斜率，能广播成score的shape，填充处可以是nan
+        :param b: 阈值，能广播成score的shape（GRM多出最后一维边界），填充处可以是nan
+        :param score: 得分，shape为（被试数，题量），题量不同的被试用nan填充
+        :param mask: 可选，shape同score的布尔数组
+        :return: (特质估计值, 迭代次数, 是否收敛)，均为shape为（被试数，）的numpy数组
+        """
+        score = np.asarray(score, dtype=float)
+        mask = ~np.isnan(score) if mask is None else np.asarray(mask, dtype=bool)
+        b = np.asarray(b, dtype=float)
+        extra_shape = b.shape[b.ndim - loglik.threshold_extra_ndim:]
+        # 广播成每个被试一行，方便只取出未收敛的被试
+        a = np.broadcast_to(a, score.shape)
+        b = np.broadcast_to(b, score.shape + extra_shape)
+
+        n = score.shape[0]
+        theta = np.zeros(n) + x0
+        n_iter = np.zeros(n, dtype=int)
+        converged = np.zeros(n, dtype=bool)
+        # 尚未收敛的被试
+        active = np.arange(n)
+        for i in range(max_iter):
+            if not active.size:
+                break
+            p0 = theta[active]
+            _loglik = loglik(score=score[active], a=a[active], b=b[active], theta=p0, mask=mask[active])
+            f1, f2 = _loglik.get_dloglik_and_ddloglik_values()
+            f3 = _loglik.get_dddloglik_value()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                if f3 is None:
+                    # 牛顿迭代
+                    p = p0 - f1 / f2
+                else:
+                    # 哈雷迭代，分母为0时退回牛顿迭代
+                    p = p0 - 2 * f1 * f2 / (2 * f2 ** 2 - f1 * f3)
+                    p = np.where(np.isfinite(p), p, p0 - f1 / f2)
+            n_iter[active] += 1
+            # 二阶导数为0的被试无法继续迭代，停在当前值
+            failed = ~np.isfinite(p)
+            p[failed] = p0[failed]
+            theta[active] = p
+            done = np.abs(p - p0) < tol
+            converged[active[done & ~failed]] = True
+            active = active[~(done | failed)]
+        return theta, n_iter, converged
+
+
 class BinaryResponseIrtModel(IRTModel):
 
     def __init__(self, *args, **kwargs):
@@ -275,19 +451,29 @@ class BrmIRTInfo(IRTInfo, LogisticModel):
         return np.sum(self.get_item_info_list())
 
 
+def get_grm_item_info(slop, threshold, theta):
+    """
+    多级计分模型的题目信息函数，一次广播算出全部题目在全部特质值上的信息，公式详见bock的书
+    :param slop: 斜率，shape为（题量，）的numpy数组
+    :param threshold: 边界阈值矩阵，shape为（题量，边界数），等级数不同时用np.inf填充
+    :param theta: 特质值，shape为（特质数，）的numpy数组
+    :return: shape为（题量，特质数）的numpy数组
+    """
+    model = GrmModel(np.asarray(slop, dtype=float)[:, np.newaxis, np.newaxis],
+                     np.asarray(threshold, dtype=float)[:, np.newaxis, :],
+                     np.asarray(theta, dtype=float)[np.newaxis, :, np.newaxis])
+    # shape为（题量，特质数，等级数）
+    p = model.category_prob_values
+    dp = model.d_boundary_values
+    return np.sum((dp[..., :-1] - dp[..., 1:]) ** 2 / np.maximum(p, np.finfo(float).tiny), axis=-1)
+
+
 class GrmIRTInfo(IRTInfo, LogisticModel):
 
     def get_item_info_list(self):
-        # 多级级计分模型的信息函数公式，详见bock的书
-        para_len = len(self.slop)
-        _p = self.prob_values.transpose()
-        _dp = self.d_prob_values.transpose()
-        p = np.vstack((np.ones(para_len), _p))
-        p = np.vstack((p, np.zeros(para_len)))
-        dp = np.vstack((np.zeros(para_len), _dp))
-        dp = np.vstack((dp, np.zeros(para_len)))
-        item_info = np.sum((dp[:-1] - dp[1:])**2 / (p[:-1] - p[1:]), axis=0)
-        return item_info
+        # 多级级计分模型的信息函数，theta为一个特质值
+        theta = np.ravel(self.theta)[:1]
+        return get_grm_item_info(np.ravel(self.slop), self.threshold, theta)[:, 0]
 
     def get_test_info(self):
         return np.sum(self.get_item_info_list())
@@ -305,3 +491,13 @@ if __name__ == '__main__':
         t.get_est_theta(0)
     e = time.clock()
     print e - s
+
+    # 批量估计，同样10000个被试，每个被试10道题
+    s = time.clock()
+    theta = np.random.normal(size=(10000, 1))
+    a0 = np.random.uniform(1, 3, (10000, 10))
+    b0 = np.random.normal(size=(10000, 10))
+    score0 = np.random.binomial(1, LogisticModel(a0, b0, theta).prob_values)
+    est, n_iter, converged = BatchNewtonZeroMethod.get_est_result(0, BatchBrmLogLik, a0, b0, score0)
+    e = time.clock()
+    print e - s
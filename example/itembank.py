@@ -0,0 +1,348 @@
+# coding=utf-8
+from tornado import gen
+import numpy as np
+from irt import BrmIRTInfo, get_grm_item_info
+from utils import Que, get_threshold, get_threshold_matrix, get_choice_values
+from exposure import exposure_counter, exposure_control
+from statements import statements
+from settings import INFO_TABLE, INFO_TABLE_DEPTH
+
+# 预先计算信息函数的特质网格
+THETA_GRID = np.linspace(-4, 4, 161)
+
+# 多级计分题按块计算信息函数表，限制（题量，格点数，等级数）中间数组的内存
+INFO_CHUNK_SIZE = 200
+
+# 子试题池（影子题库）的题量
+SHADOW_BANK_SIZE = 30
+
+QUESTION_COLUMNS = ('id, question, slop, threshold, thresholds, intercept, choice_text, '
+                    'choice_value, count, a_level, questionnaire_id, exposure_param, exposure_rate')
+
+BANK_SELECT = statements.register(
+    'bank_select', "SELECT %s FROM question WHERE questionnaire_id=%%s" % QUESTION_COLUMNS)
+# exposure_params.py改了曝光参数后只刷新缓存里的这两列，不重新载入题库
+EXPOSURE_SELECT = statements.register(
+    'exposure_select', "SELECT id, exposure_param, exposure_rate FROM question WHERE questionnaire_id=%s")
+
+
+def get_grid_index(theta):
+    """
+    :param theta: 特质值，浮点数
+    :return: THETA_GRID中离theta最近的格点下标
+    """
+    step = THETA_GRID[1] - THETA_GRID[0]
+    index = int(round((theta - THETA_GRID[0]) / step))
+    return min(max(index, 0), len(THETA_GRID) - 1)
+
+
+def get_info_table(q_type, slop, threshold):
+    """
+    试题在THETA_GRID各格点上的信息函数值
+    :param q_type: 'brm'或'grm'
+    :param slop: 斜率，shape为（题量，）的numpy数组
+    :param threshold: 阈值，BRM为shape为（题量，）、GRM为（题量，边界数）的numpy数组，见get_threshold_matrix
+    :return: shape为（题量，格点数）的numpy数组
+    """
+    if q_type == 'brm':
+        return BrmIRTInfo(slop[:, np.newaxis], threshold[:, np.newaxis], THETA_GRID).get_item_info_list()
+    else:
+        return np.concatenate([get_grm_item_info(slop[i:i + INFO_CHUNK_SIZE], threshold[i:i + INFO_CHUNK_SIZE],
+                                                 THETA_GRID) for i in range(0, len(slop), INFO_CHUNK_SIZE)]
+                              or [np.zeros((0, len(THETA_GRID)))])
+
+
+def get_rank_table(info_table, depth=INFO_TABLE_DEPTH):
+    """
+    各格点上信息函数最大的depth道题
+    :param info_table: get_info_table的返回值
+    :return: shape为（格点数，min(depth, 题量)）的位置数组，每行按信息函数从大到小排列
+    """
+    info = info_table.T
+    n_grid, n_items = info.shape
+    depth = min(depth, n_items)
+    if not depth:
+        return np.zeros((n_grid, 0), dtype=int)
+    grid = np.arange(n_grid)[:, np.newaxis]
+    # 先用argpartition取出前depth道，只对这depth道排序
+    top = np.argpartition(-info, depth - 1, axis=1)[:, :depth]
+    order = np.argsort(-info[grid, top], axis=1, kind='mergesort')
+    return top[grid, order]
+
+
+class LevelBank(object):
+    """
+    某个问卷某一层的试题，按难度排序存成numpy数组，
+    抽题时二分查找难度再切片，不必在数据库里对整层排序
+    """
+
+    def __init__(self, q_type, rows, thresholds):
+        """
+        :param q_type: 'brm'或'grm'
+        :param rows: 该层的试题对象列表
+        :param thresholds: 与rows对应的已解析的阈值，BRM为shape为（题量，）、GRM为（题量，边界数）的numpy数组
+        """
+        order = np.argsort([row.threshold for row in rows], kind='mergesort')
+        rows = [rows[i] for i in order]
+        thresholds = thresholds[order]
+        self.rows = rows
+        self.id_array = np.array([row.id for row in rows], dtype=int)
+        self.threshold_array = np.array([row.threshold for row in rows], dtype=float)
+        self.count_array = np.array([row.count for row in rows], dtype=float)
+        self.exposure_param_array = np.array([row.exposure_param for row in rows], dtype=float)
+        self.exposure_rate_array = np.array([row.exposure_rate for row in rows], dtype=float)
+        slop = np.array([row.slop for row in rows], dtype=float)
+        self.info_table = get_info_table(q_type, slop, thresholds)
+        self.rank_table = get_rank_table(self.info_table) if INFO_TABLE else None
+        self._position = dict((que_id, i) for i, que_id in enumerate(self.id_array.tolist()))
+
+    def _get_positions(self, not_in_index, start=0, stop=None):
+        # [start, stop)之间去掉不该抽的题后剩下的位置
+        positions = np.arange(start, len(self.rows) if stop is None else min(stop, len(self.rows)))
+        if not_in_index:
+            not_in = np.array([int(_) for _ in not_in_index], dtype=int)
+            positions = positions[~np.in1d(self.id_array[positions], not_in)]
+        return positions
+
+    def get_window(self, theta, not_in_index, size=SHADOW_BANK_SIZE):
+        """
+        难度与theta最接近的size道题
+        :param theta: 特质估计值
+        :param not_in_index: 不该进入抽题的题目id列表
+        :return: 按难度与theta的距离排序的位置数组
+        """
+        center = np.searchsorted(self.threshold_array, theta)
+        # 两侧各多取被排除的题量，保证排除后还够size道题
+        margin = size + len(not_in_index)
+        window = self._get_positions(not_in_index, max(center - margin, 0), center + margin)
+        order = np.argsort(np.abs(self.threshold_array[window] - theta), kind='mergesort')[:size]
+        return window[order]
+
+    def get_info_window(self, theta, not_in_index, size=SHADOW_BANK_SIZE):
+        """
+        theta处信息函数最大的size道题，查预先排好序的表，排除已作答的题后一道不剩时现场排序
+        :param theta: 特质估计值
+        :param not_in_index: 不该进入抽题的题目id列表
+        :return: 按信息函数从大到小排序的位置数组
+        """
+        grid_index = get_grid_index(theta)
+        window = self.rank_table[grid_index]
+        if not_in_index:
+            window = window[~np.in1d(self.id_array[window], np.array([int(_) for _ in not_in_index], dtype=int))]
+        if not window.size:
+            window = self._get_positions(not_in_index)
+            window = window[np.argsort(-self.info_table[window, grid_index], kind='mergesort')]
+        return window[:size]
+
+    def get_que(self, theta, not_in_index, progress=0.0, control=exposure_control):
+        """
+        由曝光控制策略在影子题库中抽题
+        :param progress: 测验进度，已作答题量/总题量
+        :param control: 曝光控制策略对象
+        :return: 试题对象，没有可抽的题时返回None
+        """
+        if self.rank_table is not None:
+            window = self.get_info_window(theta, not_in_index)
+        else:
+            window = self.get_window(theta, not_in_index)
+        if not window.size:
+            return None
+        index = control.select(self.info_table[window, get_grid_index(theta)], self.count_array[window],
+                               self.exposure_param_array[window], self.exposure_rate_array[window], progress)
+        return self.rows[window[index]]._replace(row_num=index + 1)
+
+    def get_ques_by_row_num(self, row_num_list, not_in_index):
+        """
+        相当于去掉不该抽的题后按难度排序，取出排名在row_num_list中的题
+        :param row_num_list: 排名列表，从1开始
+        :param not_in_index: 不该进入抽题的题目id列表
+        :return: 试题对象列表
+        """
+        positions = self._get_positions(not_in_index)
+        row_nums = [row_num for row_num in sorted(set(row_num_list)) if 0 < row_num <= positions.size]
+        return [self.rows[positions[row_num - 1]]._replace(row_num=row_num) for row_num in row_nums]
+
+    def incr_count(self, que_id, n=1):
+        self.count_array[self._position[que_id]] += n
+
+    def set_exposure_params(self, que_id, exposure_param, exposure_rate):
+        i = self._position[que_id]
+        self.exposure_param_array[i] = exposure_param
+        self.exposure_rate_array[i] = exposure_rate
+
+
+class ScoreTable(object):
+    """
+    各题的选项得分表，choice_value只在建表时解析一次，
+    按题目id取一道题的得分数组，或者对大量作答记录批量计分
+    """
+
+    def __init__(self, rows):
+        """
+        :param rows: 试题对象列表
+        """
+        values = [get_choice_values(row) for row in rows]
+        self.counts = np.array([len(_) for _ in values], dtype=int)
+        self.matrix = np.zeros((len(values), max(self.counts.tolist() or [0])), dtype=int)
+        for i, _values in enumerate(values):
+            self.matrix[i, :len(_values)] = _values
+        self.min_scores = np.array([min(_) if _ else 0 for _ in values], dtype=int)
+        id_array = np.array([row.id for row in rows], dtype=int)
+        self._order = np.argsort(id_array, kind='mergesort')
+        self._sorted_ids = id_array[self._order]
+        self._position = dict((que_id, i) for i, que_id in enumerate(id_array.tolist()))
+
+    def get_scores(self, que_id):
+        """
+        :return: 该题各选项得分的numpy数组，没有该题时返回None
+        """
+        i = self._position.get(que_id)
+        if i is None:
+            return None
+        return self.matrix[i, :self.counts[i]]
+
+    def score(self, que_ids, choices):
+        """
+        批量计分，与CheckChoice的规则相同：空选项计最低分，负下标从最后一个选项倒数
+        :param que_ids: 试题id数组
+        :param choices: 选项下标数组，空选项为None
+        :return: (得分数组, 是否有效的布尔数组)，无效（题库里没有该题或下标越界）的得分为0
+        """
+        que_ids = np.asarray(que_ids, dtype=int)
+        blank = np.array([choice is None for choice in choices], dtype=bool)
+        choices = np.array([0 if choice is None else choice for choice in choices], dtype=int)
+        if not self._sorted_ids.size:
+            return np.zeros(que_ids.shape, dtype=int), np.zeros(que_ids.shape, dtype=bool)
+        index = np.minimum(np.searchsorted(self._sorted_ids, que_ids), self._sorted_ids.size - 1)
+        found = self._sorted_ids[index] == que_ids
+        positions = self._order[index]
+        counts = self.counts[positions]
+        valid = found & (blank | ((choices < counts) & (choices >= -counts)))
+        column = np.where(choices < 0, choices + counts, choices)
+        column = np.where(valid & ~blank, column, 0)
+        scores = np.where(blank, self.min_scores[positions], self.matrix[positions, column])
+        return np.where(valid, scores, 0), valid
+
+
+class ItemBank(object):
+    """
+    一个问卷的全部试题，按a分层
+    """
+
+    def __init__(self, q, rows):
+        """
+        :param q: 问卷对象，需要有id, type, bank_version, exposure_version
+        :param rows: 该问卷的试题对象列表
+        """
+        self.version = q.bank_version
+        self.exposure_version = q.exposure_version
+        level_positions = {}
+        self._rows = {}
+        self._position = {}
+        for i, row in enumerate(rows):
+            level_positions.setdefault(row.a_level, []).append(i)
+            self._rows[row.id] = row
+            self._position[row.id] = i
+        # 阈值字符串只在载入时解析一次，多级计分题补齐成矩阵，抽题和估计时按位置取
+        if q.type == 'brm':
+            self.threshold_matrix = np.array([row.threshold for row in rows], dtype=float)
+            self._boundary_counts = None
+        else:
+            threshold_list = [get_threshold(row) for row in rows]
+            self.threshold_matrix = get_threshold_matrix(threshold_list)
+            self._boundary_counts = [len(_) for _ in threshold_list]
+        self.score_table = ScoreTable(rows)
+        self.levels = dict((a_level, LevelBank(q.type, [rows[i] for i in positions], self.threshold_matrix[positions]))
+                           for a_level, positions in level_positions.items())
+
+    def get_level(self, a_level):
+        # 该层没有题时返回None
+        return self.levels.get(a_level)
+
+    def get_que(self, que_id):
+        # 按id取出试题对象，没有时返回None
+        return self._rows.get(que_id)
+
+    def get_threshold(self, que_id):
+        """
+        :return: 已解析的阈值，BRM为浮点数，GRM为各边界阈值的numpy数组，没有该题时返回None
+        """
+        i = self._position.get(que_id)
+        if i is None:
+            return None
+        if self._boundary_counts is None:
+            return float(self.threshold_matrix[i])
+        return self.threshold_matrix[i, :self._boundary_counts[i]]
+
+    def get_scores(self, que_id):
+        # 该题各选项得分的numpy数组，没有该题时返回None
+        return self.score_table.get_scores(que_id)
+
+    def incr_count(self, que_id, n=1):
+        row = self._rows.get(que_id)
+        if row is not None:
+            self.levels[row.a_level].incr_count(que_id, n)
+
+    def set_exposure_params(self, version, rows):
+        """
+        :param version: 曝光参数的版本，questionnaire.exposure_version
+        :param rows: (试题id, 曝光参数, 曝光率)列表
+        """
+        for que_id, exposure_param, exposure_rate in rows:
+            row = self._rows.get(que_id)
+            if row is not None:
+                self.levels[row.a_level].set_exposure_params(que_id, exposure_param, exposure_rate)
+        self.exposure_version = version
+
+
+class ItemBankCache(object):
+    """
+    进程内的题库缓存，以问卷id为键，
+    question表的题目参数有改动时触发器会增加所属问卷的questionnaire.bank_version，该问卷的缓存随之失效；
+    exposure_params.py改了曝光参数时增加questionnaire.exposure_version，只刷新缓存里的曝光参数
+    """
+
+    def __init__(self):
+        self._banks = {}
+
+    @gen.coroutine
+    def get_bank(self, db, q):
+        """
+        :param db: 数据库
+        :param q: 问卷对象，需要有id, type, bank_version, exposure_version
+        :raise gen.Return: ItemBank对象
+        """
+        bank = self._banks.get(q.id)
+        if bank is None or bank.version != q.bank_version:
+            # 不和曝光次数的写回同时进行，以免写回的次数既在查出的count里又在get_pending_items里
+            with (yield exposure_counter.lock.acquire()):
+                cursor = yield statements.execute(db, BANK_SELECT, (q.id,))
+                rows = [Que(*(tuple(row) + (None,))) for row in cursor.fetchall()]
+                bank = ItemBank(q, rows)
+                # 加上还没写回数据库的曝光次数
+                for que_id, n in exposure_counter.get_pending_items():
+                    bank.incr_count(que_id, n)
+            self._banks[q.id] = bank
+        elif bank.exposure_version != q.exposure_version:
+            cursor = yield statements.execute(db, EXPOSURE_SELECT, (q.id,))
+            bank.set_exposure_params(q.exposure_version, cursor.fetchall())
+        raise gen.Return(bank)
+
+    def set_bank(self, q_id, bank):
+        # 直接放入题库，离线模拟等不连数据库的场合用
+        self._banks[q_id] = bank
+
+    def incr_count(self, q_id, que_id):
+        # 同步更新缓存里的曝光次数，问卷还没有缓存时什么也不做
+        bank = self._banks.get(q_id)
+        if bank is not None:
+            bank.incr_count(que_id)
+
+    def invalidate(self, q_id=None):
+        if q_id is None:
+            self._banks.clear()
+        else:
+            self._banks.pop(q_id, None)
+
+
+item_bank_cache = ItemBankCache()
@@ -1,218 +1,272 @@
 # coding=utf-8
-from psycopg2.extras import NamedTupleCursor, Json
 from tornado.web import Application, HTTPError
 from tornado import gen
 from tornado.ioloop import IOLoop
 from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
 from tornado.options import parse_command_line
-import momoko
 import os
-from bank import SelectQuestion, get_level_one_item
+import signal
+from bank import SelectQuestion, get_level_one_item, get_que_by_id, get_que_scores
+from itembank import item_bank_cache
+from exposure import exposure_counter
 from base import BaseHandler, SessionBaseHandler
-from settings import MAX_ANSWER_COUNT, DSN, COOKIE_SECRET
-from utils import Flow, get_quiz_stage, Que, session_reset, CheckChoice
+from session import get_session_store, PostgresSessionStore
+from statements import statements
+from pool import create_pool, PoolMonitor
+from settings import MAX_ANSWER_COUNT, COOKIE_SECRET, EXPOSURE_FLUSH_INTERVAL, SESSION_STORE, PROCESS_COUNT, \
+    HOST, PORT, STOP_SE
+from utils import Flow, CheckChoice, TestState, get_test_state, set_test_state, get_answer_views
+
+
+QUESTIONNAIRE_LIST = statements.register('questionnaire_list', "SELECT id, name FROM questionnaire")
+
+_ANSWER_QUERY = """
+    SELECT answer.id as aid, answer.try_count, answer.has_finished,
+    ARRAY(SELECT ARRAY[response.question_id, response.a_level] FROM response
+          WHERE response.answer_id = answer.id) AS answered,
+    questionnaire.id, questionnaire.type, questionnaire.second,
+    questionnaire.flow, questionnaire.level_one_count, questionnaire.bank_version,
+    questionnaire.info_table_version, questionnaire.exposure_version%s from questionnaire
+    LEFT JOIN answer ON answer.questionnaire_id = questionnaire.id
+    AND answer.session_key=%%s
+    WHERE questionnaire.id=%%s
+    """
+ANSWER_SELECT = statements.register('answer_select', _ANSWER_QUERY % '')
+# session存在postgresql时连同session一起查出
+ANSWER_SELECT_WITH_SESSION = statements.register(
+    'answer_select_with_session', _ANSWER_QUERY % (', (%s) AS session_data' % PostgresSessionStore.select_query))
+ANSWER_INSERT = statements.register(
+    'answer_insert',
+    "INSERT INTO answer (questionnaire_id, session_key) VALUES (%s, %s) "
+    "RETURNING id AS aid, try_count, has_finished, ARRAY[]::integer[] AS answered")
+ANSWER_RESTART = statements.register(
+    'answer_restart', "UPDATE answer SET has_finished = false, try_count = try_count + 1 WHERE id=%s")
+RESULT_SELECT = statements.register('result_select', """
+    SELECT answer.has_finished, response.question_id, response.choice, response.score,
+    response.theta, response.info, question.slop, question.threshold, question.thresholds from answer
+    LEFT JOIN response ON response.answer_id = answer.id AND response.try_count = answer.try_count
+    LEFT JOIN question ON response.question_id = question.id
+    WHERE answer.questionnaire_id=%s
+    AND answer.session_key=%s
+    ORDER BY response.step
+    """)
 
 
 class QuestionnaireListHandler(BaseHandler):
     @gen.coroutine
     def get(self):
         # 问卷列表
-        cursor = yield self.db.execute("SELECT id, name FROM questionnaire;")
+        cursor = yield statements.execute(self.db, QUESTIONNAIRE_LIST)
         q_list = cursor.fetchall()
         self.render('index.html', q_list=q_list)
 
 
 class QuestionHandler(SessionBaseHandler):
 
+    # session和问卷、作答记录一次查出，一步作答只需一次读一次写
+    prefetch_session = True
+
     @gen.coroutine
     def _check_q_exist_n_get_q_a(self, q_id):
         """
         :param q_id:
         :raise gen.Return: 返回去q_a,q是questionnaire,a是answer
         """
-        session_key = self.session_key
-        cursor = yield self.db.execute(
-            """
-            SELECT answer.id as aid, answer.score_answer, answer.old_answer,
-            answer.order_answer, answer.try_count,
-            answer.has_finished, questionnaire.id, questionnaire.type, questionnaire.second,
-            questionnaire.flow, questionnaire.level_one_count from answer
-            INNER JOIN questionnaire ON answer.questionnaire_id = questionnaire.id
-            WHERE answer.questionnaire_id=%s
-            AND answer.session_key=%s;
-            """, (q_id, session_key)
-        )
+        if self.session is None:
+            cursor = yield statements.execute(self.db, ANSWER_SELECT_WITH_SESSION,
+                                              (self.session_key, self.session_key, q_id))
+        else:
+            cursor = yield statements.execute(self.db, ANSWER_SELECT, (self.session_key, q_id))
         # q_a的意思是questionnaire and answer
         q_a = cursor.fetchone()
         if not q_a:
-            cursor = yield self.db.execute("SELECT id, type, flow, level_one_count, second "
-                                           "FROM questionnaire WHERE id=%s;",
-                                           (q_id,))
-            q = cursor.fetchone()
-
-            if q:
-
-                cursor = yield self.db.execute("INSERT INTO answer (questionnaire_id, session_key, "
-                                               "score_answer, order_answer, old_answer) VALUES (%s, %s, %s, %s, %s)"
-                                               "RETURNING id AS aid, score_answer, "
-                                               "order_answer, old_answer, try_count, "
-                                               "has_finished;",
-                                               (q_id, session_key, Json({}), Json({}), Json({})))
-                ans = cursor.fetchone()
-                raise gen.Return((q, ans))
-            else:
-                raise HTTPError(404)
+            raise HTTPError(404)
+        if self.session is None:
+            created = yield self.load_session(q_a.session_data)
+            if created:
+                # 新建的session还没有作答记录
+                q_a = q_a._replace(aid=None)
+        if q_a.aid is None:
+            cursor = yield statements.execute(self.db, ANSWER_INSERT, (q_id, self.session_key))
+            ans = cursor.fetchone()
+            raise gen.Return((q_a, ans))
         else:
             raise gen.Return((q_a, q_a))
 
     @gen.coroutine
     def get(self, q_id):
-        session = self.session
         q_a = yield self._check_q_exist_n_get_q_a(q_id)
         q, ans = q_a
+        # session可能在_check_q_exist_n_get_q_a里才和问卷一并查出，要在它之后取
+        session = self.session
 
-        # 下面是session的键值
-        is_re_start = 'is_%s_re_start' % q_id
-        step = '%s_step' % q_id
-        stage = '%s_stage' % q_id
-        next_item = '%s_next_item' % q_id
-        step_count = '%s_step_count' % q_id
+        # 测验状态
+        state = get_test_state(session, q_id)
 
         # 被试答题的过程
-        flow = Flow(flow=q.flow, name=session.session_key)
-
-        # 如果session不存在is_X_start_id，说明被试可能关闭了浏览器，所以重新启动测验
-        if not session.get(is_re_start, True):
-            # 判断测验的第一阶段是否处于结束位置
-            if session[stage] == 1:
-                next_item_list = session[next_item]
-                que = Que(*next_item_list.pop(0))
-
-            else:
-                next_item = session[next_item]
-                que = Que(*next_item)
+        flow = Flow(flow=q.flow, name=q.flow)
+
+        # 如果session不存在测验状态，说明被试可能关闭了浏览器，所以重新启动测验
+        if state is not None and not state.re_start:
+            # 第一阶段接下来有多道题，其他阶段只有一道题
+            que = yield get_que_by_id(self.db, q, state.next_ids.pop(0))
             # 将是否重新测验设定为真，则若关闭浏览器或刷新页面，则重启测验
-            session[is_re_start] = True
-            session[step] += 1
-            session[stage] = get_quiz_stage(session[step], session[stage], flow)
+            state.re_start = True
+            state.step += 1
         else:
-            # 开始测验或重启测验，session恢复出厂设置
-            session_reset(session, q_id)
+            # 开始测验或重启测验，测验状态恢复出厂设置
+            state = TestState()
             # 测验作答次数+1
             if ans.try_count > (MAX_ANSWER_COUNT - 1):
                 raise HTTPError(403)
-            # 之前的旧答案存入old_answer中
-            if ans.score_answer:
-                ans.old_answer.update(ans.score_answer)
-                ans.score_answer.clear()
-                ans.order_answer.clear()
             # 第一阶段需要回答的题量
             count = flow.get_level_item_count(1)
             # 给用户展现的第一道试题
-            que = yield get_level_one_item(ans, session, q, count, self.db)
-            yield self.db.execute(
-                "UPDATE answer SET has_finished = false, try_count = try_count + 1, score_answer=%s, order_answer=%s, "
-                "old_answer=%s WHERE id=%s",
-                (Json(ans.score_answer), Json(ans.order_answer), Json(ans.old_answer), ans.aid)
-            )
+            que = yield get_level_one_item(ans, state, q, count, self.db)
+            # 之前的作答留在response表里，以try_count区分
+            self.step_batch.add(*ANSWER_RESTART.get_query((ans.aid,)))
             # 总共答题量
-            session[step_count] = flow.total_item_count
-        yield self.db.execute("UPDATE question SET count = count + 1 WHERE id=%s", (que.id, ))
-        total_step_count = session[step_count]
-        current_step = session[step]
-        current_progress = int((current_step * 1.0 / total_step_count) * 100)
-        second = q.second
-        session['q_%s_id' % q_id] = que
+            state.step_count = flow.total_item_count
+        # 曝光次数先在内存里累计，定期批量写回
+        exposure_counter.incr(que.id)
+        item_bank_cache.incr_count(q.id, que.id)
+        state.que_id = que.id
+        set_test_state(session, q_id, state)
         yield self.save()
+        self.render_que(q_id, q, que, state)
+
+    def render_que(self, q_id, q, que, state):
+        current_step = state.step
+        if STOP_SE is None:
+            total_step_count = state.step_count
+            current_progress = int((current_step * 1.0 / total_step_count) * 100)
+        else:
+            # 变长测验的题量由终止规则决定，不显示总题量和剩余题量
+            total_step_count = None
+            current_progress = 100
         self.render('cat.html', que=que, current_progress=current_progress,
                     total_step_count=total_step_count, current_step=current_step,
-                    q_id=q_id, second=second)
+                    q_id=q_id, second=q.second)
 
     @gen.coroutine
     def post(self, q_id):
-        session = self.session
         q_a = yield self._check_q_exist_n_get_q_a(q_id)
         q, ans = q_a
+        session = self.session
         q_type = q.type
-        que = Que(*session.get('q_%s_id' % q_id))
+        state = get_test_state(session, q_id)
+        if state is None or state.que_id is None:
+            # 没有正在作答的试题，重新开始测验
+            self.redirect('/cat/%s' % q_id)
+            return
+        que = yield get_que_by_id(self.db, q, state.que_id)
         que_choice = self.get_argument('question')
-        check_choice = CheckChoice(que_choice, que)
+        scores = yield get_que_scores(self.db, q, que.id)
+        check_choice = CheckChoice(que_choice, que, scores)
         if check_choice.is_valid():
-            # 保存作答结果
+            # 作答结果追加到response表，生成重定向URL
             value = check_choice.value
-            session['%s_score' % q_id].append(int(value))
-            ans.score_answer[str(que.id)]['score'] = value
-            ans.score_answer[str(que.id)]['choice'] = que_choice
-            # 生成重定向URL
             SelectQuestionClass = getattr(SelectQuestion, q_type)
-            url = yield SelectQuestionClass(session=session, q=q, que_id=que.id,
-                                            ans=ans, db=self.db).get_que_then_redirect()
+            url = yield SelectQuestionClass(session=session, state=state, q=q, que=que, score=int(value),
+                                            choice=que_choice, ans=ans, db=self.db,
+                                            batch=self.step_batch).get_que_then_redirect()
             yield self.save()
             self.redirect(url)
         else:
             # 数据不合格则返回原作答页面
-            current_step = session['%s_step' % q_id]
-            total_step_count = session['%s_step_count' % q_id]
-            current_progress = int((current_step * 1.0 / total_step_count) * 100)
-            second = q.second
-            self.render('cat.html', que=que, current_progress=current_progress,
-                        total_step_count=total_step_count, current_step=current_step,
-                        q_id=q_id, second=second)
+            self.render_que(q_id, q, que, state)
+
+
+class HealthHandler(BaseHandler):
+    def get(self):
+        # 进程和连接池的健康状况，负载均衡可据此摘除进程
+        healthy, health = self.application.pool_monitor.get_health()
+        if not healthy:
+            self.set_status(503)
+        self.write(health)
 
 
 class ResultHandler(BaseHandler):
     @gen.coroutine
-    def _check_result_exist_n_get_q_a(self, q_id):
+    def _check_result_exist_n_get_responses(self, q_id):
+        """
+        :raise gen.Return: 最近一次测验的作答记录，按作答顺序排列
+        """
         session_key = self.get_cookie('sessionid')
         if not session_key:
             raise HTTPError(404)
-        cursor = yield self.db.execute(
-            """
-            SELECT answer.score_answer, answer.order_answer, answer.has_finished from answer
-            INNER JOIN questionnaire ON answer.questionnaire_id = questionnaire.id
-            WHERE answer.questionnaire_id=%s
-            AND answer.session_key=%s;
-            """, (q_id, session_key)
-        )
-        # q_a的意思是questionnaire and answer
-        q_a = cursor.fetchone()
-        if (not q_a) or (not q_a.has_finished):
+        cursor = yield statements.execute(self.db, RESULT_SELECT, (q_id, session_key))
+        responses = cursor.fetchall()
+        if (not responses) or (not responses[0].has_finished):
             raise HTTPError(404)
         else:
-            raise gen.Return(q_a)
+            raise gen.Return(responses)
 
     @gen.coroutine
     def get(self, q_id):
-        q_a = yield self._check_result_exist_n_get_q_a(q_id)
-        self.render('result.html', q_a=q_a, q_id=q_id)
+        responses = yield self._check_result_exist_n_get_responses(q_id)
+        # 作答详情只在查看结果时由response表拼出来
+        order_answer, score_answer = get_answer_views(responses)
+        self.render('result.html', order_answer=order_answer, score_answer=score_answer, q_id=q_id)
+
+
+@gen.coroutine
+def shutdown(ioloop, http_server, db):
+    """
+    收到SIGTERM或SIGINT时调用：不再接受新连接，写回内存里累计的曝光次数后停止IOLoop
+    """
+    http_server.stop()
+    try:
+        yield exposure_counter.close(db)
+    finally:
+        ioloop.stop()
 
 
 if __name__ == "__main__":
     parse_command_line()
-    ioloop = IOLoop.instance()
+    if PROCESS_COUNT != 1 and SESSION_STORE == 'memory':
+        raise ValueError(u'多进程时session不能存在进程内存里，请改用postgres或redis后端')
+    # 先绑定端口再fork，各进程共用同一个监听socket
+    sockets = bind_sockets(PORT, HOST)
+    if PROCESS_COUNT != 1:
+        fork_processes(PROCESS_COUNT)
+    # fork之后每个进程各自建立IOLoop和连接池
+    ioloop = IOLoop.current()
     application = Application([
         (r"/", QuestionnaireListHandler),
         (r"/cat/(\d+)", QuestionHandler),
-        (r"/result/(\d+)", ResultHandler)
+        (r"/result/(\d+)", ResultHandler),
+        (r"/health", HealthHandler),
     ],
         template_path=os.path.join(os.path.dirname(__file__), "templates"),
         static_path=os.path.join(os.path.dirname(__file__), "static"),
         cookie_secret=COOKIE_SECRET,
-        debug=True,
+        # 自动重载不能用于多进程
+        debug=PROCESS_COUNT == 1,
         xsrf_cookies=True,
     )
-    application.db = momoko.Pool(
-        dsn=DSN,
-        size=1,
-        ioloop=ioloop,
-        cursor_factory=NamedTupleCursor,
-    )
+    application.db = create_pool(ioloop)
+    application.pool_monitor = PoolMonitor(application.db)
+
+    application.session_store = get_session_store(application.db)
 
     future = application.db.connect()
     ioloop.add_future(future, lambda f: ioloop.stop())
     ioloop.start()
     future.result()
 
+    exposure_counter.start(application.db, EXPOSURE_FLUSH_INTERVAL)
+    application.pool_monitor.start()
+
     http_server = HTTPServer(application)
-    http_server.listen(8000, 'localhost')
+    http_server.add_sockets(sockets)
+
+    # 重启、部署时先写回还没写回的曝光次数再退出
+    def on_signal(signum, frame):
+        ioloop.add_callback_from_signal(shutdown, ioloop, http_server, application.db)
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
     ioloop.start()
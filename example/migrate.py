@@ -0,0 +1,208 @@
+# coding=utf-8
+"""
+数据库结构的版本化迁移，已执行的版本记在schema_migrations表里，
+每个迁移都可以重复执行（IF NOT EXISTS等），用旧版create_table.py建的库也能直接迁移
+
+    python migrate.py            迁移到最新版本
+    python migrate.py 4          迁移到第4版
+    python migrate.py --list     列出各版本及是否已执行
+"""
+import sys
+import psycopg2
+from settings import DSN
+
+# (版本号, 名称, sql)，版本号递增，已经发布的迁移不要再改，结构有变化就追加新的迁移
+MIGRATIONS = [
+    (1, 'initial', """
+     CREATE TABLE IF NOT EXISTS "session" ("session_key" varchar(40) NOT NULL PRIMARY KEY,
+                                           "session_data" jsonb NOT NULL);
+     CREATE TABLE IF NOT EXISTS "questionnaire" ("id" serial NOT NULL PRIMARY KEY,
+                                                 "name" varchar(200) NOT NULL,
+                                                 "type" varchar(20) NOT NULL,
+                                                 "flow" varchar(20) NOT NULL,
+                                                 "level_one_count" integer NULL,
+                                                 "second" integer NOT NULL DEFAULT 30);
+     CREATE TABLE IF NOT EXISTS "question" ("id" serial NOT NULL PRIMARY KEY,
+                                            "question" text NOT NULL,
+                                            "slop" double precision NULL,
+                                            "threshold" double precision NULL,
+                                            "thresholds" varchar(200) NULL,
+                                            "intercept" double precision NULL,
+                                            "choice_text" text NOT NULL,
+                                            "choice_value" varchar(20) NOT NULL,
+                                            "count" integer NOT NULL DEFAULT 0,
+                                            "a_level" integer NOT NULL,
+                                            "questionnaire_id" integer REFERENCES questionnaire NOT NULL);
+     CREATE TABLE IF NOT EXISTS "answer" ("id" serial NOT NULL PRIMARY KEY,
+                                          "questionnaire_id" integer REFERENCES questionnaire NOT NULL,
+                                          "session_key"  varchar(40) NOT NULL,
+                                          "has_finished" boolean NOT NULL DEFAULT false,
+                                          "try_count" integer NOT NULL DEFAULT 0,
+                                          "theta" double precision NULL,
+                                          "info" double precision NULL);
+     """),
+    (2, 'bank_version', """
+     ALTER TABLE "questionnaire" ADD COLUMN IF NOT EXISTS "bank_version" integer NOT NULL DEFAULT 0;
+     -- 试题参数有改动时增加bank_version，使进程内的题库缓存失效，曝光次数count的改动不算
+     CREATE OR REPLACE FUNCTION "bump_bank_version"() RETURNS trigger AS $$
+     BEGIN
+         UPDATE questionnaire SET bank_version = bank_version + 1;
+         RETURN NULL;
+     END;
+     $$ LANGUAGE plpgsql;
+     DROP TRIGGER IF EXISTS "question_bank_version" ON "question";
+     CREATE TRIGGER "question_bank_version"
+     AFTER INSERT OR DELETE OR TRUNCATE OR UPDATE OF question, slop, threshold, thresholds,
+     intercept, choice_text, choice_value, a_level, questionnaire_id ON question
+     FOR EACH STATEMENT EXECUTE PROCEDURE bump_bank_version();
+     """),
+    (3, 'answer_session_key_without_fk', """
+     -- session可以存在redis等其他后端，answer.session_key不再外键引用session表
+     ALTER TABLE "answer" DROP CONSTRAINT IF EXISTS "answer_session_key_fkey";
+     """),
+    (4, 'response', """
+     -- 只追加的作答记录，每作答一道题插入一行，try_count区分第几次测验
+     CREATE TABLE IF NOT EXISTS "response" ("id" bigserial NOT NULL PRIMARY KEY,
+                                            "answer_id" integer REFERENCES answer NOT NULL,
+                                            "try_count" integer NOT NULL,
+                                            "step" integer NOT NULL,
+                                            "question_id" integer NOT NULL,
+                                            "a_level" integer NOT NULL,
+                                            "choice" varchar(200) NULL,
+                                            "score" integer NULL,
+                                            "theta" double precision NULL,
+                                            "info" double precision NULL,
+                                            "created" timestamp with time zone NOT NULL DEFAULT now());
+     CREATE INDEX IF NOT EXISTS "response_answer_id" ON "response" ("answer_id", "try_count", "step");
+     """),
+    (5, 'hot_query_indexes', """
+     -- 每个请求都按问卷和session_key找作答记录
+     CREATE INDEX IF NOT EXISTS "answer_questionnaire_id_session_key" ON "answer" ("questionnaire_id", "session_key");
+     -- 抽题按问卷和层次取出一层的题，再按难度排序或找难度最近的题
+     CREATE INDEX IF NOT EXISTS "question_questionnaire_id_a_level_threshold"
+     ON "question" ("questionnaire_id", "a_level", "threshold");
+     ANALYZE "answer";
+     ANALYZE "question";
+     """),
+    (6, 'exposure_params', """
+     -- 曝光控制的离线参数，由exposure_params.py按作答记录计算：
+     -- exposure_param为Sympson-Hetter的曝光参数（被选中后实际施测的概率），exposure_rate为曝光率
+     ALTER TABLE "question" ADD COLUMN IF NOT EXISTS "exposure_param" double precision NOT NULL DEFAULT 1;
+     ALTER TABLE "question" ADD COLUMN IF NOT EXISTS "exposure_rate" double precision NOT NULL DEFAULT 0;
+     DROP TRIGGER IF EXISTS "question_bank_version" ON "question";
+     CREATE TRIGGER "question_bank_version"
+     AFTER INSERT OR DELETE OR TRUNCATE OR UPDATE OF question, slop, threshold, thresholds,
+     intercept, choice_text, choice_value, a_level, questionnaire_id, exposure_param, exposure_rate ON question
+     FOR EACH STATEMENT EXECUTE PROCEDURE bump_bank_version();
+     """),
+    (7, 'question_info_rank', """
+     -- 每个问卷每层在每个特质格点上按信息函数从大到小排好序的试题id，由info_table.py重建，
+     -- info_table_version为重建时的bank_version，不相等说明试题参数改过，排序表已过期
+     CREATE TABLE IF NOT EXISTS "question_info_rank" ("questionnaire_id" integer REFERENCES questionnaire NOT NULL,
+                                                      "a_level" integer NOT NULL,
+                                                      "theta_bin" integer NOT NULL,
+                                                      "question_ids" integer[] NOT NULL,
+                                                      PRIMARY KEY ("questionnaire_id", "a_level", "theta_bin"));
+     ALTER TABLE "questionnaire" ADD COLUMN IF NOT EXISTS "info_table_version" integer NULL;
+     """),
+    (8, 'scoped_bank_version', """
+     -- 只增加改动的题所属问卷的bank_version，不再让全部问卷的题库缓存和排序表失效；
+     -- 行级触发器，同一事务里一个问卷只增加一次（记在事务级的设置里），批量导入和重新分层不会逐行更新问卷
+     CREATE OR REPLACE FUNCTION "bump_questionnaire_bank_version"(q_id integer) RETURNS void AS $$
+     BEGIN
+         IF current_setting('cat_bank_version.q' || q_id, true) IS DISTINCT FROM '1' THEN
+             UPDATE questionnaire SET bank_version = bank_version + 1 WHERE id = q_id;
+             PERFORM set_config('cat_bank_version.q' || q_id, '1', true);
+         END IF;
+     END;
+     $$ LANGUAGE plpgsql;
+     CREATE OR REPLACE FUNCTION "bump_row_bank_version"() RETURNS trigger AS $$
+     BEGIN
+         IF TG_OP <> 'INSERT' THEN
+             PERFORM bump_questionnaire_bank_version(OLD.questionnaire_id);
+         END IF;
+         IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.questionnaire_id <> OLD.questionnaire_id) THEN
+             PERFORM bump_questionnaire_bank_version(NEW.questionnaire_id);
+         END IF;
+         RETURN NULL;
+     END;
+     $$ LANGUAGE plpgsql;
+     DROP TRIGGER IF EXISTS "question_bank_version" ON "question";
+     CREATE TRIGGER "question_bank_version"
+     AFTER INSERT OR DELETE OR UPDATE OF question, slop, threshold, thresholds,
+     intercept, choice_text, choice_value, a_level, questionnaire_id, exposure_param, exposure_rate ON question
+     FOR EACH ROW EXECUTE PROCEDURE bump_row_bank_version();
+     -- TRUNCATE没有行级触发器，清空的是所有问卷的题，仍然全部增加
+     DROP TRIGGER IF EXISTS "question_bank_version_truncate" ON "question";
+     CREATE TRIGGER "question_bank_version_truncate"
+     AFTER TRUNCATE ON question
+     FOR EACH STATEMENT EXECUTE PROCEDURE bump_bank_version();
+     """),
+    (9, 'exposure_version', """
+     -- 曝光参数不影响信息函数，改动时不增加bank_version（否则排序表跟着过期），
+     -- 由exposure_params.py增加exposure_version，题库缓存据此只刷新曝光参数
+     ALTER TABLE "questionnaire" ADD COLUMN IF NOT EXISTS "exposure_version" integer NOT NULL DEFAULT 0;
+     DROP TRIGGER IF EXISTS "question_bank_version" ON "question";
+     CREATE TRIGGER "question_bank_version"
+     AFTER INSERT OR DELETE OR UPDATE OF question, slop, threshold, thresholds,
+     intercept, choice_text, choice_value, a_level, questionnaire_id ON question
+     FOR EACH ROW EXECUTE PROCEDURE bump_row_bank_version();
+     """),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# 同一时刻只让一个进程执行迁移
+_LOCK_KEY = 20170301
+
+
+def get_applied_versions(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS "schema_migrations" ("version" integer NOT NULL PRIMARY KEY, '
+                   '"name" varchar(100) NOT NULL, '
+                   '"applied" timestamp with time zone NOT NULL DEFAULT now());')
+    cursor.execute('SELECT version FROM schema_migrations;')
+    return set(row[0] for row in cursor.fetchall())
+
+
+def migrate(conn, target=None):
+    """
+    执行还没执行过的迁移，每个迁移连同版本记录在一个事务里提交
+    :param conn: psycopg2连接
+    :param target: 目标版本，None为最新版本
+    :return: 这次执行的版本号列表
+    """
+    target = LATEST_VERSION if target is None else target
+    applied = []
+    for version, name, sql in MIGRATIONS:
+        if version > target:
+            break
+        with conn:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s);', (_LOCK_KEY,))
+                if version in get_applied_versions(cursor):
+                    continue
+                cursor.execute(sql)
+                cursor.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s);', (version, name))
+        applied.append(version)
+    return applied
+
+
+def main(argv):
+    conn = psycopg2.connect(DSN)
+    try:
+        if argv and argv[0] == '--list':
+            with conn:
+                with conn.cursor() as cursor:
+                    applied = get_applied_versions(cursor)
+            for version, name, sql in MIGRATIONS:
+                print '%04d %s %s' % (version, name, 'applied' if version in applied else 'pending')
+        else:
+            target = int(argv[0]) if argv else None
+            for version in migrate(conn, target):
+                print 'applied %04d' % version
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,65 @@
+# coding=utf-8
+import psycopg2
+from tornado import gen
+from tornado.log import app_log
+from statements import statements, is_missing_statement
+
+
+class StepBatch(object):
+    """
+    一步作答要写的语句先攒起来，最后拼成一条多语句查询发出去，
+    postgresql把一次发来的多条语句放在同一个隐式事务里执行，只要一次往返，
+    其中一条出错时整批回滚（不显式BEGIN，以免出错后连接停在失败的事务里），
+    所以连接上没有预备某条语句时可以把整批换成原始sql重发
+    """
+
+    def __init__(self):
+        self._queries = []
+        self._params = []
+
+    def __len__(self):
+        return len(self._queries)
+
+    def add(self, query, params=()):
+        """
+        :param query: 只用%s占位符的sql语句
+        :param params: 参数序列
+        """
+        self._queries.append(query.strip().rstrip(';'))
+        self._params.extend(params)
+
+    @gen.coroutine
+    def execute(self, db):
+        """
+        一次执行攒下的全部语句，执行后清空
+        :param db: 数据库
+        """
+        if not self._queries:
+            return
+        queries, params = self._queries, self._params
+        self._queries, self._params = [], []
+        try:
+            yield db.execute(';\n'.join(queries) + ';', params)
+        except psycopg2.Error as e:
+            if not is_missing_statement(e):
+                raise
+            app_log.warning(u'预备语句不存在，本批语句改用原始sql')
+            queries = [statements.get_raw_query(query) for query in queries]
+            yield db.execute(';\n'.join(queries) + ';', params)
+
+
+class RoundTripCounter(object):
+    """
+    数据库的代理，记录一次请求里经它发出的查询往返次数
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self.round_trips = 0
+
+    def execute(self, *args, **kwargs):
+        self.round_trips += 1
+        return self._db.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
@@ -0,0 +1,122 @@
+# coding=utf-8
+from datetime import timedelta
+import os
+import time
+from psycopg2.extras import NamedTupleCursor
+from tornado.ioloop import PeriodicCallback
+import momoko
+from statements import statements
+from settings import DSN, DB_POOL_SIZE, DB_POOL_MAX_SIZE, DB_POOL_SHRINK_DELAY
+
+
+def create_pool(ioloop):
+    """
+    依据settings生成数据库连接池，多进程时每个进程fork之后各自调用
+    连接数从DB_POOL_SIZE起，忙不过来时增长到DB_POOL_MAX_SIZE，
+    多出来的连接空闲DB_POOL_SHRINK_DELAY秒后关闭
+    要在登记完全部预备语句（导入完各模块）之后调用
+    :param ioloop: 当前进程的IOLoop
+    :return: momoko.Pool对象，还没有连接
+    """
+    return momoko.Pool(
+        dsn=DSN,
+        size=DB_POOL_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        auto_shrink=DB_POOL_MAX_SIZE > DB_POOL_SIZE,
+        shrink_delay=timedelta(seconds=DB_POOL_SHRINK_DELAY),
+        shrink_period=timedelta(seconds=DB_POOL_SHRINK_DELAY),
+        ioloop=ioloop,
+        cursor_factory=NamedTupleCursor,
+        # 每个新连接上预备全部固定查询
+        setsession=statements.get_setsession(),
+    )
+
+
+def get_pool_stats(pool):
+    """
+    连接池当前各状态的连接数
+    :param pool: momoko.Pool对象
+    :return: 字典，waiting为排队等连接的查询数，saturation为忙碌连接占最大连接数的比例
+    """
+    conns = pool.conns
+    busy = len(conns.busy)
+    return {
+        'size': pool.size,
+        'max_size': pool.max_size,
+        'total': conns.total,
+        'free': len(conns.free),
+        'busy': busy,
+        'dead': len(conns.dead),
+        'pending': len(conns.pending),
+        'waiting': len(conns.waiting_queue),
+        'saturation': round(busy * 1.0 / pool.max_size, 3),
+    }
+
+
+class PoolMonitor(object):
+    """
+    定期采样连接池，记录上次读取以来忙碌连接数和排队查询数的峰值，
+    两次请求/health之间的短暂饱和也能看到
+    """
+
+    def __init__(self, pool, interval=0.1):
+        """
+        :param pool: momoko.Pool对象
+        :param interval: 采样间隔，单位为秒
+        """
+        self.pool = pool
+        self.interval = interval
+        self.started_at = time.time()
+        self._callback = None
+        self._reset_peak()
+
+    def _reset_peak(self):
+        self.peak_busy = 0
+        self.peak_waiting = 0
+        # 有查询在排队等连接的采样次数和总采样次数
+        self.saturated_samples = 0
+        self.samples = 0
+
+    def sample(self):
+        conns = self.pool.conns
+        waiting = len(conns.waiting_queue)
+        self.peak_busy = max(self.peak_busy, len(conns.busy))
+        self.peak_waiting = max(self.peak_waiting, waiting)
+        self.samples += 1
+        if waiting:
+            self.saturated_samples += 1
+
+    def start(self):
+        self._callback = PeriodicCallback(self.sample, self.interval * 1000)
+        self._callback.start()
+
+    def stop(self):
+        if self._callback is not None:
+            self._callback.stop()
+            self._callback = None
+
+    def get_stats(self):
+        """
+        :return: 当前连接池状态加上上次读取以来的峰值，读取后峰值清零
+        """
+        stats = get_pool_stats(self.pool)
+        stats.update({
+            'peak_busy': self.peak_busy,
+            'peak_waiting': self.peak_waiting,
+            'saturated_ratio': round(self.saturated_samples * 1.0 / self.samples, 3) if self.samples else 0.0,
+        })
+        self._reset_peak()
+        return stats
+
+    def get_health(self):
+        """
+        :return: (是否健康, 健康信息字典)，连接全部失效时不健康
+        """
+        stats = self.get_stats()
+        healthy = not self.pool.conns.all_dead
+        return healthy, {
+            'status': 'ok' if healthy else 'unavailable',
+            'pid': os.getpid(),
+            'uptime': int(time.time() - self.started_at),
+            'pool': stats,
+        }
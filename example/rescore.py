@@ -0,0 +1,71 @@
+# coding=utf-8
+"""
+按question表当前的choice_value重新计算一个问卷全部作答记录（response表）的得分，
+用于修正选项得分之后批量订正历史作答，只改得分有变化的行，特质估计值不重新计算
+
+    python rescore.py 问卷id [--dry-run]
+"""
+import sys
+import numpy as np
+import psycopg2
+from psycopg2.extras import NamedTupleCursor
+from settings import DSN
+from itembank import ScoreTable, BANK_SELECT
+
+
+def _parse_choice(choice):
+    # 与CheckChoice相同：空选项为None，不是整数时返回False
+    if choice is None or choice == '':
+        return None
+    try:
+        return int(choice)
+    except ValueError:
+        return False
+
+
+def rescore(cursor, q_id, dry_run=False):
+    """
+    :param cursor: 事务中的游标
+    :param q_id: 问卷id
+    :param dry_run: 为True时只计算不写回
+    :return: (作答记录数, 得分有变化的行数, 无法计分的response id列表)
+    """
+    cursor.execute(*BANK_SELECT.get_query((q_id,), prepared=False))
+    score_table = ScoreTable(cursor.fetchall())
+    cursor.execute('SELECT response.id, response.question_id, response.choice, response.score FROM response '
+                   'JOIN answer ON response.answer_id = answer.id WHERE answer.questionnaire_id = %s;', (q_id,))
+    responses = cursor.fetchall()
+    response_ids = np.array([response.id for response in responses], dtype=np.int64)
+    choices = [_parse_choice(response.choice) for response in responses]
+    parsed = np.array([choice is not False for choice in choices], dtype=bool)
+    scores, valid = score_table.score([response.question_id for response in responses],
+                                      [choice if choice is not False else 0 for choice in choices])
+    valid &= parsed
+    old_scores = np.array([-1 if response.score is None else response.score for response in responses], dtype=int)
+    changed = valid & (scores != old_scores)
+    if changed.any() and not dry_run:
+        cursor.execute("""
+            UPDATE response SET score = v.score
+            FROM unnest(%s::bigint[], %s::integer[]) AS v(id, score)
+            WHERE response.id = v.id;
+            """, (response_ids[changed].tolist(), scores[changed].tolist()))
+    return len(responses), int(changed.sum()), response_ids[~valid].tolist()
+
+
+def main(argv):
+    q_id = int(argv[0])
+    dry_run = '--dry-run' in argv[1:]
+    conn = psycopg2.connect(DSN)
+    try:
+        with conn:
+            with conn.cursor(cursor_factory=NamedTupleCursor) as cursor:
+                count, changed, invalid = rescore(cursor, q_id, dry_run)
+        print 'responses: %d, changed: %d%s' % (count, changed, ' (dry run)' if dry_run else '')
+        if invalid:
+            print 'unscorable responses: %s' % ', '.join(str(_) for _ in invalid)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,393 @@
+# coding=utf-8
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+import json
+import time
+from tornado import gen
+from tornado.iostream import StreamClosedError
+from tornado.locks import Lock
+from tornado.tcpclient import TCPClient
+from psycopg2.extras import Json
+from psycopg2 import IntegrityError
+from statements import statements
+from settings import SESSION_STORE, SESSION_TTL, SESSION_MEMORY_MAX_SIZE, REDIS_HOST, REDIS_PORT, REDIS_DB
+
+
+class Session(dict):
+    """
+    记录改动过哪些键的session字典，保存时只写改动过的键，没有改动就不写
+    取出的列表、字典等可变值可能被原地修改，所以也算作改动过
+
+    >>> session = Session({'a': 1, 'b': [1]})
+    >>> session.is_dirty
+    False
+    >>> session['a'] = 2
+    >>> session['b'].append(2)
+    >>> del session['a']
+    >>> sorted(session.changed_keys), sorted(session.deleted_keys)
+    (['b'], ['a'])
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Session, self).__init__(*args, **kwargs)
+        self.changed_keys = set()
+        self.deleted_keys = set()
+
+    def _touch(self, key, value):
+        if isinstance(value, (list, dict)):
+            self.changed_keys.add(key)
+        return value
+
+    def __getitem__(self, key):
+        return self._touch(key, super(Session, self).__getitem__(key))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        super(Session, self).__setitem__(key, value)
+        self.changed_keys.add(key)
+        self.deleted_keys.discard(key)
+
+    def __delitem__(self, key):
+        super(Session, self).__delitem__(key)
+        self.deleted_keys.add(key)
+        self.changed_keys.discard(key)
+
+    def pop(self, key, *args):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return super(Session, self).pop(key, *args)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    @property
+    def is_dirty(self):
+        return bool(self.changed_keys or self.deleted_keys)
+
+    def get_changes(self):
+        """
+        :return: (改动过的键值字典, 删除的键列表)
+        """
+        changed = dict((key, dict.__getitem__(self, key)) for key in self.changed_keys)
+        return changed, list(self.deleted_keys)
+
+    def clear_changes(self):
+        # 保存之后调用
+        self.changed_keys.clear()
+        self.deleted_keys.clear()
+
+
+class BaseSessionStore(object):
+    """
+    session存储后端，session是可以json序列化的字典
+    """
+
+    __metaclass__ = ABCMeta
+
+    # session是否存在业务数据库里，是则可以和业务查询合并成一次往返
+    in_database = False
+
+    @abstractmethod
+    def get(self, session_key):
+        """
+        :raise gen.Return: session字典，不存在或已过期时为None
+        """
+        pass
+
+    @abstractmethod
+    def create(self, session_key, session_data):
+        """
+        新建session
+        :raise gen.Return: session_key已存在时为False
+        """
+        pass
+
+    @abstractmethod
+    def save(self, session_key, session_data):
+        pass
+
+    @abstractmethod
+    def delete(self, session_key):
+        pass
+
+    @gen.coroutine
+    def save_changes(self, session_key, session):
+        """
+        只保存改动过的键，后端不支持局部更新时保存整个session
+        :param session: Session对象
+        """
+        yield self.save(session_key, session)
+
+    def get_save_changes_statement(self, session_key, session):
+        """
+        :return: 保存改动的(sql, 参数)，可以放进StepBatch和其他语句一起执行，
+                 session不在业务数据库里时为None
+        """
+        return None
+
+
+SESSION_SELECT = statements.register(
+    'session_select', "SELECT session_data FROM session WHERE session_key=%s")
+SESSION_INSERT = statements.register(
+    'session_insert', "INSERT INTO session (session_key, session_data) VALUES (%s, %s::jsonb)")
+SESSION_UPDATE = statements.register(
+    'session_update', "UPDATE session SET session_data = %s::jsonb WHERE session_key = %s")
+# 删掉删除的键，再合并改动过的键，不重写整个session_data
+# jsonb - text[]要postgresql 10，这里用jsonb_each过滤掉删除的键，9.5起可用
+SESSION_UPDATE_CHANGES = statements.register(
+    'session_update_changes',
+    "UPDATE session SET session_data = (SELECT coalesce(jsonb_object_agg(key, value), '{}'::jsonb) "
+    "FROM jsonb_each(session_data) WHERE key <> ALL(%s::text[])) || %s::jsonb WHERE session_key = %s")
+SESSION_DELETE = statements.register(
+    'session_delete', "DELETE FROM session WHERE session_key = %s")
+
+
+class PostgresSessionStore(BaseSessionStore):
+    """
+    存在postgresql的session表里，不会过期
+    """
+
+    in_database = True
+
+    # 按session_key取session_data的查询，也可以作为子查询嵌进其他查询
+    select_query = SESSION_SELECT.query
+
+    def __init__(self, db):
+        self.db = db
+
+    @gen.coroutine
+    def get(self, session_key):
+        cursor = yield statements.execute(self.db, SESSION_SELECT, (session_key,))
+        session = cursor.fetchone()
+        raise gen.Return(session.session_data if session else None)
+
+    @gen.coroutine
+    def create(self, session_key, session_data):
+        try:
+            yield statements.execute(self.db, SESSION_INSERT, (session_key, Json(session_data)))
+        except IntegrityError:
+            raise gen.Return(False)
+        raise gen.Return(True)
+
+    @gen.coroutine
+    def save(self, session_key, session_data):
+        yield statements.execute(self.db, SESSION_UPDATE, (Json(session_data), session_key))
+
+    @gen.coroutine
+    def save_changes(self, session_key, session):
+        changed, deleted = session.get_changes()
+        yield statements.execute(self.db, SESSION_UPDATE_CHANGES, (deleted, Json(changed), session_key))
+
+    def get_save_changes_statement(self, session_key, session):
+        changed, deleted = session.get_changes()
+        return SESSION_UPDATE_CHANGES.get_query((deleted, Json(changed), session_key))
+
+    @gen.coroutine
+    def delete(self, session_key):
+        yield statements.execute(self.db, SESSION_DELETE, (session_key,))
+
+
+class MemorySessionStore(BaseSessionStore):
+    """
+    存在进程内存里的LRU session，超过max_size时淘汰最久没用的session，
+    只适合单进程部署
+    """
+
+    def __init__(self, max_size=10000, ttl=86400):
+        """
+        :param max_size: 最多保存的session数
+        :param ttl: 过期时间，单位为秒
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        # session_key: (过期时刻, json字符串)，存字符串以免请求之间共用同一个字典
+        self._data = OrderedDict()
+
+    def _get(self, session_key):
+        item = self._data.pop(session_key, None)
+        if item is None:
+            return None
+        expire, value = item
+        if expire < time.time():
+            return None
+        # 重新插入，放到最近使用的一端
+        self._data[session_key] = item
+        return json.loads(value)
+
+    def _set(self, session_key, session_data):
+        self._data.pop(session_key, None)
+        self._data[session_key] = (time.time() + self.ttl, json.dumps(session_data))
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    @gen.coroutine
+    def get(self, session_key):
+        raise gen.Return(self._get(session_key))
+
+    @gen.coroutine
+    def create(self, session_key, session_data):
+        if self._get(session_key) is not None:
+            raise gen.Return(False)
+        self._set(session_key, session_data)
+        raise gen.Return(True)
+
+    @gen.coroutine
+    def save(self, session_key, session_data):
+        self._set(session_key, session_data)
+
+    @gen.coroutine
+    def delete(self, session_key):
+        self._data.pop(session_key, None)
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisConnection(object):
+    """
+    最简单的异步redis协议（RESP）客户端，一条连接上依次执行命令，断开后自动重连
+    """
+
+    def __init__(self, host='127.0.0.1', port=6379, db=0, password=None):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self._stream = None
+        self._lock = Lock()
+
+    @staticmethod
+    def _encode(value):
+        if not isinstance(value, bytes):
+            value = (u'%s' % value).encode('utf-8')
+        return value
+
+    def _pack_command(self, args):
+        args = [self._encode(arg) for arg in args]
+        parts = [b'*' + self._encode(len(args)) + b'\r\n']
+        for arg in args:
+            parts.append(b'$' + self._encode(len(arg)) + b'\r\n' + arg + b'\r\n')
+        return b''.join(parts)
+
+    @gen.coroutine
+    def _read_reply(self, stream):
+        line = yield stream.read_until(b'\r\n')
+        prefix, line = line[:1], line[1:-2]
+        if prefix == b'+':
+            raise gen.Return(line)
+        elif prefix == b'-':
+            raise RedisError(line)
+        elif prefix == b':':
+            raise gen.Return(int(line))
+        elif prefix == b'$':
+            length = int(line)
+            if length < 0:
+                raise gen.Return(None)
+            data = yield stream.read_bytes(length + 2)
+            raise gen.Return(data[:-2])
+        elif prefix == b'*':
+            length = int(line)
+            if length < 0:
+                raise gen.Return(None)
+            reply = []
+            for i in range(length):
+                item = yield self._read_reply(stream)
+                reply.append(item)
+            raise gen.Return(reply)
+        raise RedisError(u'无法解析的回复%r' % line)
+
+    @gen.coroutine
+    def _send(self, stream, *args):
+        yield stream.write(self._pack_command(args))
+        reply = yield self._read_reply(stream)
+        raise gen.Return(reply)
+
+    @gen.coroutine
+    def _get_stream(self):
+        if self._stream is None or self._stream.closed():
+            stream = yield TCPClient().connect(self.host, self.port)
+            if self.password:
+                yield self._send(stream, 'AUTH', self.password)
+            if self.db:
+                yield self._send(stream, 'SELECT', self.db)
+            self._stream = stream
+        raise gen.Return(self._stream)
+
+    @gen.coroutine
+    def execute(self, *args):
+        """
+        执行一条命令
+        :raise gen.Return: 命令的回复
+        """
+        with (yield self._lock.acquire()):
+            stream = yield self._get_stream()
+            try:
+                reply = yield self._send(stream, *args)
+            except StreamClosedError:
+                # 连接被服务端关闭，重连后再试一次
+                stream.close()
+                stream = yield self._get_stream()
+                reply = yield self._send(stream, *args)
+        raise gen.Return(reply)
+
+
+class RedisSessionStore(BaseSessionStore):
+    """
+    存在redis（或任何兼容redis协议的服务）里的session，用redis的过期时间实现ttl
+    """
+
+    def __init__(self, connection, ttl=86400, prefix='session:'):
+        """
+        :param connection: RedisConnection对象
+        :param ttl: 过期时间，单位为秒
+        :param prefix: 键的前缀
+        """
+        self.connection = connection
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @gen.coroutine
+    def get(self, session_key):
+        value = yield self.connection.execute('GET', self.prefix + session_key)
+        raise gen.Return(None if value is None else json.loads(value))
+
+    @gen.coroutine
+    def create(self, session_key, session_data):
+        reply = yield self.connection.execute('SET', self.prefix + session_key, json.dumps(session_data),
+                                              'EX', self.ttl, 'NX')
+        raise gen.Return(reply is not None)
+
+    @gen.coroutine
+    def save(self, session_key, session_data):
+        yield self.connection.execute('SET', self.prefix + session_key, json.dumps(session_data), 'EX', self.ttl)
+
+    @gen.coroutine
+    def delete(self, session_key):
+        yield self.connection.execute('DEL', self.prefix + session_key)
+
+
+def get_session_store(db):
+    """
+    依据settings生成session存储后端
+    :param db: 数据库，postgres后端使用
+    """
+    if SESSION_STORE == 'postgres':
+        return PostgresSessionStore(db)
+    elif SESSION_STORE == 'memory':
+        return MemorySessionStore(max_size=SESSION_MEMORY_MAX_SIZE, ttl=SESSION_TTL)
+    elif SESSION_STORE == 'redis':
+        return RedisSessionStore(RedisConnection(REDIS_HOST, REDIS_PORT, REDIS_DB), ttl=SESSION_TTL)
+    raise ValueError(u'不支持的session后端%s' % SESSION_STORE)
@@ -5,5 +5,57 @@ MAX_ANSWER_COUNT = 30
 
 COOKIE_SECRET = 'xi bao zi'
 
+# 标准误终止规则：第一阶段定长，之后每个阶段最多答flow规定的题量，
+# 答够STOP_MIN_FLOW规定的最少题量且后验标准差不大于STOP_SE时结束本阶段，之后各阶段最少题量都为0时结束测验；
+# STOP_SE为None时按flow定长
+STOP_SE = None
+# 各阶段最少题量，形如'5|1|0'，为None时第一阶段按flow，其他阶段为0
+STOP_MIN_FLOW = None
+
+# 是否把题库缓存在进程内存里抽题，False则每次抽题都查询数据库
+ITEM_BANK_CACHE = True
+
+# 曝光次数在内存里累计，每隔多少秒合并写回数据库
+EXPOSURE_FLUSH_INTERVAL = 5
+
+# 第二阶段起从影子题库中选题的曝光控制策略：'ratio'为曝光次数占比与信息函数之比最小，
+# 'randomesque'为信息函数最大的EXPOSURE_RANDOMESQUE_K道题中随机抽，
+# 'sympson_hetter'和'progressive_restricted'的曝光参数、曝光率用exposure_params.py离线计算
+EXPOSURE_CONTROL = 'ratio'
+EXPOSURE_RANDOMESQUE_K = 5
+# 目标最大曝光率，exposure_params.py计算Sympson-Hetter参数和progressive restricted限制抽题时用
+EXPOSURE_MAX_RATE = 0.25
+
+# 影子题库取theta处信息函数最大的题（查预先按特质格点排好序的表），False则取难度与theta最近的题；
+# 不用题库缓存时排序表存在question_info_rank表里，试题参数有改动后用info_table.py重建，过期时退回按难度取
+INFO_TABLE = True
+# 排序表每个格点保存的题量，排除已作答的题后一道不剩时改为现场排序
+INFO_TABLE_DEPTH = 100
+
+# session存储后端，'postgres'、'memory'（进程内LRU，只适合单进程）或'redis'
+SESSION_STORE = 'postgres'
+# session过期时间，单位为秒，memory和redis后端有效
+SESSION_TTL = 86400
+# memory后端最多保存的session数
+SESSION_MEMORY_MAX_SIZE = 10000
+REDIS_HOST = '127.0.0.1'
+REDIS_PORT = 6379
+REDIS_DB = 0
+
+# 每个进程的数据库连接池，从DB_POOL_SIZE个连接起，查询排队时增长到DB_POOL_MAX_SIZE个，
+# 多出来的连接空闲DB_POOL_SHRINK_DELAY秒后关闭
+DB_POOL_SIZE = 2
+DB_POOL_MAX_SIZE = 10
+DB_POOL_SHRINK_DELAY = 120
+
+# 是否在每个连接上预备固定查询（见statements.py），经过pgbouncer等事务级连接池时设为False
+PREPARED_STATEMENTS = True
+
+# 服务进程数，大于1时预先fork出多个进程共用端口，0为cpu核数；
+# 多进程时session不能存在进程内存里，题库缓存和曝光计数器每个进程各有一份
+PROCESS_COUNT = 1
+HOST = 'localhost'
+PORT = 8000
+
 # 例如DNS = "dbname=cat host=127.0.0.1 port=5432 user=postgres password=123456"
 DSN = "dbname=yours host=yours port=yours user=yours password=yours"
\ No newline at end of file
@@ -0,0 +1,177 @@
+# coding=utf-8
+"""
+蒙特卡洛模拟测验，不连数据库：生成题库放进进程内的题库缓存，让模拟被试走一遍真实的抽题、计分和估计流程
+（get_level_one_item、影子题库、SelectQuestion.brm/grm），
+报告每秒处理的题量、每步耗时的分位数、特质估计的偏差和均方根误差以及曝光率分布
+
+    python simulate.py [brm|grm] [被试数] [题量] [测验流程] [随机种子]
+
+例如python simulate.py grm 2000 5000 5|4|3，需要settings.ITEM_BANK_CACHE为True
+"""
+from collections import namedtuple
+import random
+import sys
+import time
+import numpy as np
+from irt import LogisticModel, GrmModel
+from utils import Flow, Que, TestState
+from itembank import ItemBank, item_bank_cache
+from bank import SelectQuestion, get_level_one_item, get_que_by_id
+from persistence import StepBatch
+from strata import stratify
+from settings import ITEM_BANK_CACHE, EXPOSURE_CONTROL, EXPOSURE_MAX_RATE, STOP_SE
+
+SimQuestionnaire = namedtuple('SimQuestionnaire', ('id', 'type', 'flow', 'level_one_count', 'second',
+                                                   'bank_version', 'info_table_version', 'exposure_version'))
+
+SimAnswer = namedtuple('SimAnswer', ('aid', 'try_count', 'answered'))
+
+# 多级计分题的等级数
+GRM_CATEGORY_COUNT = 4
+
+# 耗时分位数
+PERCENTILES = (50, 90, 99)
+
+
+def make_bank(q, item_count):
+    """
+    生成模拟题库，斜率服从对数正态分布，难度服从标准正态分布，按难度分块的a分层
+    :param q: SimQuestionnaire对象
+    :param item_count: 题量
+    :return: 试题对象列表
+    """
+    n_strata = Flow(flow=q.flow, name=q.flow).level_len
+    slop = np.random.lognormal(0, 0.3, item_count)
+    if q.type == 'brm':
+        thresholds = np.random.normal(0, 1, (item_count, 1))
+    else:
+        thresholds = np.sort(np.random.normal(0, 1, (item_count, GRM_CATEGORY_COUNT - 1)), axis=1)
+    threshold = thresholds.mean(axis=1)
+    levels = stratify(slop, threshold, n_strata)
+    rows = []
+    for i in range(item_count):
+        if q.type == 'brm':
+            choice_text, choice_value, _thresholds = u'错|对', '0|1', None
+        else:
+            choice_text = '|'.join(u'选项%d' % (k + 1) for k in range(GRM_CATEGORY_COUNT))
+            choice_value = '|'.join(str(k + 1) for k in range(GRM_CATEGORY_COUNT))
+            _thresholds = '|'.join(repr(float(_)) for _ in thresholds[i])
+        rows.append(Que(i + 1, u'题目%d' % (i + 1), float(slop[i]), float(threshold[i]), _thresholds, None,
+                        choice_text, choice_value, 0, int(levels[i]), q.id, 1.0, 0.0, None))
+    return rows
+
+
+def get_sim_score(que, theta):
+    """
+    按模型概率模拟作答
+    :return: (得分, 所选选项)
+    """
+    if que.thresholds:
+        b = np.array([float(_) for _ in que.thresholds.split('|')])
+        p = GrmModel(que.slop, b[np.newaxis, :], theta).category_prob_values[0]
+        category = min(int(np.searchsorted(np.cumsum(p), np.random.random_sample())), p.size - 1)
+        return category + 1, str(category)
+    score = int(np.random.random_sample() < LogisticModel(que.slop, que.threshold, theta).prob_values)
+    return score, str(score)
+
+
+def simulate_examinee(q, flow, true_theta, aid):
+    """
+    模拟一个被试从开始到结束的整个测验，照搬QuestionHandler的流程，但不读写session和数据库
+    :return: (特质估计值, 后验标准差, 作答的试题id列表, 每步耗时列表)
+    """
+    session = {}
+    state = TestState()
+    ans = SimAnswer(aid=aid, try_count=1, answered=[])
+    timings = []
+    s = time.time()
+    que = get_level_one_item(ans, state, q, flow.get_level_item_count(1), None).result()
+    timings.append(time.time() - s)
+    state.step_count = flow.total_item_count
+    que_ids = []
+    while True:
+        item_bank_cache.incr_count(q.id, que.id)
+        que_ids.append(que.id)
+        state.que_id = que.id
+        score, choice = get_sim_score(que, true_theta)
+        s = time.time()
+        select_question = getattr(SelectQuestion, q.type)(
+            session=session, state=state, q=q, que=que, score=score, choice=choice, ans=ans, db=None,
+            batch=StepBatch())
+        url = select_question.get_que_then_redirect().result()
+        if url.startswith('/result'):
+            timings.append(time.time() - s)
+            return select_question.theta, select_question.posterior.sd, que_ids, timings
+        que = get_que_by_id(None, q, state.next_ids.pop(0)).result()
+        state.re_start = True
+        state.step += 1
+        timings.append(time.time() - s)
+
+
+def simulate(q_type='brm', examinee_count=1000, item_count=2000, flow='5|4|3', seed=None):
+    """
+    :return: 结果字典
+    """
+    if not ITEM_BANK_CACHE:
+        raise ValueError(u'模拟需要把settings.ITEM_BANK_CACHE设为True')
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+    q = SimQuestionnaire(id=0, type=q_type, flow=flow, level_one_count=None, second=30, bank_version=0,
+                         info_table_version=0, exposure_version=0)
+    rows = make_bank(q, item_count)
+    q = q._replace(level_one_count=sum(1 for row in rows if row.a_level == 1))
+    item_bank_cache.set_bank(q.id, ItemBank(q, rows))
+    flow = Flow(flow=flow, name=flow)
+    true_thetas = np.random.normal(0, 1, examinee_count)
+    est_thetas = np.empty(examinee_count)
+    sds = np.empty(examinee_count)
+    exposure = np.zeros(item_count + 1)
+    timings = []
+    s = time.time()
+    for i, true_theta in enumerate(true_thetas):
+        est_thetas[i], sds[i], que_ids, _timings = simulate_examinee(q, flow, float(true_theta), i + 1)
+        exposure[que_ids] += 1
+        timings.extend(_timings)
+    elapsed = time.time() - s
+    timings = np.array(timings) * 1000
+    exposure_rate = exposure[1:] / examinee_count
+    error = est_thetas - true_thetas
+    return {
+        'examinees': examinee_count,
+        'items': int(exposure.sum()),
+        'items_per_second': exposure.sum() / elapsed,
+        'mean_length': exposure.sum() / examinee_count,
+        'latency': [(p, float(np.percentile(timings, p))) for p in PERCENTILES] + [('max', float(timings.max()))],
+        'bias': float(error.mean()),
+        'rmse': float(np.sqrt(np.mean(error ** 2))),
+        'mean_sd': float(sds.mean()),
+        'exposure': [(p, float(np.percentile(exposure_rate, p))) for p in PERCENTILES] +
+                    [('max', float(exposure_rate.max()))],
+        'unused_ratio': float(np.mean(exposure_rate == 0)),
+        'over_max_ratio': float(np.mean(exposure_rate > EXPOSURE_MAX_RATE)),
+    }
+
+
+def main(argv):
+    q_type = argv[0] if argv else 'brm'
+    examinee_count = int(argv[1]) if len(argv) > 1 else 1000
+    item_count = int(argv[2]) if len(argv) > 2 else 2000
+    flow = argv[3] if len(argv) > 3 else '5|4|3'
+    seed = int(argv[4]) if len(argv) > 4 else None
+    result = simulate(q_type, examinee_count, item_count, flow, seed)
+    print 'model: %s, flow: %s, exposure control: %s, stop se: %s' % (q_type, flow, EXPOSURE_CONTROL, STOP_SE)
+    print 'examinees: %d, items: %d, mean test length: %.2f, items/s: %.1f' % (
+        result['examinees'], result['items'], result['mean_length'], result['items_per_second'])
+    print 'step latency (ms): ' + ', '.join('p%s %.3f' % (p, v) if p != 'max' else 'max %.3f' % v
+                                            for p, v in result['latency'])
+    print 'theta bias: %.4f, rmse: %.4f, mean posterior sd: %.4f' % (result['bias'], result['rmse'],
+                                                                     result['mean_sd'])
+    print 'exposure rate: ' + ', '.join('p%s %.4f' % (p, v) if p != 'max' else 'max %.4f' % v
+                                        for p, v in result['exposure'])
+    print 'unused items: %.2f%%, over %.2f: %.2f%%' % (result['unused_ratio'] * 100, EXPOSURE_MAX_RATE,
+                                                       result['over_max_ratio'] * 100)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
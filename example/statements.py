@@ -0,0 +1,108 @@
+# coding=utf-8
+from collections import OrderedDict
+import re
+import psycopg2
+from tornado import gen
+from tornado.log import app_log
+from settings import PREPARED_STATEMENTS
+
+# 预备语句不存在时postgresql返回的错误码
+_INVALID_SQL_STATEMENT_NAME = '26000'
+
+_EXECUTE_RE = re.compile(r'^EXECUTE (\w+)\(')
+
+
+def is_missing_statement(error):
+    """
+    :param error: psycopg2.Error
+    :return: 是否因为连接上没有预备这条语句而出错，是则可以改用原始sql重试
+    """
+    return PREPARED_STATEMENTS and error.pgcode == _INVALID_SQL_STATEMENT_NAME
+
+
+class Statement(object):
+    """
+    固定的一条查询，连接建立时PREPARE一次，之后按名字EXECUTE，不必每次重新解析和规划
+    参数个数必须固定，不定长的id列表用数组参数，例如id <> ALL(%s::integer[])
+    """
+
+    def __init__(self, name, query):
+        """
+        :param name: 预备语句名
+        :param query: 只用%s占位符的sql语句，结尾不带分号
+        """
+        self.name = name
+        self.query = query.strip().rstrip(';')
+        parts = self.query.split('%s')
+        self.param_count = len(parts) - 1
+        # 依次把%s换成$1, $2...
+        prepared = parts[0] + ''.join('$%d%s' % (i + 1, part) for i, part in enumerate(parts[1:]))
+        self.prepare_query = 'PREPARE %s AS %s' % (name, prepared)
+        self.execute_query = 'EXECUTE %s(%s)' % (name, ', '.join(['%s'] * self.param_count))
+
+    def get_query(self, params=(), prepared=PREPARED_STATEMENTS):
+        """
+        :return: (sql, 参数)，可以直接交给db.execute或StepBatch.add
+        """
+        if len(params) != self.param_count:
+            raise ValueError(u'%s需要%d个参数，传入了%d个' % (self.name, self.param_count, len(params)))
+        return (self.execute_query if prepared else self.query), params
+
+
+class StatementRegistry(object):
+    """
+    全部固定查询的登记处，连接池用get_setsession在每个新连接上预备登记过的语句
+    """
+
+    def __init__(self):
+        self._statements = OrderedDict()
+
+    def register(self, name, query):
+        """
+        登记一条查询，模块导入时调用
+        :return: Statement对象
+        """
+        if name in self._statements and self._statements[name].query != query.strip().rstrip(';'):
+            raise ValueError(u'预备语句%s重复登记' % name)
+        statement = self._statements[name] = Statement(name, query)
+        return statement
+
+    def get_raw_query(self, query):
+        """
+        :param query: sql语句
+        :return: query是登记过的语句的EXECUTE时返回原始sql，否则原样返回，参数不变
+        """
+        match = _EXECUTE_RE.match(query)
+        statement = self._statements.get(match.group(1)) if match else None
+        if statement is not None and statement.execute_query == query:
+            return statement.query
+        return query
+
+    def get_setsession(self):
+        """
+        :return: 每个新连接上要执行的PREPARE语句列表，不用预备语句时为空
+        """
+        if not PREPARED_STATEMENTS:
+            return []
+        return [statement.prepare_query for statement in self._statements.values()]
+
+    @gen.coroutine
+    def execute(self, db, statement, params=()):
+        """
+        按名字执行预备语句，连接上没有预备这条语句时（例如经过事务级的连接池中间件）退回原始sql
+        :param db: 数据库
+        :param statement: Statement对象
+        :param params: 参数序列
+        :raise gen.Return: 游标
+        """
+        try:
+            cursor = yield db.execute(*statement.get_query(params))
+        except psycopg2.Error as e:
+            if not is_missing_statement(e):
+                raise
+            app_log.warning(u'预备语句%s不存在，改用原始sql', statement.name)
+            cursor = yield db.execute(*statement.get_query(params, prepared=False))
+        raise gen.Return(cursor)
+
+
+statements = StatementRegistry()
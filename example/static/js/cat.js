@@ -14,15 +14,18 @@ setInterval(function(){set_time();}, 1000);
 $(function () {
     count_down = parseInt($("#count-down").text());
     total_time = count_down;
-    var total_item = parseInt($("#total").text());
-    var item_no = parseInt($("#current").text());
-    var progress_val = item_no / total_item * 100 | 0;
-    $(".item-bar").css("width", progress_val + '%').attr("aria-valuenow", parseInt(progress_val));
-    $(".progress-item").tooltip({
-        trigger: "hover focus",
-        title: "还剩" + (total_item - item_no) + "题",
-        placement: "left", container: "body"
-    });
+    // 变长测验没有总题量，进度条只显示第几题
+    if ($("#total").length) {
+        var total_item = parseInt($("#total").text());
+        var item_no = parseInt($("#current").text());
+        var progress_val = item_no / total_item * 100 | 0;
+        $(".item-bar").css("width", progress_val + '%').attr("aria-valuenow", parseInt(progress_val));
+        $(".progress-item").tooltip({
+            trigger: "hover focus",
+            title: "还剩" + (total_item - item_no) + "题",
+            placement: "left", container: "body"
+        });
+    }
     $(".list-choice").click(function () {
         $(".list-choice-checked").removeClass("list-choice-checked");
         $(this).addClass("list-choice-checked");
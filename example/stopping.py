@@ -0,0 +1,90 @@
+# coding=utf-8
+from abc import ABCMeta, abstractmethod
+from utils import Flow
+from settings import STOP_SE, STOP_MIN_FLOW
+
+
+class BaseStoppingRule(object):
+    """
+    终止规则，每作答一道题后决定下一道题从哪个阶段抽，或者结束测验
+    """
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def get_next_stage(self, flow, stage, stage_step, se):
+        """
+        :param flow: Flow对象
+        :param stage: 刚作答的题所在阶段
+        :param stage_step: 本阶段已作答的题量，包括刚作答的题
+        :param se: 作答后的后验标准差
+        :return: 下一道题所在阶段，flow.level_len + 1为结束测验
+        """
+        pass
+
+
+class FixedLengthRule(BaseStoppingRule):
+    """
+    定长测验，每个阶段答满flow规定的题量
+
+    >>> rule = FixedLengthRule()
+    >>> flow = Flow(name='5|4|3', flow='5|4|3')
+    >>> rule.get_next_stage(flow, 1, 4, 0.1), rule.get_next_stage(flow, 1, 5, 0.9), rule.get_next_stage(flow, 3, 3, 0.9)
+    (1, 2, 4)
+    """
+
+    def get_next_stage(self, flow, stage, stage_step, se):
+        if stage_step >= flow.get_level_item_count(stage):
+            return stage + 1
+        return stage
+
+
+class StandardErrorRule(FixedLengthRule):
+    """
+    标准误终止规则：第一阶段定长；之后的阶段最多答flow规定的题量，
+    答够最少题量且后验标准差不大于se时不再答本阶段的题，之后各阶段最少题量都为0时结束测验，否则进入下一阶段
+
+    >>> rule = StandardErrorRule(0.3, Flow(name='5|1|0', flow='5|1|0'))
+    >>> flow = Flow(name='5|4|3', flow='5|4|3')
+    >>> rule.get_next_stage(flow, 2, 1, 0.2), rule.get_next_stage(flow, 2, 2, 0.5), rule.get_next_stage(flow, 3, 1, 0.2)
+    (4, 2, 4)
+    >>> StandardErrorRule(0.3, Flow(name='5|1|1', flow='5|1|1')).get_next_stage(flow, 2, 1, 0.2)
+    3
+    """
+
+    def __init__(self, se, min_flow=None):
+        """
+        :param se: 目标标准误
+        :param min_flow: 各阶段最少题量，Flow对象，为None时第一阶段按flow，其他阶段为0
+        """
+        self.se = se
+        self.min_flow = min_flow
+
+    def get_min_count(self, flow, stage):
+        # 该阶段最少题量
+        if stage == 1:
+            return flow.get_level_item_count(1)
+        if self.min_flow is None:
+            return 0
+        return self.min_flow.get_level_item_count(stage) if stage <= self.min_flow.level_len else 0
+
+    def get_next_stage(self, flow, stage, stage_step, se):
+        next_stage = super(StandardErrorRule, self).get_next_stage(flow, stage, stage_step, se)
+        if next_stage != stage or stage == 1 or stage_step < self.get_min_count(flow, stage) or se > self.se:
+            return next_stage
+        if all(self.get_min_count(flow, _stage) == 0 for _stage in range(stage + 1, flow.level_len + 1)):
+            return flow.level_len + 1
+        return stage + 1
+
+
+def get_stopping_rule(se=STOP_SE, min_flow=STOP_MIN_FLOW):
+    """
+    :param se: 目标标准误，为None时定长
+    :param min_flow: 各阶段最少题量，形如flow的字符串
+    :return: 终止规则对象
+    """
+    if se is None:
+        return FixedLengthRule()
+    return StandardErrorRule(se, Flow(name=min_flow, flow=min_flow) if min_flow else None)
+
+
+stopping_rule = get_stopping_rule()
@@ -0,0 +1,119 @@
+# coding=utf-8
+"""
+a分层：把问卷的题按斜率分成flow阶段数个层，第一阶段用斜率最小的层，越往后斜率越大
+
+    python strata.py 问卷id [a|ab] [难度块数]
+
+'a'为按斜率等分，'ab'为按难度分块的a分层（a-stratified with b-blocking），
+先按难度把题分成若干块，每块内再按斜率分到各层，使各层的难度分布相近
+"""
+import sys
+import numpy as np
+import psycopg2
+from settings import DSN
+
+SEP = '|'
+
+
+def stratify(slop, threshold, n_strata, method='ab', n_blocks=None):
+    """
+    计算每道题所在的层
+    :param slop: 斜率，shape为（题量，）的numpy数组
+    :param threshold: 难度，shape为（题量，）的numpy数组，多级计分为各边界的均值
+    :param n_strata: 层数
+    :param method: 'a'或'ab'
+    :param n_blocks: 'ab'的难度块数，默认每块n_strata道题，即每块给每层各分一道
+    :return: 层，shape为（题量，）的整数数组，从1开始，各层题量相差不超过1（'ab'为每块内相差不超过1）
+
+    >>> stratify(np.array([0.5, 2.0, 1.0, 1.5]), np.array([0.0, 0.0, 0.0, 0.0]), 2, method='a').tolist()
+    [1, 2, 1, 2]
+    >>> stratify(np.array([0.5, 2.0, 1.0, 1.5]), np.array([-1.0, -1.1, 1.0, 1.1]), 2).tolist()
+    [1, 2, 1, 2]
+    """
+    slop = np.asarray(slop, dtype=float)
+    threshold = np.asarray(threshold, dtype=float)
+    n = slop.shape[0]
+    levels = np.empty(n, dtype=int)
+    if not n:
+        return levels
+    if method == 'a':
+        # 斜率相同时按难度排
+        order = np.lexsort((threshold, slop))
+        levels[order] = np.arange(n) * n_strata // n + 1
+    elif method == 'ab':
+        if n_blocks is None:
+            n_blocks = -(-n // n_strata)
+        n_blocks = max(1, min(n_blocks, n))
+        # 按难度分块
+        block = np.empty(n, dtype=int)
+        block[np.lexsort((slop, threshold))] = np.arange(n) * n_blocks // n
+        # 块内按斜率排序，算出块内名次
+        order = np.lexsort((threshold, slop, block))
+        block_sizes = np.bincount(block, minlength=n_blocks)
+        block_starts = np.concatenate(([0], np.cumsum(block_sizes)[:-1]))
+        sorted_block = block[order]
+        rank = np.arange(n) - block_starts[sorted_block]
+        levels[order] = rank * n_strata // block_sizes[sorted_block] + 1
+    else:
+        raise ValueError(u'不支持的分层方法%s' % method)
+    return levels
+
+
+def describe_strata(levels, slop, threshold):
+    """
+    :return: [(层, 题量, 平均斜率, 平均难度, 难度标准差)]
+    """
+    result = []
+    for level in np.unique(levels):
+        mask = levels == level
+        result.append((int(level), int(mask.sum()), float(slop[mask].mean()), float(threshold[mask].mean()),
+                       float(threshold[mask].std())))
+    return result
+
+
+def restratify(cursor, q_id, method='ab', n_blocks=None):
+    """
+    重新计算问卷各题的层，批量写回question.a_level，并更新level_one_count
+    :param cursor: 事务中的游标
+    :param q_id: 问卷id
+    :return: (题目id数组, 层数组, 斜率数组, 难度数组)
+    """
+    cursor.execute('SELECT flow FROM questionnaire WHERE id=%s;', (q_id,))
+    row = cursor.fetchone()
+    if row is None:
+        raise ValueError(u'问卷%s不存在' % q_id)
+    n_strata = len(row[0].split(SEP))
+    cursor.execute('SELECT id, slop, threshold FROM question WHERE questionnaire_id=%s;', (q_id,))
+    values = np.array(cursor.fetchall(), dtype=float).reshape(-1, 3)
+    que_ids = values[:, 0].astype(int)
+    slop = values[:, 1]
+    threshold = values[:, 2]
+    levels = stratify(slop, threshold, n_strata, method, n_blocks)
+    # 只改层有变化的题
+    cursor.execute("""
+        UPDATE question SET a_level = v.a_level
+        FROM unnest(%s::integer[], %s::integer[]) AS v(id, a_level)
+        WHERE question.id = v.id AND question.a_level <> v.a_level;
+        UPDATE questionnaire SET level_one_count = %s WHERE id = %s;
+        """, (que_ids.tolist(), levels.tolist(), int(np.sum(levels == 1)), q_id))
+    return que_ids, levels, slop, threshold
+
+
+def main(argv):
+    q_id = int(argv[0])
+    method = argv[1] if len(argv) > 1 else 'ab'
+    n_blocks = int(argv[2]) if len(argv) > 2 else None
+    conn = psycopg2.connect(DSN)
+    try:
+        with conn:
+            with conn.cursor() as cursor:
+                que_ids, levels, slop, threshold = restratify(cursor, q_id, method, n_blocks)
+        print '%6s %8s %10s %10s %10s' % ('level', 'count', 'mean a', 'mean b', 'sd b')
+        for level, count, mean_a, mean_b, sd_b in describe_strata(levels, slop, threshold):
+            print '%6d %8d %10.4f %10.4f %10.4f' % (level, count, mean_a, mean_b, sd_b)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,122 @@
+# coding=utf-8
+"""
+曝光次数写回和题库缓存重新载入的测试，用可以控制何时返回的假数据库
+
+    python -m unittest discover -p 'test_*.py'
+"""
+from collections import namedtuple
+import unittest
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.testing import AsyncTestCase, gen_test
+from exposure import ExposureCounter
+from itembank import ItemBankCache
+from bank import BrmShadowBank
+from utils import Que
+import itembank
+import bank
+
+Questionnaire = namedtuple('Questionnaire', ('id', 'type', 'bank_version', 'exposure_version'))
+
+
+class FakeCursor(object):
+
+    def __init__(self, rows=()):
+        self._rows = list(rows)
+
+    def fetchall(self):
+        return self._rows
+
+
+class FakeDB(object):
+    """
+    question表只有一道题，COUNT_UPDATE在release之前不返回，用来模拟写回进行到一半
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.executed = []
+        self._blocked = None
+
+    def block(self):
+        self._blocked = Future()
+
+    def release(self):
+        blocked, self._blocked = self._blocked, None
+        blocked.set_result(None)
+
+    @gen.coroutine
+    def execute(self, query, params=()):
+        self.executed.append(query)
+        if 'question_count_update' in query:
+            que_ids, n_list = params
+            # 写回先在数据库里提交，回复晚一点才到
+            self.count += sum(n_list)
+            if self._blocked is not None:
+                yield self._blocked
+            raise gen.Return(FakeCursor())
+        if 'shadow_select' in query:
+            # 两道参数相同的题，数据库里的曝光次数都是0
+            raise gen.Return(FakeCursor([Que(que_id, u'题目%d' % que_id, 1.0, 0.0, None, None, u'错|对', '0|1', 0, 2,
+                                             1, 1.0, 0.0, i + 1) for i, que_id in enumerate((1, 2))]))
+        if 'bank_select' in query:
+            raise gen.Return(FakeCursor([(1, u'题目1', 1.0, 0.0, None, None, u'错|对', '0|1', self.count, 1, 1,
+                                          1.0, 0.0)]))
+        raise AssertionError(query)
+
+
+class ExposureCounterTest(AsyncTestCase):
+
+    def setUp(self):
+        super(ExposureCounterTest, self).setUp()
+        self.db = FakeDB()
+        self.counter = ExposureCounter()
+        self._counter, itembank.exposure_counter = itembank.exposure_counter, self.counter
+        bank.exposure_counter = self.counter
+
+    def tearDown(self):
+        itembank.exposure_counter = bank.exposure_counter = self._counter
+        super(ExposureCounterTest, self).tearDown()
+
+    @gen_test
+    def test_flush(self):
+        self.counter.incr(1)
+        self.counter.incr(1, 2)
+        yield self.counter.flush(self.db)
+        self.assertEqual(self.db.count, 3)
+        self.assertEqual(self.counter.get_pending_items(), [])
+
+    @gen_test
+    def test_reload_during_flush_does_not_double_count(self):
+        self.counter.incr(1, 3)
+        self.db.block()
+        flush = self.counter.flush(self.db)
+        # 写回已经提交但还没返回时重新载入题库
+        reload = ItemBankCache().get_bank(self.db, Questionnaire(1, 'brm', 0, 0))
+        self.counter.incr(1)
+        self.db.release()
+        yield flush
+        bank = yield reload
+        # 数据库里的3次加上之后新增的1次
+        self.assertEqual(bank.get_level(1).count_array.tolist(), [4.0])
+
+    @gen_test
+    def test_close_flushes_pending(self):
+        self.counter.start(self.db, 3600)
+        self.counter.incr(1, 2)
+        yield self.counter.close(self.db)
+        self.assertEqual(self.db.count, 2)
+        self.assertIsNone(self.counter._callback)
+
+    @gen_test
+    def test_shadow_bank_counts_pending(self):
+        # 不用题库缓存时，还没写回的曝光次数也参与选题
+        que = yield BrmShadowBank(1, 2, 0.0, [], self.db).get_que()
+        self.assertEqual(que.id, 1)
+        self.counter.incr(1, 5)
+        que = yield BrmShadowBank(1, 2, 0.0, [], self.db).get_que()
+        self.assertEqual(que.id, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
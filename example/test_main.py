@@ -0,0 +1,237 @@
+# coding=utf-8
+"""
+QuestionHandler的作答流程测试，用内存里的假数据库代替postgresql和momoko，
+session存在（假的）postgresql里，走和默认settings相同的预取session分支
+
+    python -m unittest discover -p 'test_*.py'
+"""
+from collections import namedtuple
+import os
+import re
+import unittest
+from tornado.concurrent import Future
+from tornado.testing import AsyncHTTPTestCase
+from tornado.web import Application
+from psycopg2 import IntegrityError
+from main import QuestionHandler
+import main
+from session import PostgresSessionStore
+from itembank import item_bank_cache
+from utils import get_test_state_key
+
+AnswerRow = namedtuple('AnswerRow', ('aid', 'try_count', 'has_finished', 'answered', 'id', 'type', 'second',
+                                     'flow', 'level_one_count', 'bank_version', 'info_table_version',
+                                     'exposure_version', 'session_data'))
+AnswerInsertRow = namedtuple('AnswerInsertRow', ('aid', 'try_count', 'has_finished', 'answered'))
+
+Q_ID = 1
+
+FLOW = '2|1|1'
+
+# 各层的题：(id, 斜率, 难度, 层)
+QUESTIONS = [(1, 1.0, -1.0, 1), (2, 1.2, -0.5, 1), (3, 0.8, 0.5, 1), (4, 1.1, 1.0, 1),
+             (5, 1.5, -0.5, 2), (6, 1.4, 0.0, 2), (7, 1.6, 0.5, 2),
+             (8, 2.0, -0.5, 3), (9, 1.9, 0.0, 3), (10, 2.1, 0.5, 3)]
+
+
+class FakeCursor(object):
+
+    def __init__(self, rows=()):
+        self._rows = list(rows)
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return self._rows
+
+
+class FakeDB(object):
+    """
+    按预备语句名应答的假数据库，只认QuestionHandler一步作答用到的语句，
+    session、作答记录和response表都存在字典和列表里
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        # session_key: AnswerInsertRow
+        self.answers = {}
+        self.responses = []
+        self.executed = []
+        # exposure_params.py写回的曝光参数：试题id: (曝光参数, 曝光率)
+        self.exposure_version = 0
+        self.exposure_params = {}
+
+    def execute(self, query, params=()):
+        future = Future()
+        try:
+            cursor = None
+            # StepBatch把多条语句拼成一条，按各自的占位符个数切分参数
+            for sql in query.rstrip(';').split(';\n'):
+                n = sql.count('%s')
+                cursor = self._execute(sql.strip(), params[:n])
+                params = params[n:]
+            future.set_result(cursor)
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _execute(self, sql, params):
+        name = re.match(r'EXECUTE (\w+)\(', sql).group(1)
+        self.executed.append(name)
+        return getattr(self, name)(*params) or FakeCursor()
+
+    def answer_select_with_session(self, session_key, _session_key, q_id):
+        ans = self.answers.get(session_key) or AnswerInsertRow(None, None, None, None)
+        return FakeCursor([AnswerRow(*(tuple(ans) + (int(q_id), 'brm', 30, FLOW, 4, 0, 0, self.exposure_version,
+                                                     self.sessions.get(session_key))))])
+
+    def session_insert(self, session_key, session_data):
+        if session_key in self.sessions:
+            raise IntegrityError()
+        self.sessions[session_key] = dict(session_data.adapted)
+
+    def session_update_changes(self, deleted, changed, session_key):
+        session_data = self.sessions[session_key]
+        for key in deleted:
+            session_data.pop(key, None)
+        session_data.update(changed.adapted)
+
+    def answer_insert(self, q_id, session_key):
+        ans = self.answers[session_key] = AnswerInsertRow(len(self.answers) + 1, 1, False, [])
+        return FakeCursor([ans])
+
+    def answer_restart(self, aid):
+        pass
+
+    def bank_select(self, q_id):
+        return FakeCursor([(que_id, u'题目%d' % que_id, slop, threshold, None, None, u'错|对', '0|1', 0, a_level,
+                            q_id, 1.0, 0.0) for que_id, slop, threshold, a_level in QUESTIONS])
+
+    def exposure_select(self, q_id):
+        return FakeCursor([(que_id, ) + self.exposure_params.get(que_id, (1.0, 0.0)) for que_id, _, _, _ in QUESTIONS])
+
+    def response_insert(self, *params):
+        self.responses.append(params)
+
+    def answer_finish(self, theta, info, has_finished, aid):
+        pass
+
+
+class QuestionHandlerTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        application = Application([(r"/cat/(\d+)", QuestionHandler)],
+                                  template_path=os.path.join(os.path.dirname(__file__), "templates"),
+                                  static_path=os.path.join(os.path.dirname(__file__), "static"),
+                                  cookie_secret='test')
+        self.db = application.db = FakeDB()
+        application.session_store = PostgresSessionStore(application.db)
+        return application
+
+    def setUp(self):
+        super(QuestionHandlerTest, self).setUp()
+        item_bank_cache.invalidate()
+
+    def tearDown(self):
+        item_bank_cache.invalidate()
+        super(QuestionHandlerTest, self).tearDown()
+
+    def get_state(self, session_key):
+        return self.db.sessions[session_key][get_test_state_key(Q_ID)]
+
+    def test_first_get_creates_session_and_state(self):
+        response = self.fetch('/cat/%d' % Q_ID)
+        self.assertEqual(response.code, 200)
+        session_key = re.search(r'sessionid=(\w+)', response.headers['Set-Cookie']).group(1)
+        # [re_start, step, stage, step_count, que_id, next_ids, ...]
+        state = self.get_state(session_key)
+        self.assertEqual(state[1:4], [1, 1, 4])
+        self.assertIn(state[4], [1, 2, 3, 4])
+        self.assertEqual(len(state[5]), 1)
+
+    def test_one_step(self):
+        response = self.fetch('/cat/%d' % Q_ID)
+        session_key = re.search(r'sessionid=(\w+)', response.headers['Set-Cookie']).group(1)
+        headers = {'Cookie': 'sessionid=%s' % session_key}
+        que_id = self.get_state(session_key)[4]
+
+        # 作答第一道题，response表追加一行，重定向到下一道题
+        del self.db.executed[:]
+        response = self.fetch('/cat/%d' % Q_ID, method='POST', body='question=1', headers=headers,
+                              follow_redirects=False)
+        self.assertEqual(response.code, 302)
+        self.assertEqual(response.headers['Location'], '/cat/%d' % Q_ID)
+        self.assertEqual(response.headers['X-DB-Round-Trips'], '2')
+        self.assertEqual(self.db.executed, ['answer_select_with_session', 'response_insert',
+                                            'session_update_changes'])
+        self.assertEqual([(_[3], _[6]) for _ in self.db.responses], [(que_id, 1)])
+        state = self.get_state(session_key)
+        self.assertEqual(state[0], 0)
+        self.assertEqual(state[6:8], [[que_id], [1]])
+
+        # 展示第一阶段的第二道题，只有一次读一次写
+        next_id = state[5][0]
+        response = self.fetch('/cat/%d' % Q_ID, headers=headers)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['X-DB-Round-Trips'], '2')
+        state = self.get_state(session_key)
+        self.assertEqual(state[:5], [1, 2, 1, 4, next_id])
+
+    def test_repeated_post_is_not_scored(self):
+        response = self.fetch('/cat/%d' % Q_ID)
+        session_key = re.search(r'sessionid=(\w+)', response.headers['Set-Cookie']).group(1)
+        headers = {'Cookie': 'sessionid=%s' % session_key}
+        que_id = self.get_state(session_key)[4]
+        response = self.fetch('/cat/%d' % Q_ID, method='POST', body='question=1', headers=headers,
+                              follow_redirects=False)
+        self.assertEqual(response.code, 302)
+        state = self.get_state(session_key)
+
+        # 再次提交同一个答案，只重定向回测验页面，不追加作答记录，测验状态不变
+        del self.db.executed[:]
+        response = self.fetch('/cat/%d' % Q_ID, method='POST', body='question=1', headers=headers,
+                              follow_redirects=False)
+        self.assertEqual(response.code, 302)
+        self.assertEqual(response.headers['Location'], '/cat/%d' % Q_ID)
+        self.assertEqual(self.db.executed, ['answer_select_with_session'])
+        self.assertEqual([(_[3], _[6]) for _ in self.db.responses], [(que_id, 1)])
+        self.assertEqual(self.get_state(session_key), state)
+        # [re_start, step, stage, step_count, que_id, next_ids, ids, score, posterior, stage_step]
+        self.assertEqual((state[2], state[4], state[6], state[9]), (1, None, [que_id], 1))
+
+    def test_total_hidden_for_variable_length(self):
+        response = self.fetch('/cat/%d' % Q_ID)
+        self.assertIn(b'<div id="total">4</div>', response.body)
+        # 标准误终止规则下总题量不定，不显示flow的总题量
+        self._stop_se, main.STOP_SE = main.STOP_SE, 0.3
+        try:
+            response = self.fetch('/cat/%d' % Q_ID)
+        finally:
+            main.STOP_SE = self._stop_se
+        self.assertEqual(response.code, 200)
+        self.assertNotIn(b'id="total"', response.body)
+        self.assertIn(u'第1题'.encode('utf-8'), response.body)
+
+    def test_exposure_params_refresh_without_reload(self):
+        response = self.fetch('/cat/%d' % Q_ID)
+        headers = {'Cookie': 'sessionid=%s' % re.search(r'sessionid=(\w+)', response.headers['Set-Cookie']).group(1)}
+        bank = item_bank_cache._banks[Q_ID]
+
+        # 曝光参数改了只刷新这两列，题库不重新载入
+        self.db.exposure_version = 1
+        self.db.exposure_params = {6: (0.5, 0.3)}
+        del self.db.executed[:]
+        response = self.fetch('/cat/%d' % Q_ID, method='POST', body='question=1', headers=headers,
+                              follow_redirects=False)
+        self.assertEqual(response.code, 302)
+        self.assertIn('exposure_select', self.db.executed)
+        self.assertNotIn('bank_select', self.db.executed)
+        self.assertIs(item_bank_cache._banks[Q_ID], bank)
+        level_bank = bank.get_level(2)
+        i = level_bank.id_array.tolist().index(6)
+        self.assertEqual((level_bank.exposure_param_array[i], level_bank.exposure_rate_array[i]), (0.5, 0.3))
+
+
+if __name__ == '__main__':
+    unittest.main()
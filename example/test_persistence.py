@@ -0,0 +1,80 @@
+# coding=utf-8
+"""
+StepBatch的测试：连接上没有预备语句时整批改用原始sql重发
+
+    python -m unittest discover -p 'test_*.py'
+"""
+import unittest
+import psycopg2
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+from persistence import StepBatch
+from statements import StatementRegistry
+import persistence
+import statements as statements_module
+
+
+class MissingStatementError(psycopg2.OperationalError):
+    pgcode = '26000'
+
+
+class FakeDB(object):
+    """
+    没有预备任何语句的连接，执行EXECUTE时报26000
+    """
+
+    def __init__(self, error=MissingStatementError):
+        self.error = error
+        self.executed = []
+
+    @gen.coroutine
+    def execute(self, query, params=()):
+        self.executed.append((query, list(params)))
+        if 'EXECUTE' in query:
+            raise self.error('prepared statement does not exist')
+
+
+class StepBatchTest(AsyncTestCase):
+
+    def setUp(self):
+        super(StepBatchTest, self).setUp()
+        self.registry = StatementRegistry()
+        self.insert = self.registry.register('t_insert', "INSERT INTO t (a, b) VALUES (%s, %s)")
+        self.update = self.registry.register('t_update', "UPDATE t SET a = %s WHERE b = %s")
+        self._statements, persistence.statements = persistence.statements, self.registry
+        self._prepared, statements_module.PREPARED_STATEMENTS = statements_module.PREPARED_STATEMENTS, True
+
+    def tearDown(self):
+        persistence.statements = self._statements
+        statements_module.PREPARED_STATEMENTS = self._prepared
+        super(StepBatchTest, self).tearDown()
+
+    def get_batch(self):
+        batch = StepBatch()
+        batch.add(*self.insert.get_query((1, 'x'), prepared=True))
+        batch.add('UPDATE t SET a = a + 1')
+        batch.add(*self.update.get_query((2, 'y'), prepared=True))
+        return batch
+
+    @gen_test
+    def test_fallback_to_raw_sql(self):
+        db = FakeDB()
+        batch = self.get_batch()
+        yield batch.execute(db)
+        self.assertEqual(len(db.executed), 2)
+        self.assertEqual(db.executed[0][0], 'EXECUTE t_insert(%s, %s);\nUPDATE t SET a = a + 1;\n'
+                                            'EXECUTE t_update(%s, %s);')
+        self.assertEqual(db.executed[1], ('INSERT INTO t (a, b) VALUES (%s, %s);\nUPDATE t SET a = a + 1;\n'
+                                          'UPDATE t SET a = %s WHERE b = %s;', [1, 'x', 2, 'y']))
+        self.assertEqual(len(batch), 0)
+
+    @gen_test
+    def test_other_errors_are_raised(self):
+        db = FakeDB(psycopg2.IntegrityError)
+        with self.assertRaises(psycopg2.IntegrityError):
+            yield self.get_batch().execute(db)
+        self.assertEqual(len(db.executed), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,223 @@
+# coding=utf-8
+"""
+session存储后端的测试：进程内LRU的过期和淘汰，redis后端对着本地的redis协议替身测试读写、过期和RESP回复的解析
+
+    python -m unittest discover -p 'test_*.py'
+"""
+import unittest
+from tornado import gen
+from tornado.iostream import StreamClosedError
+from tornado.tcpserver import TCPServer
+from tornado.testing import AsyncTestCase, gen_test, bind_unused_port
+import session
+from session import Session, MemorySessionStore, RedisSessionStore, RedisConnection, RedisError
+
+
+class FakeClock(object):
+    # 代替time模块，测试里手动拨动时间
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class FakeRedisServer(TCPServer):
+    """
+    只实现GET、SET（EX、NX）、DEL、SELECT、AUTH的redis协议替身，过期时间按clock计算
+    """
+
+    def __init__(self, clock):
+        super(FakeRedisServer, self).__init__()
+        self.clock = clock
+        # 键: (值, 过期时刻或None)
+        self.data = {}
+        self.commands = []
+        self.streams = []
+
+    def close_connections(self):
+        # 模拟服务端断开连接
+        for stream in self.streams:
+            stream.close()
+        self.streams = []
+
+    @gen.coroutine
+    def _read_command(self, stream):
+        line = yield stream.read_until(b'\r\n')
+        assert line[:1] == b'*'
+        args = []
+        for i in range(int(line[1:-2])):
+            line = yield stream.read_until(b'\r\n')
+            assert line[:1] == b'$'
+            data = yield stream.read_bytes(int(line[1:-2]) + 2)
+            args.append(data[:-2])
+        raise gen.Return(args)
+
+    def _get(self, key):
+        value, expire = self.data.get(key, (None, None))
+        if expire is not None and expire <= self.clock.time():
+            del self.data[key]
+            return None
+        return value
+
+    def _reply(self, args):
+        command = args[0].upper()
+        if command in (b'SELECT', b'AUTH'):
+            return b'+OK\r\n'
+        if command == b'GET':
+            value = self._get(args[1])
+            return b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+        if command == b'SET':
+            key, value, options = args[1], args[2], [_.upper() for _ in args[3:]]
+            if b'NX' in options and self._get(key) is not None:
+                return b'$-1\r\n'
+            expire = None
+            if b'EX' in options:
+                expire = self.clock.time() + int(args[3 + options.index(b'EX') + 1])
+            self.data[key] = (value, expire)
+            return b'+OK\r\n'
+        if command == b'DEL':
+            return b':%d\r\n' % int(self.data.pop(args[1], None) is not None)
+        return b'-ERR unknown command\r\n'
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        self.streams.append(stream)
+        try:
+            while True:
+                args = yield self._read_command(stream)
+                self.commands.append(args)
+                yield stream.write(self._reply(args))
+        except StreamClosedError:
+            pass
+
+
+class MemorySessionStoreTest(AsyncTestCase):
+
+    def setUp(self):
+        super(MemorySessionStoreTest, self).setUp()
+        self.clock = FakeClock()
+        self._time, session.time = session.time, self.clock
+
+    def tearDown(self):
+        session.time = self._time
+        super(MemorySessionStoreTest, self).tearDown()
+
+    @gen_test
+    def test_round_trip(self):
+        store = MemorySessionStore(ttl=60)
+        created = yield store.create('a', {})
+        self.assertTrue(created)
+        created = yield store.create('a', {})
+        self.assertFalse(created)
+        yield store.save('a', {'cat_1': [1, 2, None], u'名': u'值'})
+        data = yield store.get('a')
+        self.assertEqual(data, {'cat_1': [1, 2, None], u'名': u'值'})
+        # 每次取出的是新字典，改动不影响存着的session
+        data['cat_1'].append(3)
+        data = yield store.get('a')
+        self.assertEqual(data['cat_1'], [1, 2, None])
+        yield store.delete('a')
+        data = yield store.get('a')
+        self.assertIsNone(data)
+
+    @gen_test
+    def test_ttl(self):
+        store = MemorySessionStore(ttl=60)
+        yield store.create('a', {'x': 1})
+        self.clock.now += 59
+        data = yield store.get('a')
+        self.assertEqual(data, {'x': 1})
+        self.clock.now += 2
+        data = yield store.get('a')
+        self.assertIsNone(data)
+        # 过期的session_key可以重新创建
+        created = yield store.create('a', {})
+        self.assertTrue(created)
+
+    @gen_test
+    def test_save_renews_ttl(self):
+        store = MemorySessionStore(ttl=60)
+        yield store.create('a', {})
+        self.clock.now += 50
+        yield store.save_changes('a', Session({'x': 1}))
+        self.clock.now += 50
+        data = yield store.get('a')
+        self.assertEqual(data, {'x': 1})
+
+    @gen_test
+    def test_lru_eviction(self):
+        store = MemorySessionStore(max_size=2, ttl=60)
+        yield store.create('a', {})
+        yield store.create('b', {})
+        # 读一次a，b变成最久没用的
+        yield store.get('a')
+        yield store.create('c', {})
+        a, b, c = yield [store.get('a'), store.get('b'), store.get('c')]
+        self.assertEqual((a, b, c), ({}, None, {}))
+
+
+class RedisSessionStoreTest(AsyncTestCase):
+
+    def setUp(self):
+        super(RedisSessionStoreTest, self).setUp()
+        self.clock = FakeClock()
+        sock, port = bind_unused_port()
+        self.server = FakeRedisServer(self.clock)
+        self.server.add_socket(sock)
+        self.connection = RedisConnection('127.0.0.1', port, db=2)
+        self.store = RedisSessionStore(self.connection, ttl=60, prefix='s:')
+
+    def tearDown(self):
+        self.server.stop()
+        self.server.close_connections()
+        super(RedisSessionStoreTest, self).tearDown()
+
+    @gen_test
+    def test_round_trip(self):
+        created = yield self.store.create('a', {})
+        self.assertTrue(created)
+        created = yield self.store.create('a', {'x': 1})
+        self.assertFalse(created)
+        yield self.store.save('a', {'cat_1': [1, 2.5, None], u'名': u'值'})
+        data = yield self.store.get('a')
+        self.assertEqual(data, {'cat_1': [1, 2.5, None], u'名': u'值'})
+        yield self.store.delete('a')
+        data = yield self.store.get('a')
+        self.assertIsNone(data)
+        # 连接建立时选库，键带前缀，过期时间随每次写入
+        self.assertEqual(self.server.commands[0], [b'SELECT', b'2'])
+        self.assertEqual(self.server.commands[1], [b'SET', b's:a', b'{}', b'EX', b'60', b'NX'])
+
+    @gen_test
+    def test_ttl(self):
+        yield self.store.create('a', {'x': 1})
+        self.clock.now += 59
+        data = yield self.store.get('a')
+        self.assertEqual(data, {'x': 1})
+        self.clock.now += 2
+        data = yield self.store.get('a')
+        self.assertIsNone(data)
+
+    @gen_test
+    def test_replies(self):
+        reply = yield self.connection.execute('DEL', 'missing')
+        self.assertEqual(reply, 0)
+        reply = yield self.connection.execute('SET', 'k', u'值')
+        self.assertEqual(reply, b'OK')
+        reply = yield self.connection.execute('GET', 'k')
+        self.assertEqual(reply, u'值'.encode('utf-8'))
+        with self.assertRaises(RedisError):
+            yield self.connection.execute('FLUSHALL')
+
+    @gen_test
+    def test_reconnect(self):
+        yield self.store.create('a', {'x': 1})
+        self.server.close_connections()
+        data = yield self.store.get('a')
+        self.assertEqual(data, {'x': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
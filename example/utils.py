@@ -3,6 +3,7 @@ from collections import namedtuple
 import random
 import string
 import weakref
+import numpy as np
 
 
 class CachedProperty(object):
@@ -114,34 +115,6 @@ class Flow(object):
             cls._cache[name] = instance
         return cls._cache[name]
 
-def get_quiz_stage(step, stage, flow):
-    """
-    确定目前测验处于的阶段
-    :param step: 整数，测验所做试题量
-    :param stage:整数，测验所处阶段
-    :param flow: Flow的实例
-    :return:整数，测验应该所处阶段
-
-    >>> flow = Flow('3|4|5')
-    >>> get_quiz_stage(3, 1, flow)
-    2
-    >>> get_quiz_stage(2, 1, flow)
-    1
-    >>> get_quiz_stage(4, 2, flow)
-    2
-    """
-    if not isinstance(flow, Flow):
-        raise TypeError(u"flow必须是Flow的实例")
-    if not isinstance(step, int):
-        raise TypeError(u"step必须的整数")
-    if not isinstance(stage, int):
-        raise TypeError(u"stage必须是整数")
-
-    if step == flow.get_below_level_item_count(stage):
-        return stage + 1
-    else:
-        return stage
-
 
 def get_threshold(que_obj):
     if not que_obj.thresholds:
@@ -151,63 +124,143 @@ def get_threshold(que_obj):
         return thresholds
 
 
+def get_threshold_matrix(threshold_list):
+    """
+    把多级计分题的边界阈值排成矩阵，边界数不同的题在右侧用np.inf补齐
+    :param threshold_list: 各题get_threshold的返回值列表
+    :return: shape为（题量，最大边界数）的numpy数组
+
+    >>> get_threshold_matrix([[-1.0, 1.0], [0.5]]).tolist()
+    [[-1.0, 1.0], [0.5, inf]]
+    """
+    width = max([len(_) for _ in threshold_list] or [0])
+    matrix = np.full((len(threshold_list), width), np.inf)
+    for i, thresholds in enumerate(threshold_list):
+        matrix[i, :len(thresholds)] = thresholds
+    return matrix
+
+
+def get_choice_values(que_obj):
+    # 各选项的得分列表
+    return [int(each_value.strip()) for each_value in que_obj.choice_value.split('|')]
+
+
 Que = namedtuple('que', ('id', 'question', 'slop', 'threshold', 'thresholds', 'intercept', 'choice_text',
-                         'choice_value', 'count', 'a_level', 'questionnaire_id', 'row_num'))
-
-
-def session_reset(session, q_id):
-    # 设置为重启模式
-    session['is_%s_re_start' % q_id] = True
-    # 设置当前为第一道题，即第一步
-    session['%s_step' % q_id] = 1
-    # 设置当前为第一阶段
-    session['%s_stage' % q_id] = 1
-    # 初始化启动位置
-    session['start_%s' % q_id] = None
-    # 初始化当前所答试题id
-    session['q_%s_id' % q_id] = None
-    # 初始化试题参数
-    session['%s_a' % q_id] = []
-    # 初始化试题参数
-    session['%s_b' % q_id] = []
-    # 初始化得分
-    session['%s_score' % q_id] = []
-    session['%s_step_count' % q_id] = None
-    session['%s_next_item' % q_id] = None
-    session['%s_x0' % q_id] = None
-
-
-def del_session(session, q_id):
-    # 删除测验相关键值
-    del session['is_%s_re_start' % q_id]
-    del session['%s_step' % q_id]
-    del session['%s_stage' % q_id]
-    del session['start_%s' % q_id]
-    del session['q_%s_id' % q_id]
-    del session['%s_a' % q_id]
-    del session['%s_b' % q_id]
-    del session['%s_score' % q_id]
-    del session['%s_next_item' % q_id]
-    del session['%s_step_count' % q_id]
-    del session['%s_x0' % q_id]
-
-
-def get_has_answered_que_id_list(ans, a_level):
-    old_ans = ans.old_answer
-    que_id_list = []
-    if old_ans:
-        for k, v in old_ans.items():
-            if v['a_level'] == a_level:
-                que_id_list.append(k)
+                         'choice_value', 'count', 'a_level', 'questionnaire_id', 'exposure_param', 'exposure_rate',
+                         'row_num'))
+
+
+class TestState(object):
+    """
+    一个测验的作答状态，整个存成session里的一个键，
+    只保存试题id，题干、选项等内容按id从题库里取
+
+    >>> state = TestState()
+    >>> state.add_response(12, 1)
+    >>> TestState.from_json(state.to_json()).ids
+    array([12], dtype=int32)
+    """
+
+    __slots__ = ('re_start', 'step', 'stage', 'step_count', 'que_id', 'next_ids', 'ids', 'score', 'posterior',
+                 'stage_step')
+
+    def __init__(self, re_start=True, step=1, stage=1, step_count=None, que_id=None, next_ids=None,
+                 ids=None, score=None, posterior=None, stage_step=0):
+        """
+        :param re_start: 再次打开测验页面时是否重启测验
+        :param step: 当前是第几道题
+        :param stage: 当前所处阶段
+        :param step_count: 总共答题量
+        :param que_id: 当前展现给被试的试题id
+        :param next_ids: 接下来要展现的试题id列表
+        :param ids: 已作答的试题id
+        :param score: 已作答试题的得分
+        :param posterior: 后验状态，PosteriorState.to_json()的返回值
+        :param stage_step: 当前阶段已作答的题量
+        """
+        self.re_start = re_start
+        self.step = step
+        self.stage = stage
+        self.step_count = step_count
+        self.que_id = que_id
+        self.next_ids = next_ids or []
+        self.ids = np.array(ids or [], dtype=np.int32)
+        self.score = np.array(score or [], dtype=np.int8)
+        self.posterior = posterior
+        self.stage_step = stage_step
+
+    def add_response(self, que_id, score):
+        self.ids = np.append(self.ids, np.int32(que_id))
+        self.score = np.append(self.score, np.int8(score))
+
+    def to_json(self):
+        return [int(self.re_start), self.step, self.stage, self.step_count, self.que_id, self.next_ids,
+                self.ids.tolist(), self.score.tolist(), self.posterior, self.stage_step]
+
+    @classmethod
+    def from_json(cls, data):
+        re_start = data[0]
+        # 旧的测验状态没有stage_step
+        return cls(bool(re_start), *data[1:])
+
+
+def get_test_state_key(q_id):
+    # 测验状态在session里的键
+    return 'cat_%s' % q_id
+
+
+def get_test_state(session, q_id):
+    """
+    :return: TestState对象，session里没有时返回None
+    """
+    data = session.get(get_test_state_key(q_id))
+    return None if data is None else TestState.from_json(data)
+
+
+def set_test_state(session, q_id, state):
+    session[get_test_state_key(q_id)] = state.to_json()
+
+
+def del_test_state(session, q_id):
+    # 删除测验状态
+    session.pop(get_test_state_key(q_id), None)
+
+
+def get_has_answered_que_id_list(ans, state, a_level):
+    """
+    不该再抽的题目id列表
+    :param ans: 作答记录，answered为response表里已作答的[试题id, 层次]列表
+    :param state: 测验状态，TestState对象
+    :param a_level: 层次
+    :return: 该层以前作答过的题目id，第一层以外还要加上本次测验已作答的题目id
+    """
+    que_id_list = [que_id for que_id, level in ans.answered or [] if level == a_level]
     if a_level == 1:
         return que_id_list
     else:
-        ans = ans.score_answer
-        if ans:
-            for k, v in ans.items():
-                if v['a_level'] == a_level:
-                    que_id_list.append(k)
-        return que_id_list
+        return sorted(set(que_id_list) | set(state.ids.tolist()))
+
+
+def get_answer_views(responses):
+    """
+    由response表的作答记录生成结果页用的order_answer和score_answer字典
+    :param responses: 一次测验的作答记录，按step排序，需要有question_id, choice, score, theta, info
+                      以及试题的slop, threshold, thresholds
+    :return: (order_answer, score_answer)，order_answer为{顺序: 题号}，score_answer为{题号: 作答详情}，
+             键都是字符串
+    """
+    order_answer = {}
+    score_answer = {}
+    for i, response in enumerate(responses):
+        que_id = str(response.question_id)
+        order_answer[str(i + 1)] = que_id
+        score_answer[que_id] = {'choice': response.choice,
+                                'score': response.score,
+                                'slop': response.slop,
+                                'threshold': get_threshold(response),
+                                'info': response.info if response.info is not None else '',
+                                'theta': response.theta if response.theta is not None else ''}
+    return order_answer, score_answer
 
 
 class CheckChoice(object):
@@ -215,15 +268,22 @@ class CheckChoice(object):
     检查post的数据
     """
 
-    def __init__(self, choice, que):
+    def __init__(self, choice, que, scores=None):
+        """
+        :param choice: post的选项下标
+        :param que: 试题对象
+        :param scores: 可选，题库载入时算好的各选项得分数组（ScoreTable.get_scores），为None时解析que.choice_value
+        """
         self._choice = choice
         self._que = que
+        self._scores = scores
         self._value = None
 
     def _get_value_list(self):
         # 返回试题得分的列表
-        _value_list = self._que.choice_value.split('|')
-        value_list = [int(each_value.strip()) for each_value in _value_list]
+        if self._scores is not None:
+            return self._scores, self._scores.min()
+        value_list = get_choice_values(self._que)
         min_value = min(value_list)
         return value_list, min_value
 
@@ -236,7 +296,7 @@ class CheckChoice(object):
                 self.value = min_value
             else:
                 i = int(choice)
-                self.value = value_list[i]
+                self.value = int(value_list[i])
             return True
         except IndexError:
             return False